@@ -0,0 +1,103 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import tempfile
+import time
+
+import sqlite3_collector_backend
+
+"""
+Ingest throughput of the collector backend, driven in-process so only the
+storage path is measured, not HTTP.
+"""
+
+
+def sample_record(i: int) -> dict:
+    """Query params as one of 1000 AirCompressor mock emitters sends them"""
+    return {
+        "uuid": "compressor-{}".format(i % 1000),
+        "device_type": "AirCompressor",
+        "device_model": "PythonMock",
+        "protocol_ver": "-1",
+        "firmware_ver": "-1",
+        "heapfree": str(20000 + i % 100),
+        "metric.psi": str(90 + i % 10),
+        "metric.tank_temp_f": "130",
+        "metric.head_temp_f": "200",
+        "metric.compressor_running": "no",
+        "metric.power_w": "0.1",
+    }
+
+
+def bench_per_row(records: list, on_disk: bool = False) -> float:
+    """
+    records/s with a commit per record: each one is flushed before the
+    next is queued, so no transaction ever holds more than one
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        writer = sqlite3_collector_backend.DBWriter(
+            1, data_dir=scratch if on_disk else None
+        )
+        start = time.perf_counter()
+        for rec in records:
+            writer.acceptData(rec)
+            writer.flush()
+        rate = len(records) / (time.perf_counter() - start)
+        writer.close()
+    return rate
+
+
+def bench_batches(batch_sizes: list, nrecords: int, on_disk: bool = False):
+    """
+    records/s through acceptData and the writer thread for each batch
+    size, against a commit per record (row). 1 starts a commit as soon
+    as a record is queued, but the writer takes everything queued by
+    then, so it isn't a commit per record once writes fall behind.
+    on_disk writes partition files to a scratch directory.
+    """
+    records = [sample_record(i) for i in range(nrecords)]
+    results = {"row": bench_per_row(records, on_disk)}
+    for size in batch_sizes:
+        with tempfile.TemporaryDirectory() as scratch:
+            # Room for every record, this measures writing, not turning away
+            writer = sqlite3_collector_backend.DBWriter(
+                size, data_dir=scratch if on_disk else None, queue_size=nrecords
+            )
+            start = time.perf_counter()
+            for rec in records:
+                writer.acceptData(rec)
+            writer.flush()
+            results[size] = nrecords / (time.perf_counter() - start)
+            writer.close()
+
+    print("{:>7} {:>12} {:>8}".format("batch", "records/s", "vs row"))
+    for size in ["row"] + batch_sizes:
+        rate = results[size]
+        print("{:>7} {:>12.1f} {:>7.1f}x".format(size, rate, rate / results["row"]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collector backend ingest benchmark")
+    parser.add_argument("--batch", default="1,10,100,1000")
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument(
+        "--disk", action="store_true", help="write partition files, not :memory:"
+    )
+    args = parser.parse_args()
+
+    bench_batches([int(b) for b in args.batch.split(",")], args.records, args.disk)
@@ -0,0 +1,623 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import gzip
+import json
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import http_collector_endpoint
+import mock_emitters
+import sqlite3_collector_backend
+import udp_collector_listener
+
+"""
+Behavior of the collector: the endpoint runs in process on a free port
+with its own writer, nothing outside this script is needed.
+"""
+
+
+def start_endpoint(writer) -> tuple:
+    """(server, base url) serving writer from a thread, shutdown() stops it"""
+    srv = http_collector_endpoint.CollectorServer(
+        ("127.0.0.1", 0), http_collector_endpoint.StdoutEndpoint
+    )
+    state = http_collector_endpoint.EndpointState(writer)
+    http_collector_endpoint.StdoutEndpoint.singletonState = state
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, "http://127.0.0.1:{}".format(srv.server_address[1])
+
+
+def request(url: str, body: bytes = None, headers: dict = None) -> tuple:
+    """(status, json body) for a GET, or a POST if there's a body"""
+    req = urllib.request.Request(url, data=body, headers=headers or {})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def wait_for(writer, records: int, timeout: float = 5) -> dict:
+    """writer's stats once it has committed records, or the timeout passed"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = writer.stats()
+        if stats["records"] >= records:
+            return stats
+        time.sleep(0.02)
+    return writer.stats()
+
+
+def brute_buckets(samples: list, start: float, end: float, bucket_s: float):
+    """What DBWriter.query should answer for [(ts, value)], worked out in full"""
+    seen = set()
+    buckets = {}
+    for ts, val in samples:
+        # Repeats of a ts are ignored, the first one stays
+        if ts in seen:
+            continue
+        seen.add(ts)
+        if start <= ts < end:
+            buckets.setdefault(int(ts / bucket_s), []).append((ts, val))
+    out = []
+    for b in sorted(buckets):
+        got = buckets[b]
+        nums = [v for _, v in got if not isinstance(v, str)]
+        out.append(
+            (
+                round(b * bucket_s, 3),
+                len(got),
+                min(nums, default=None),
+                max(nums, default=None),
+                sum(nums) / len(nums) if nums else None,
+                max(got)[1],
+            )
+        )
+    return out
+
+
+def same_buckets(got: list, expected: list) -> bool:
+    if len(got) != len(expected):
+        return False
+    for row, want in zip(got, expected):
+        for a, b in zip(row, want):
+            if isinstance(b, (int, float)) and not isinstance(b, bool):
+                if a is None or abs(a - b) > 1e-6 * max(1, abs(b)):
+                    return False
+            elif a != b:
+                return False
+    return True
+
+
+def test_bulk_ingest():
+    writer = sqlite3_collector_backend.DBWriter(batch_ms=20)
+    srv, url = start_endpoint(writer)
+    try:
+        now = time.time()
+        recs = [
+            {"uuid": "bulk-1", "ts": now - i, "psi": 90 + i, "state": "on"}
+            for i in range(50)
+        ]
+        ndjson = "\n".join(json.dumps(r) for r in recs).encode()
+        status, resp = request(url + "/ingest", ndjson)
+        assert (status, resp) == (200, {"recorded": 50}), resp
+
+        # One array, gzipped
+        recs = [{"uuid": "bulk-2", "ts": now - i, "psi": i} for i in range(30)]
+        body = gzip.compress(json.dumps(recs).encode())
+        status, resp = request(url + "/ingest", body, {"Content-Encoding": "gzip"})
+        assert (status, resp) == (200, {"recorded": 30}), resp
+        stats = wait_for(writer, 80)
+        assert stats["devices"]["bulk-2"]["records"] == 30
+
+        # One malformed record fails the body, none of it is queued
+        bad = [
+            '{"uuid": "bulk-3", "psi": 1}\n{"uuid": "bulk-3", "psi": ',
+            '{"uuid": ["x"], "psi": 1}',
+            '{"uuid": "bulk-3", "psi": 1}\n{"uuid": "bulk-3", "psi": [1]}',
+            '{"uuid": "bulk-3", "ts": "soon", "psi": 1}',
+            '{"uuid": "bulk-3", "ts": 1e20, "psi": 1}',
+            '[{"uuid": "bulk-3", "psi": 1}',
+            "[1, 2]",
+        ]
+        for body in bad:
+            status, resp = request(url + "/ingest", body.encode())
+            assert status == 400 and "error" in resp, (body, resp)
+        status, resp = request(
+            url + "/ingest", b"not gzip", {"Content-Encoding": "gzip"}
+        )
+        assert status == 400, resp
+        time.sleep(0.1)
+        stats = writer.stats()
+        assert "bulk-3" not in stats["devices"]
+        assert stats["records"] == 80 and stats["failed"] == 0
+
+        # GETs still work alongside, a bad ts is a 400 there too
+        assert request(url + "/?uuid=get-1&psi=7")[0] == 200
+        assert request(url + "/?uuid=get-1&psi=7&ts=nan")[0] == 400
+        assert wait_for(writer, 81)["devices"]["get-1"]["records"] == 1
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        writer.close()
+
+
+def test_udp_parsing():
+    rec = udp_collector_listener.parse_datagram(b"v1 uuid=a1&a0=512&ts=1700000000.5")
+    assert rec == {"uuid": "a1", "a0": "512", "ts": "1700000000.5"}
+    for data in [
+        b"v2 uuid=a1&a0=512",
+        b"uuid=a1&a0=512",
+        b"v1 ",
+        b"v1 uuid=a1&ts=nan&a0=1",
+        b"v1 uuid=a1&ts=inf&a0=1",
+        b"v1 uuid=a1&ts=later&a0=1",
+        b"v1 uuid=\xff\xfe&a0=1",
+    ]:
+        try:
+            udp_collector_listener.parse_datagram(data)
+        except ValueError:
+            continue
+        assert False, data
+
+    writer = sqlite3_collector_backend.DBWriter(batch_ms=20)
+    listener = udp_collector_listener.UDPListener(writer, "127.0.0.1", 0)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        bad = [
+            b"v1 uuid=u1&ts=nan&a0=1",
+            b"v1 uuid=u1&ts=1e20&a0=1",
+            b"v1 uuid=u1&ts=-5&a0=1",
+            b"v1 uuid=\xff&a0=1",
+            b"v9 uuid=u1&a0=1",
+        ]
+        good = [
+            b"v1 uuid=u1&a0=512",
+            b"v1 uuid=u1&a0=513&ts=%.3f" % (time.time() - 60),
+        ]
+        for data in bad + good:
+            sock.sendto(data, ("127.0.0.1", listener.port))
+        stats = wait_for(writer, 2)
+        assert stats["devices"]["u1"]["records"] == 2, stats
+        udp = listener.stats()
+        assert (udp["received"], udp["malformed"]) == (7, 5), udp
+
+        # Still listening after all of that
+        sock.sendto(b"v1 uuid=u2&a0=1", ("127.0.0.1", listener.port))
+        assert wait_for(writer, 3)["devices"]["u2"]["records"] == 1
+        assert listener.thread.is_alive()
+    finally:
+        sock.close()
+        listener.close()
+        writer.close()
+
+
+def test_udp_emitter():
+    writer = sqlite3_collector_backend.DBWriter(
+        batch_size=100, batch_ms=60000, queue_size=2
+    )
+    listener = udp_collector_listener.UDPListener(writer, "127.0.0.1", 0)
+    try:
+        # The mock emitters' datagram path lands in the same backend
+        tool = mock_emitters.AirCompressor("127.0.0.1", 0)
+        tool.uuid = "comp-udp"
+        tool.udp_port = listener.port
+        assert tool.send_datagram()["sent"] > 0
+        deadline = time.time() + 5
+        while writer.stats()["pending"] < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        writer.flush()
+        now = time.time()
+        rows = list(writer.query("comp-udp", "psi", now - 60, now + 1, 60))
+        assert sum(row[1] for row in rows) == 1 and rows[-1][5] == 90, rows
+
+        # With the write queue full a datagram is counted as dropped
+        writer.acceptBatch([{"uuid": "fill"}, {"uuid": "fill"}])
+        tool.send_datagram()
+        deadline = time.time() + 5
+        while listener.stats()["dropped"] < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        udp = listener.stats()
+        assert (udp["received"], udp["malformed"], udp["dropped"]) == (2, 0, 1), udp
+        assert writer.stats()["dropped"] == 1
+    finally:
+        listener.close()
+        writer.close()
+
+
+def test_partitions():
+    span = 2
+    with tempfile.TemporaryDirectory() as scratch:
+        writer = sqlite3_collector_backend.DBWriter(
+            batch_ms=20, data_dir=scratch, partition_s=span, retain=3
+        )
+        # Start right after a boundary so the span can't end mid-test
+        time.sleep(span - time.time() % span + 0.05)
+        now = time.time()
+        current = writer.partition_start(now)
+        # The two spans before this one, within what retain keeps
+        writer.acceptBatch(
+            [{"uuid": "p", "ts": current - span * k + 0.5, "v": k} for k in (1, 2)]
+        )
+        # Anything older, or too far ahead, is turned away
+        for ts in (current - span * 3, now + 2 * 86400, 1e12):
+            try:
+                writer.acceptBatch([{"uuid": "p", "ts": ts, "v": 0}])
+            except ValueError:
+                continue
+            assert False, ts
+        # A fast clock, a few spans ahead, gets a partition of its own
+        writer.acceptBatch([{"uuid": "p", "ts": current + span * 5, "v": 5}])
+        writer.flush()
+        starts = [start for start, _ in writer.partitions()]
+        assert starts == [
+            current - 2 * span,
+            current - span,
+            current,
+            current + 5 * span,
+        ]
+
+        # Crossing into the next span rotates, the oldest partitions go but
+        # never the one for now
+        time.sleep(current + span - time.time() + 0.05)
+        writer.acceptData({"uuid": "p", "v": "3"})
+        writer.flush()
+        starts = [start for start, _ in writer.partitions()]
+        assert writer.partition == current + span
+        assert current + span in starts and len(starts) == 3, starts
+        assert starts[-1] == current + 5 * span
+        writer.close()
+
+        # A new writer picks up what's on disk
+        writer = sqlite3_collector_backend.DBWriter(data_dir=scratch, partition_s=span)
+        assert writer.stats()["devices"]["p"]["records"] >= 2
+        writer.close()
+
+
+def test_partition_files():
+    span = 100
+    with tempfile.TemporaryDirectory() as scratch:
+        writer = sqlite3_collector_backend.DBWriter(data_dir=scratch, partition_s=span)
+        now = time.time()
+        current = writer.partition_start(now)
+        writer.acceptBatch(
+            [{"uuid": "f", "ts": now - span * k, "v": k} for k in range(4)]
+        )
+        writer.flush()
+        parts = writer.partitions()
+        assert [start for start, _ in parts] == [
+            current - span * k for k in (3, 2, 1, 0)
+        ]
+        for _, path in parts:
+            conn = sqlite3.connect(path)
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+            conn.close()
+            assert mode == "wal", (path, mode)
+
+        # A range only opens the partitions it overlaps
+        assert writer.overlapping(current - span * 1.5, current - span) == [parts[1][1]]
+        got = writer.query("f", "v", now - span * 3.5, now + 1, span)
+        assert sum(row[1] for row in got) == 4
+
+        # Dropping old data is unlinking its files, the rest still answers
+        dropped = writer.drop_partitions(current - span)
+        assert dropped == [path for _, path in parts[:2]], dropped
+        for path in dropped:
+            assert not os.path.exists(path) and not os.path.exists(path + "-wal")
+        got = writer.query("f", "v", now - span * 3.5, now + 1, span)
+        assert sum(row[1] for row in got) == 2
+        writer.close()
+
+
+def test_bad_record_survival():
+    for on_disk in (False, True):
+        with tempfile.TemporaryDirectory() as scratch:
+            writer = sqlite3_collector_backend.DBWriter(
+                batch_ms=20, data_dir=scratch if on_disk else None
+            )
+            now = time.time()
+            good = writer.to_record({"uuid": "ok", "x": "1"}, now)
+            # What to_record would turn away, queued behind its back
+            bad = (now, {"not": "a name"}, None, None, {"x": 1})
+            writer.enqueue([good, bad, writer.to_record({"uuid": "ok2"}, now)])
+            # Waits out the writer thread if it took the batch first
+            writer.flush()
+            stats = writer.stats()
+            assert (stats["records"], stats["failed"]) == (2, 1), stats
+            assert writer.flusher.is_alive()
+
+            writer.acceptData({"uuid": "after", "x": "2"})
+            stats = wait_for(writer, 3)
+            assert stats["records"] == 3 and "after" in stats["devices"]
+            writer.close()
+
+
+def test_backpressure():
+    # The writer won't drain by itself here, only flush() empties the queue
+    writer = sqlite3_collector_backend.DBWriter(
+        batch_size=100, batch_ms=60000, queue_size=4
+    )
+    srv, url = start_endpoint(writer)
+    try:
+        # Requests are taken side by side, none waits on the database
+        codes = []
+        threads = [
+            threading.Thread(
+                target=lambda i: codes.append(
+                    request(url + "/?uuid=bp{}&v=1".format(i))[0]
+                ),
+                args=(i,),
+            )
+            for i in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert codes == [200] * 4, codes
+
+        # Full, the next emitter is told when to come back
+        try:
+            urllib.request.urlopen(url + "/?uuid=bp9&v=1")
+            assert False, "queued past queue_size"
+        except urllib.error.HTTPError as e:
+            assert e.code == 503 and e.headers["Retry-After"] == str(
+                http_collector_endpoint.RETRY_AFTER_S
+            )
+            assert json.loads(e.read())["pending"] == 4
+        status, resp = request(url + "/ingest", b'{"uuid": "bp9", "v": 1}')
+        assert status == 503, resp
+        status, stats = request(url + "/stats")
+        assert status == 200, stats
+        assert (stats["pending"], stats["queue_size"], stats["dropped"]) == (4, 4, 2)
+
+        writer.flush()
+        assert request(url + "/?uuid=bp9&v=1")[0] == 200
+        writer.flush()
+        stats = writer.stats()
+        assert (stats["records"], stats["pending"], stats["dropped"]) == (5, 0, 2)
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        writer.close()
+
+
+def test_query_endpoint():
+    base = 1700000000
+    writer = sqlite3_collector_backend.DBWriter(queue_size=100000)
+    srv, url = start_endpoint(writer)
+    try:
+        recs = [
+            {
+                "uuid": "raw",
+                "ts": base + i / 2,
+                "psi": "off" if i % 13 == 0 else (i * 7) % 100,
+            }
+            for i in range(3000)
+        ]
+        writer.acceptBatch(recs)
+        writer.flush()
+        samples = [(r["ts"], r["psi"]) for r in recs]
+
+        # Every aggregate by default, straight from the samples, more
+        # points than go in one write of the response
+        start, end = base + 0.25, base + 1400.75
+        qry = "/query?device=raw&metric=psi&from={}&to={}&bucket=0.5"
+        with urllib.request.urlopen(url + qry.format(start, end)) as resp:
+            assert resp.headers["Content-Length"] is None
+            body = json.loads(resp.read())
+        assert (body["resolution"], body["bucket"]) == (0, 0.5)
+        expected = brute_buckets(samples, start, end, 0.5)
+        assert len(expected) > http_collector_endpoint.POINTS_PER_WRITE
+        got = [
+            (p["t"], p["count"], p["min"], p["max"], p["avg"], p["last"])
+            for p in body["points"]
+        ]
+        assert same_buckets(got, expected)
+
+        # Wider buckets, only the aggregates asked for
+        qry = "/query?device=raw&metric=psi&from={}&to={}&bucket=7&agg=max,last"
+        status, resp = request(url + qry.format(base, base + 1500))
+        assert status == 200, resp
+        expected = brute_buckets(samples, base, base + 1500, 7)
+        assert [set(p) for p in resp["points"]] == [{"t", "max", "last"}] * len(
+            expected
+        )
+        assert [(p["t"], p["max"], p["last"]) for p in resp["points"]] == [
+            (row[0], row[3], row[5]) for row in expected
+        ]
+
+        # Nothing there is no points, not an error
+        status, resp = request(url + "/query?device=nobody&metric=psi")
+        assert status == 200 and resp["points"] == [], resp
+
+        # Arguments are checked before anything is sent
+        for qry in [
+            "/query?metric=psi",
+            "/query?device=raw",
+            "/query?device=raw&metric=psi&from=10&to=5",
+            "/query?device=raw&metric=psi&from=0&to=1e9&bucket=1",
+            "/query?device=raw&metric=psi&bucket=0",
+            "/query?device=raw&metric=psi&bucket=soon",
+            "/query?device=raw&metric=psi&agg=median",
+        ]:
+            status, resp = request(url + qry)
+            assert status == 400 and "error" in resp, (qry, resp)
+
+        # A range scan of the primary key, never the whole table
+        conn = sqlite3.connect(writer.memname, uri=True)
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN " + sqlite3_collector_backend.BUCKET_QUERY,
+            (1, 1, base, base + 1, 1),
+        ).fetchall()
+        conn.close()
+        assert not [row for row in plan if row[3].startswith("SCAN Sample")], plan
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        writer.close()
+
+
+def test_rollup_upserts():
+    # On the hour, so on a bucket of every rollup
+    base = 1699999200
+    with tempfile.TemporaryDirectory() as scratch:
+        for data_dir in (None, scratch):
+            writer = sqlite3_collector_backend.DBWriter(data_dir=data_dir)
+            if data_dir is None:
+                source = writer.memname
+            else:
+                path = writer.partition_path(writer.partition_start(base))
+                source = "file:{}?mode=ro".format(path)
+
+            def rollup(res: int, bucket: int) -> tuple:
+                """(n, n_num, lo, hi, total, last_ts, last_value) of a bucket"""
+                conn = sqlite3.connect(source, uri=True)
+                try:
+                    return conn.execute(
+                        "SELECT n, n_num, lo, hi, total, last_ts, last_value"
+                        " FROM Rollup WHERE res = ? AND bucket = ?",
+                        (res, bucket),
+                    ).fetchone()
+                finally:
+                    conn.close()
+
+            writer.acceptBatch(
+                [{"uuid": "r", "ts": base + 60 + i, "psi": 10 + i} for i in range(30)]
+            )
+            writer.flush()
+            assert rollup(60, base + 60) == (30, 30, 10, 39, 735, base + 89, 39)
+            assert rollup(1, base + 75) == (1, 1, 25, 25, 25, base + 75, 25)
+            assert rollup(3600, base)[:5] == (30, 30, 10, 39, 735)
+
+            # Late data upserts the buckets it lands in, older than their
+            # last it leaves last alone, a repeat of a ts changes nothing
+            writer.acceptBatch(
+                [
+                    {"uuid": "r", "ts": base + 60.5, "psi": 2},
+                    {"uuid": "r", "ts": base + 61, "psi": 99},
+                    {"uuid": "r", "ts": base + 119.5, "psi": "off"},
+                ]
+            )
+            writer.flush()
+            assert rollup(60, base + 60) == (32, 31, 2, 39, 737, base + 119.5, "off")
+            assert rollup(1, base + 60) == (2, 2, 2, 10, 12, base + 60.5, 2)
+            assert rollup(1, base + 61) == (1, 1, 11, 11, 11, base + 61, 11)
+            assert rollup(3600, base)[:5] == (32, 31, 2, 39, 737)
+
+            # What query() reads from them matches the samples
+            samples = [(base + 60 + i, 10 + i) for i in range(30)]
+            samples += [(base + 60.5, 2), (base + 119.5, "off")]
+            for bucket_s in (1, 60, 3600):
+                res = writer.resolution(bucket_s)
+                assert res == bucket_s, (bucket_s, res)
+                got = list(writer.query("r", "psi", base, base + 3600, bucket_s))
+                assert same_buckets(
+                    got, brute_buckets(samples, base, base + 3600, bucket_s)
+                )
+            writer.close()
+
+
+def test_query_rollups():
+    random.seed(7)
+    base = 1700000000
+    with tempfile.TemporaryDirectory() as scratch:
+        for data_dir in (None, scratch):
+            writer = sqlite3_collector_backend.DBWriter(
+                data_dir=data_dir, partition_s=1000, queue_size=100000
+            )
+            recs = []
+            for i in range(20000):
+                ts = round(base + random.uniform(0, 5 * 3600), 3)
+                val = random.randint(0, 1000) / 10 if i % 11 else "off"
+                recs.append({"uuid": "q{}".format(i % 2), "ts": ts, "psi": val})
+            # Repeats of a reading are ignored, even with another value
+            repeats = [dict(r, psi=-1) for r in random.sample(recs, 300)]
+            # Out of order batches, every bucket gets late data
+            recs += repeats
+            random.shuffle(recs)
+            samples = [(r["ts"], r["psi"]) for r in recs if r["uuid"] == "q0"]
+            for i in range(0, len(recs), 500):
+                writer.acceptBatch(recs[i : i + 500])
+                writer.flush()
+
+            ranges = [
+                (base, base + 5 * 3600),
+                (base + 1234.567, base + 3 * 3600 + 17.25),
+                (base + 59.5, base + 61.2),
+            ]
+            for bucket_s in (0.5, 1, 7, 60, 90, 900, 3600, 7200):
+                for start, end in ranges:
+                    got = list(writer.query("q0", "psi", start, end, bucket_s))
+                    expected = brute_buckets(samples, start, end, bucket_s)
+                    assert same_buckets(got, expected), (bucket_s, start, end)
+            assert [writer.resolution(b) for b in (0.5, 1, 90, 120, 7200)] == [
+                0,
+                1,
+                1,
+                60,
+                3600,
+            ]
+            writer.close()
+
+    # Through the endpoint, a week at an hour per point comes from the rollup
+    writer = sqlite3_collector_backend.DBWriter(queue_size=100000)
+    srv, url = start_endpoint(writer)
+    try:
+        recs = [
+            {"uuid": "comp", "ts": base + i * 60, "psi": 80 + i % 20}
+            for i in range(7 * 1440)
+        ]
+        writer.acceptBatch(recs)
+        writer.flush()
+        qry = "/query?device=comp&metric=psi&from={}&to={}&bucket=3600&agg=count,avg"
+        status, resp = request(url + qry.format(base, base + 7 * 86400))
+        assert status == 200 and resp["resolution"] == 3600, resp
+        expected = brute_buckets(
+            [(r["ts"], r["psi"]) for r in recs], base, base + 7 * 86400, 3600
+        )
+        assert len(resp["points"]) == len(expected)
+        for point, row in zip(resp["points"], expected):
+            assert (point["t"], point["count"]) == row[:2]
+            assert abs(point["avg"] - row[4]) < 1e-9
+        assert request(url + "/query?device=comp&metric=psi&agg=median")[0] == 400
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        writer.close()
+
+
+if __name__ == "__main__":
+    test_bulk_ingest()
+    test_udp_parsing()
+    test_udp_emitter()
+    test_partitions()
+    test_partition_files()
+    test_bad_record_survival()
+    test_backpressure()
+    test_query_endpoint()
+    test_rollup_upserts()
+    test_query_rollups()
+
+    print("Got here without breaking an assert - PASS")
@@ -14,33 +14,148 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import codecs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
 import json
 from os import getenv
+import time
 import uuid
 import urllib.parse
 import urllib.request
+import zlib
 
 import sqlite3_collector_backend
+import udp_collector_listener
+
+"Seconds a turned away emitter is told to wait before sending again"
+RETRY_AFTER_S = 1
+
+"Bytes of a bulk body read, or inflated, at a time"
+READ_CHUNK = 65536
+
+"Longest one record in a bulk body may be, bounds what's buffered"
+MAX_RECORD_BYTES = 65536
+
+"/query range when from isn't given, an hour before to"
+DEFAULT_QUERY_S = 3600
+
+"Buckets a /query range is cut into when bucket isn't given"
+DEFAULT_POINTS = 300
+
+"Most buckets one /query may ask for"
+MAX_POINTS = 100000
+
+"What /query can report per bucket, and where it is in DBWriter.query rows"
+AGGREGATES = {"count": 1, "min": 2, "max": 3, "avg": 4, "last": 5}
+
+"Points serialized per write of a /query response"
+POINTS_PER_WRITE = 256
+
+"Between records in a bulk body, newline delimited or in an array"
+SEPARATORS = " \t\r\n,"
+
+
+def body_chunks(stream, length: int, gzipped: bool):
+    """
+    Yield length bytes of request body a chunk at a time, inflated if
+    gzipped. Each inflated piece is at most READ_CHUNK, however well the
+    body compressed
+    """
+    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    while length > 0:
+        chunk = stream.read(min(length, READ_CHUNK))
+        if not chunk:
+            raise ValueError("body ended {} bytes short".format(length))
+        length -= len(chunk)
+        if inflate is None:
+            yield chunk
+            continue
+        yield inflate.decompress(chunk, READ_CHUNK)
+        while inflate.unconsumed_tail:
+            yield inflate.decompress(inflate.unconsumed_tail, READ_CHUNK)
+    if inflate is not None and not inflate.eof:
+        raise ValueError("gzip body is truncated")
+
+
+def read_records(chunks, limit: int) -> list:
+    """
+    JSON objects from body chunks, parsed as the chunks arrive so only the
+    record being parsed is buffered. Takes newline delimited objects or one
+    array of them. ValueError for anything else, or past limit records
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    records = []
+    buf = ""
+    # None until the first byte says NDJSON ("") or an array ("["), "]" once
+    # the array is closed
+    form = None
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buf += utf8.decode(b"" if final else chunk, final)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in SEPARATORS:
+                pos += 1
+            if pos == len(buf):
+                break
+            if form is None:
+                form = "[" if buf[pos] == "[" else ""
+                pos += len(form)
+                continue
+            if form == "]":
+                raise ValueError("data after the array")
+            if form == "[" and buf[pos] == "]":
+                form = "]"
+                pos += 1
+                continue
+            try:
+                rec, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Most likely the rest of it is in the next chunk
+                if final:
+                    raise
+                break
+            if not isinstance(rec, dict):
+                raise ValueError("records are JSON objects")
+            records.append(rec)
+            if len(records) > limit:
+                raise ValueError("over {} records".format(limit))
+        buf = buf[pos:]
+        if len(buf) > MAX_RECORD_BYTES:
+            raise ValueError("record over {} bytes".format(MAX_RECORD_BYTES))
+    if form == "[":
+        raise ValueError("array isn't closed")
+    return records
 
 
 class EndpointState:
     """Make sense of incoming GET requests, write them to the backend"""
 
-    __slots__ = "writer"
+    __slots__ = "writer", "listener"
 
-    def __init__(self, backend=None):
+    def __init__(self, backend=None, listener=None):
         if backend == None:
             self.writer = sqlite3_collector_backend.DBWriter()
         else:
             self.writer = backend
+        # UDP side feeding the same writer, if there is one
+        self.listener = listener
 
     def process_path(self, path: str) -> str:
         """
         Path expected to be of the form authority/?<query>, however handling
         <authority>/<topic>?<query> should be supported soon.
+        /stats answers the backend's ingest counters instead, and the UDP
+        listener's if there is one.
         Return json string response
         """
+        if urllib.parse.urlsplit(path).path == "/stats":
+            stats = self.writer.stats()
+            if self.listener is not None:
+                stats["udp"] = self.listener.stats()
+            return json.dumps(stats)
 
         # TODO: do this with urllib parser
         qry = path.split("?")[1]
@@ -53,39 +168,166 @@ class EndpointState:
 
         return self.recv_record(m)
 
+    def process_bulk(self, stream, length: int, gzipped: bool) -> str:
+        """
+        POST /ingest, many records in one body handed to the backend as one
+        batch. A record the backend can't store fails the whole body with
+        ValueError before any of it is queued. Return json string response
+        """
+        chunks = body_chunks(stream, length, gzipped)
+        records = read_records(chunks, self.writer.queue_size)
+        self.writer.acceptBatch(records)
+        return json.dumps({"recorded": len(records)})
+
+    def process_query(self, path: str):
+        """
+        /query?device=&metric=&from=&to=&bucket=&agg=, from and to in epoch
+        seconds, bucket in seconds, agg a comma list of AGGREGATES. The
+        arguments are checked right away, ValueError if they don't make
+        sense. Returns an iterator of json string pieces, produced as the
+        buckets are read
+        """
+        args = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+        device = args.get("device")
+        metric = args.get("metric")
+        if not device or not metric:
+            raise ValueError("device and metric are required")
+        end = float(args.get("to", time.time()))
+        start = float(args.get("from", end - DEFAULT_QUERY_S))
+        if end <= start:
+            raise ValueError("from must be before to")
+        bucket = float(args.get("bucket", (end - start) / DEFAULT_POINTS))
+        if not bucket > 0 or (end - start) / bucket > MAX_POINTS:
+            raise ValueError("bucket makes over {} points".format(MAX_POINTS))
+        aggs = args.get("agg", ",".join(AGGREGATES)).split(",")
+        for agg in aggs:
+            if agg not in AGGREGATES:
+                raise ValueError("agg is any of {}".format(",".join(AGGREGATES)))
+
+        rows = self.writer.query(device, metric, start, end, bucket)
+        head = {
+            "device": device,
+            "metric": metric,
+            "from": start,
+            "to": end,
+            "bucket": bucket,
+            "resolution": self.writer.resolution(bucket),
+        }
+        return self.stream_points(head, aggs, rows)
+
     def recv_record(self, recordcontents: dict) -> str:
         "Forward record derived from request to (storage) backend"
         self.writer.acceptData(recordcontents)
         return json.dumps({"recorded": True})
 
+    # not public interface
+    def stream_points(self, head: dict, aggs: list, rows):
+        """{**head, "points": [{"t", agg...}, ...]} a few points at a time"""
+        yield json.dumps(head)[:-1] + ', "points": ['
+        sep = ""
+        points = []
+        for row in rows:
+            point = {"t": row[0]}
+            for agg in aggs:
+                point[agg] = row[AGGREGATES[agg]]
+            points.append(json.dumps(point))
+            if len(points) == POINTS_PER_WRITE:
+                yield sep + ",".join(points)
+                sep = ","
+                points = []
+        yield (sep + ",".join(points) if points else "") + "]}"
+
+
+class CollectorServer(ThreadingHTTPServer):
+    """A thread per request, they only parse and queue"""
+
+    # socketserver's default listen backlog of 5 drops SYNs when a shop full
+    # of emitters reports at once, they'd sit out 1s+ retransmit timeouts
+    request_queue_size = 128
+
 
 class StdoutEndpoint(BaseHTTPRequestHandler):
     singletonState = None
 
     def do_GET(self) -> None:
         """Handle a GET request from a sensing node"""
+        # Shared by the handler threads, the writer does its own locking
+        s = StdoutEndpoint.singletonState
+        if urllib.parse.urlsplit(self.path).path == "/query":
+            self.stream(lambda: s.process_query(self.path))
+            return
+        self.answer(lambda: s.process_path(self.path))
 
-        def send_header(code: int) -> None:
-            """Send http response header, common to all return paths"""
-            self.send_response(code)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-
-        # Get away with this because the server is single threaded
+    def do_POST(self) -> None:
+        """Handle a bulk POST from an emitter that combines its samples"""
         s = StdoutEndpoint.singletonState
+        if urllib.parse.urlsplit(self.path).path != "/ingest":
+            self.send_json(404, {"error": "bulk records go to /ingest"})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_json(411, {"error": "Content-Length required"})
+            return
+        encoding = self.headers.get("Content-Encoding", "identity").lower()
+        if encoding not in ("identity", "gzip"):
+            self.send_json(415, {"error": "gzip or no Content-Encoding"})
+            return
+        gzipped = encoding == "gzip"
+        self.answer(lambda: s.process_bulk(self.rfile, int(length), gzipped))
+
+    # not public interface
+    def answer(self, process) -> None:
+        """Run process() for the json response, map failures to a status"""
         try:
-            res = s.process_path(self.path)
+            res = process()
+        except sqlite3_collector_backend.QueueFullError as e:
+            # Writes are behind, turn the emitter away rather than queue more
+            err = {"error": "ingest queue full", "pending": e.depth}
+            self.send_json(503, err, RETRY_AFTER_S)
+            return
         except Exception as e:
             # todo: 400 vs 404 etc
             print("Exception in processing {}\n{}".format(self.path, str(e)))
-            send_header(400)
-            b = bytes("", "utf-8")
-            self.wfile.write(b)
+            self.send_json(400, {"error": str(e)})
+            return
+
+        # Report success
+        self.send_json(200, res)
+
+    def stream(self, process) -> None:
+        """
+        Send the json string pieces from process() as they come, without a
+        Content-Length, the connection closing ends the body
+        """
+        try:
+            pieces = process()
+        except Exception as e:
+            print("Exception in processing {}\n{}".format(self.path, str(e)))
+            self.send_json(400, {"error": str(e)})
             return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for piece in pieces:
+                self.wfile.write(bytes(piece, "utf-8"))
+        except Exception as e:
+            # Too late for a status, a cut off body is the best left to do
+            print("Exception streaming {}\n{}".format(self.path, str(e)))
+        self.close_connection = True
 
-        # Report success, needs content-length
-        send_header(200)
-        b = bytes(res, "utf-8")
+    def send_json(self, code: int, body, retry_after: int = None) -> None:
+        """Send a response, body is a json string or something to dump"""
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        b = bytes(body, "utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(b)))
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
         self.wfile.write(b)
 
 
@@ -94,8 +336,34 @@ if __name__ == "__main__":
     HOST = getenv("EP_HOST", default="0.0.0.0")
     PORT = int(getenv("EP_PORT", 9050))
 
-    srv = HTTPServer((HOST, PORT), StdoutEndpoint)
-    StdoutEndpoint.singletonState = EndpointState()
+    # Records per insert transaction, and longest one may wait for the rest
+    BATCH_SIZE = int(
+        getenv("EP_BATCH_SIZE", sqlite3_collector_backend.DEFAULT_BATCH_SIZE)
+    )
+    BATCH_MS = int(getenv("EP_BATCH_MS", sqlite3_collector_backend.DEFAULT_BATCH_MS))
+
+    # Keep data in partition files here, in memory only if unset
+    DATA_DIR = getenv("EP_DATA_DIR", "") or None
+    PARTITION_S = int(
+        getenv("EP_PARTITION_S", sqlite3_collector_backend.DEFAULT_PARTITION_S)
+    )
+    # Newest partitions kept on disk, 0 for all of them
+    RETAIN = int(getenv("EP_RETAIN_PARTITIONS", 0))
+    # Records waiting on the writer before requests get 503
+    QUEUE_SIZE = int(
+        getenv("EP_QUEUE_SIZE", sqlite3_collector_backend.DEFAULT_QUEUE_SIZE)
+    )
+    # Also take datagram records on this port, off if unset
+    UDP_PORT = getenv("EP_UDP_PORT", "")
+
+    srv = CollectorServer((HOST, PORT), StdoutEndpoint)
+    writer = sqlite3_collector_backend.DBWriter(
+        BATCH_SIZE, BATCH_MS, DATA_DIR, PARTITION_S, RETAIN, QUEUE_SIZE
+    )
+    listener = None
+    if UDP_PORT:
+        listener = udp_collector_listener.UDPListener(writer, HOST, int(UDP_PORT))
+    StdoutEndpoint.singletonState = EndpointState(writer, listener)
 
     # Start listening
     try:
@@ -103,3 +371,8 @@ if __name__ == "__main__":
         print("Endpoint {}:{} started".format(HOST, PORT))
     except KeyboardInterrupt:
         srv.socket.close()
+    finally:
+        # Don't lose whatever is still buffered
+        if listener is not None:
+            listener.close()
+        writer.close()
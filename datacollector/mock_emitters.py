@@ -10,6 +10,7 @@ import urllib.request
 import urllib.error
 import urllib.parse
 import os
+import socket
 
 
 class NetworkTimeout(BaseException):
@@ -36,6 +37,8 @@ class MockTelemetryEmitter:
         "protocol_ver",
         "endpoint_host",
         "endpoint_port",
+        "uuid",
+        "udp_port",
     )
 
     def __init__(self, host, port):
@@ -45,6 +48,10 @@ class MockTelemetryEmitter:
         self.firmware_ver = -1
         self.endpoint_host = host
         self.endpoint_port = port
+        # Tells apart devices of the same type, the collector keys on it
+        self.uuid = None
+        # Send datagrams to this port of endpoint_host instead of GETs
+        self.udp_port = None
 
     def get_uri_qry_pairs(self):
         cur = self.getcurrent()
@@ -54,6 +61,8 @@ class MockTelemetryEmitter:
             "protocol_ver={}".format(self.protocol_ver),
             "firmware_ver={}".format(self.firmware_ver),
         ]
+        if self.uuid is not None:
+            pairs.append("uuid={}".format(urllib.parse.quote_plus(self.uuid)))
 
         for name, met in cur.items():
             met = str(met)
@@ -80,11 +89,24 @@ class MockTelemetryEmitter:
         # Just a single line status flag
         return json.loads([line for line in res][0])
 
+    def send_datagram(self):
+        """
+        Send the same pairs as one v1 datagram, see udp_collector_listener.
+        Nothing comes back, delivery isn't known
+        """
+        data = bytes("v1 " + self.get_uri_qry_pairs(), "utf-8")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(data, (self.endpoint_host, int(self.udp_port)))
+        return {"sent": len(data)}
+
     def loop(self, interval_s: int):
         while MockTelemetryEmitter.runLoop:
             time.sleep(interval_s)
             try:
-                resp = self.send_get_req()
+                if self.udp_port is None:
+                    resp = self.send_get_req()
+                else:
+                    resp = self.send_datagram()
                 print("Got response: {}".format(json.dumps(resp)))
             except KeyboardInterrupt as e:
                 # Stop other thread loops
@@ -106,6 +128,7 @@ class SingleChannelSensor(MockTelemetryEmitter):
         self.device_model = "PythonMock"
         self.makevalue = lambda: 1.0
         self.guid = guid
+        self.uuid = guid
 
     def getcurrent(self):
         """Sample input and attach metadata including units"""
@@ -172,6 +195,8 @@ if __name__ == "__main__":
     # Override with env vars
     EP_HOST = os.environ.get("EP_HOST", "127.0.0.1")
     EP_PORT = os.environ.get("EP_PORT", 9050)
+    # Send datagrams to the collector's EP_UDP_PORT instead, if set
+    EP_UDP_PORT = os.environ.get("EP_UDP_PORT")
 
     # Make configurable later
     BROADCAST_INTERVAL = 5
@@ -192,6 +217,8 @@ if __name__ == "__main__":
 
     simple_sensors = make_some_sensors(50)
     tools = tools + simple_sensors
+    for tool in tools:
+        tool.udp_port = EP_UDP_PORT
 
     threads = []
     for tool in tools:
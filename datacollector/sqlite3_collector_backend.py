@@ -14,82 +14,916 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import json
+import calendar
+import itertools
+import math
+import os
+import re
 import sqlite3
+import threading
 import time
 import urllib.parse
+import uuid
 
+"Records buffered before they're written out in one transaction"
+DEFAULT_BATCH_SIZE = 100
 
-class DBWriter(object):
-    """Responsible for beating stream data kvset into something tabular"""
+"Longest a record sits in the buffer before it's written out anyway"
+DEFAULT_BATCH_MS = 200
+
+"Records waiting to be written before new ones are turned away"
+DEFAULT_QUEUE_SIZE = 10000
+
+"Seconds of data per partition file when writing to disk, a day"
+DEFAULT_PARTITION_S = 86400
+
+"Furthest ahead of now a sample's ts may be, for emitter clocks running fast"
+MAX_FUTURE_S = 86400
+
+"Partition files are named for the UTC start of the span they hold"
+PARTITION_NAME = "live-%Y%m%d-%H%M%S.db"
+PARTITION_RE = re.compile(r"^live-(\d{8}-\d{6})\.db$")
+
+"WAL lets readers run alongside the writer, NORMAL skips the fsync per commit"
+FILE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16384",
+)
+
+"Device and metric names live here, every partition shares its integer ids"
+CATALOG_NAME = "catalog.db"
+
+"Query params that describe the emitter, every other one is a metric"
+ENVELOPE_PARAMS = frozenset(
+    ["uuid", "device_type", "device_model", "protocol_ver", "firmware_ver", "ts"]
+)
+
+"Emitters are told apart by uuid, else by device_type, else they're this"
+UNKNOWN_DEVICE = "unknown"
+
+"Envelope params that are stored, they have to be strings"
+NAME_PARAMS = ("uuid", "device_type", "device_model")
+
+"""
+One row per metric per record. The primary key is the only index and the
+table is stored in it (WITHOUT ROWID), so reading one metric of one device
+over a time range is a single narrow range scan that never touches
+anything else. Numeric readings go in num_value, anything else in
+text_value. A second reading of the same metric in the same millisecond,
+e.g. from a retried bulk POST, is ignored so the rollups count it once.
+"""
+CREATE_SAMPLE = (
+    "CREATE TABLE IF NOT EXISTS Sample("
+    "  device_id integer NOT NULL, "
+    "  metric_id integer NOT NULL, "
+    "  ts numeric(10,3) NOT NULL, "
+    "  num_value real, "
+    "  text_value varchar, "
+    "  PRIMARY KEY (device_id, metric_id, ts)) WITHOUT ROWID"
+)
+
+CREATE_DEVICE = (
+    "CREATE TABLE IF NOT EXISTS Device("
+    "  id integer PRIMARY KEY, "
+    "  name varchar UNIQUE NOT NULL, "
+    "  device_type varchar, "
+    "  device_model varchar)"
+)
 
-    __slots__ = "dbconn"
+CREATE_METRIC = (
+    "CREATE TABLE IF NOT EXISTS Metric("
+    "  id integer PRIMARY KEY, "
+    "  name varchar UNIQUE NOT NULL)"
+)
+
+"""
+Rollup bucket widths in seconds, kept up to date as samples are written.
+Each is a multiple of the one before
+"""
+ROLLUP_RESOLUTIONS = (1, 60, 3600)
+
+"""
+count, sum, min, max and last of one metric of one device per res second
+bucket. Every partition file rolls up its own samples, so dropping the
+file drops them too. last_value is numeric or text, whatever the sample was
+"""
+CREATE_ROLLUP = (
+    "CREATE TABLE IF NOT EXISTS Rollup("
+    "  res integer NOT NULL, "
+    "  device_id integer NOT NULL, "
+    "  metric_id integer NOT NULL, "
+    "  bucket integer NOT NULL, "
+    "  n integer NOT NULL, "
+    "  n_num integer NOT NULL, "
+    "  lo real, "
+    "  hi real, "
+    "  total real, "
+    "  last_ts numeric(10,3) NOT NULL, "
+    "  last_value, "
+    "  PRIMARY KEY (res, device_id, metric_id, bucket)) WITHOUT ROWID"
+)
+
+"Where a batch is staged so sqlite can roll it up in one statement"
+CREATE_BATCH = (
+    "CREATE TEMP TABLE IF NOT EXISTS Batch("
+    "  device_id integer NOT NULL, "
+    "  metric_id integer NOT NULL, "
+    "  ts numeric(10,3) NOT NULL, "
+    "  num_value real, "
+    "  text_value varchar, "
+    "  PRIMARY KEY (device_id, metric_id, ts)) WITHOUT ROWID"
+)
+
+"Parameterized so values are never spliced into SQL"
+INSERT_BATCH = (
+    "INSERT OR IGNORE INTO Batch(device_id, metric_id, ts, num_value, text_value)"
+    " VALUES (?, ?, ?, ?, ?)"
+)
+
+"Samples already stored aren't new, they'd be counted twice"
+DROP_KNOWN = (
+    "DELETE FROM Batch WHERE EXISTS (SELECT 1 FROM Sample AS s"
+    " WHERE s.device_id = Batch.device_id AND s.metric_id = Batch.metric_id"
+    " AND s.ts = Batch.ts)"
+)
+
+INSERT_SAMPLES = (
+    "INSERT INTO Sample(device_id, metric_id, ts, num_value, text_value)"
+    " SELECT device_id, metric_id, ts, num_value, text_value FROM Batch"
+)
+
+"""
+Fold the samples in {source} into the ?1 second rollup. A bucket that
+already has a row, late data included, gets the new samples merged in
+"""
+MERGE_ROLLUP = (
+    "INSERT INTO Rollup(res, device_id, metric_id, bucket, n, n_num, lo, hi,"
+    "  total, last_ts, last_value)"
+    " SELECT ?1, device_id, metric_id, b, n, n_num, lo, hi, total, last_ts,"
+    "  (SELECT coalesce(num_value, text_value) FROM {source} AS s"
+    "   WHERE s.device_id = g.device_id AND s.metric_id = g.metric_id"
+    "   AND s.ts = g.last_ts)"
+    " FROM (SELECT device_id, metric_id, CAST(ts / ?1 AS INTEGER) * ?1 AS b,"
+    "   count(*) AS n, count(num_value) AS n_num, min(num_value) AS lo,"
+    "   max(num_value) AS hi, sum(num_value) AS total, max(ts) AS last_ts"
+    "   FROM {source} GROUP BY device_id, metric_id, b) AS g"
+    " WHERE true"
+    " ON CONFLICT(res, device_id, metric_id, bucket) DO UPDATE SET"
+    "  n = n + excluded.n,"
+    "  n_num = n_num + excluded.n_num,"
+    "  lo = coalesce(min(lo, excluded.lo), lo, excluded.lo),"
+    "  hi = coalesce(max(hi, excluded.hi), hi, excluded.hi),"
+    "  total = coalesce(total + excluded.total, total, excluded.total),"
+    "  last_value = CASE WHEN excluded.last_ts > last_ts"
+    "   THEN excluded.last_value ELSE last_value END,"
+    "  last_ts = max(last_ts, excluded.last_ts)"
+)
+ROLLUP_BATCH = MERGE_ROLLUP.format(source="Batch")
+ROLLUP_SAMPLES = MERGE_ROLLUP.format(source="Sample")
+
+"""
+One metric of one device per time bucket over [?3, ?4), a range scan of
+Sample's primary key. Sums, not averages, so a bucket split over two
+partition files adds up. last is a primary key lookup at the bucket's
+newest ts, numeric or not
+"""
+BUCKET_QUERY = (
+    "SELECT b, n, n_num, lo, hi, total, last_ts,"
+    "  (SELECT coalesce(num_value, text_value) FROM Sample"
+    "   WHERE device_id = ?1 AND metric_id = ?2 AND ts = g.last_ts)"
+    " FROM (SELECT CAST(ts / ?5 AS INTEGER) AS b, count(*) AS n,"
+    "   count(num_value) AS n_num, min(num_value) AS lo, max(num_value) AS hi,"
+    "   sum(num_value) AS total, max(ts) AS last_ts"
+    "   FROM Sample"
+    "   WHERE device_id = ?1 AND metric_id = ?2 AND ts >= ?3 AND ts < ?4"
+    "   GROUP BY b) AS g"
+    " ORDER BY b"
+)
+
+"""
+BUCKET_QUERY's rows from the ?6 second rollup, for buckets a multiple of
+it over [?3, ?4), both on ?6 second boundaries
+"""
+ROLLUP_QUERY = (
+    "SELECT b, n, n_num, lo, hi, total, last_ts,"
+    "  (SELECT last_value FROM Rollup WHERE res = ?6 AND device_id = ?1"
+    "   AND metric_id = ?2 AND bucket = CAST(g.last_ts / ?6 AS INTEGER) * ?6)"
+    " FROM (SELECT CAST(bucket / ?5 AS INTEGER) AS b, sum(n) AS n,"
+    "   sum(n_num) AS n_num, min(lo) AS lo, max(hi) AS hi, sum(total) AS total,"
+    "   max(last_ts) AS last_ts"
+    "   FROM Rollup"
+    "   WHERE res = ?6 AND device_id = ?1 AND metric_id = ?2"
+    "   AND bucket >= ?3 AND bucket < ?4"
+    "   GROUP BY b) AS g"
+    " ORDER BY b"
+)
+
+
+def split_value(val) -> tuple:
+    """
+    (num_value, text_value) for a reading, one of them None. Query params
+    are always strings, bulk JSON records may also hold numbers, see
+    check_value. A string like "nan" stays text, sqlite can't store it
+    """
+    if isinstance(val, str):
+        try:
+            num = float(val)
+        except ValueError:
+            return None, val
+        return (num, None) if math.isfinite(num) else (None, val)
+    return float(val), None
+
+
+def parse_ts(ts) -> float:
+    """
+    Sample time in epoch seconds from a ts param or field, a number or a
+    numeric string. ValueError if it's neither or isn't finite
+    """
+    if isinstance(ts, str):
+        try:
+            ts = float(ts)
+        except ValueError:
+            raise ValueError("ts must be a number")
+    elif isinstance(ts, bool) or not isinstance(ts, (int, float)):
+        raise ValueError("ts must be a number")
+    if not math.isfinite(ts):
+        raise ValueError("ts must be finite")
+    return float(ts)
+
+
+def check_value(name: str, val):
+    """ValueError unless val is a string or a finite number split_value takes"""
+    if isinstance(val, str):
+        return
+    if isinstance(val, (int, float)):
+        try:
+            if math.isfinite(float(val)):
+                return
+        except OverflowError:
+            pass
+    raise ValueError("{} must be a string or a finite number".format(name))
+
+
+def merge_buckets(a: tuple, b: tuple) -> tuple:
+    """One BUCKET_QUERY row from two for the same bucket, b the newer"""
+    numeric = [row for row in (a, b) if row[2]]
+    return (
+        a[0],
+        a[1] + b[1],
+        a[2] + b[2],
+        min((row[3] for row in numeric), default=None),
+        max((row[4] for row in numeric), default=None),
+        sum(row[5] for row in numeric) if numeric else None,
+        b[6],
+        b[7],
+    )
+
+
+def finish_bucket(row: tuple, bucket_s: float) -> tuple:
+    """(bucket start, count, min, max, avg, last) from a BUCKET_QUERY row"""
+    b, n, n_num, lo, hi, total, _, last = row
+    avg = total / n_num if n_num else None
+    return (round(b * bucket_s, 3), n, lo, hi, avg, last)
+
+
+class QueueFullError(BaseException):
+    """The write queue had no room, the records offered were dropped"""
+
+    __slots__ = "depth"
+
+    def __init__(self, depth: int):
+        self.depth = depth
+
+    def __repr__(self):
+        return "QueueFullError: {} records waiting".format(self.depth)
+
+
+class IngestStats(object):
+    """Running record count and first/last accept_time for some records"""
+
+    __slots__ = "records", "first", "last"
 
     def __init__(self):
-        # Set up a DB with emphemeral storage
-        self.dbconn = sqlite3.connect(":memory:")
-
-        # DML to make fact table. Since this is using memory it may assume the table
-        # does not already exist.
-        dml = "CREATE TABLE Live("
-        dml += "  accept_time numeric(10,3), "
-        dml += "  topic varchar, "
-        dml += "  device_id varchar, "
-        dml += "  device_type varchar, "
-        dml += "  freemem int, "
-        dml += "  data varchar);"
-
-        self.dbconn.execute(dml)
-        self.dbconn.commit()
+        self.records = 0
+        self.first = None
+        self.last = None
+
+    def add(self, count: int, first: float, last: float):
+        self.records += count
+        if self.first is None or first < self.first:
+            self.first = first
+        if self.last is None or last > self.last:
+            self.last = last
+
+    def asdict(self) -> dict:
+        return {"records": self.records, "first": self.first, "last": self.last}
+
+
+class DBWriter(object):
+    """Responsible for beating stream data kvset into something tabular
+
+    Each record is stored as one Sample row per metric. Device and metric
+    names are replaced by integer ids from the Device/Metric tables, the
+    name to id maps are cached so only a new name costs a lookup.
+
+    acceptData only queues a record, it never waits on the database. One
+    writer thread drains the queue with one executemany per transaction
+    once batch_size records are waiting or the oldest has waited batch_ms,
+    whichever comes first, taking everything queued by then so batches
+    grow when writes fall behind. At most queue_size records wait, past
+    that acceptData raises QueueFullError and the record is dropped rather
+    than letting the backlog grow. acceptBatch queues many records at
+    once, for emitters that combine samples and send their own sample
+    times. flush() writes out whatever is queued from the calling thread,
+    close() flushes and closes the database.
+
+    Counts and first/last times, overall and per device, are kept up to
+    date as batches are committed, so stats() never touches the table.
+
+    Without data_dir the tables live in memory and are gone on restart.
+    With it, samples go to one WAL mode database file per partition_s of
+    sample time (a day by default) under data_dir, a new file is started
+    when the clock reaches the next span. A ts more than MAX_FUTURE_S
+    ahead, or older than retain keeps, is turned away. Device and Metric
+    are kept in their own catalog.db alongside. Dropping old data is
+    unlinking files, drop_partitions() does that and retain keeps only
+    the newest that many on each rotation. query() only reads the
+    partitions a time range needs.
+    """
+
+    __slots__ = (
+        "dbconn",
+        "batch_size",
+        "batch_ms",
+        "pending",
+        "oldest",
+        "queue_size",
+        "dropped",
+        "failed",
+        "lock",
+        "ready",
+        "writing",
+        "stopping",
+        "flusher",
+        "totals",
+        "devices",
+        "data_dir",
+        "partition_s",
+        "retain",
+        "partition",
+        "memname",
+        "catalog",
+        "device_ids",
+        "metric_ids",
+    )
+
+    def __init__(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        batch_ms: int = DEFAULT_BATCH_MS,
+        data_dir: str = None,
+        partition_s: int = DEFAULT_PARTITION_S,
+        retain: int = 0,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+    ):
+        # lock guards the queue and stats and is never held over a write,
+        # writing serializes all use of the connections
+        self.batch_size = max(batch_size, 1)
+        self.batch_ms = batch_ms
+        self.pending = []
+        self.oldest = 0
+        self.queue_size = max(queue_size, 1)
+        self.dropped = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.writing = threading.Lock()
+        self.stopping = threading.Event()
+        self.totals = IngestStats()
+        self.devices = {}
+        self.data_dir = data_dir
+        self.partition_s = partition_s
+        self.retain = retain
+        self.partition = None
+        self.memname = None
+        self.dbconn = None
+        self.device_ids = {}
+        self.metric_ids = {}
+
+        if data_dir is None:
+            # Ephemeral storage, named so query() can connect to it too
+            self.memname = "file:collector-{}?mode=memory&cache=shared".format(
+                uuid.uuid4().hex
+            )
+            self.dbconn = self.open_db(self.memname)
+            self.catalog = self.dbconn
+            self.create_catalog()
+        else:
+            os.makedirs(data_dir, exist_ok=True)
+            self.catalog = self.open_db(os.path.join(data_dir, CATALOG_NAME))
+            self.create_catalog()
+            self.load_catalog()
+            self.load_stats()
+            self.rotate(self.partition_start(time.time()))
+
+        self.flusher = threading.Thread(target=self.write_loop, daemon=True)
+        self.flusher.start()
 
     def __del__(self):
-        if self.dbconn:
+        self.close()
+
+    def close(self):
+        """Write out anything buffered, then close the database"""
+        if self.dbconn is None:
+            return
+        with self.ready:
+            self.stopping.set()
+            self.ready.notify()
+        self.flusher.join()
+        self.flush()
+        with self.writing:
+            if self.catalog is not self.dbconn:
+                self.catalog.close()
             self.dbconn.close()
+            self.dbconn = None
 
     def acceptData(self, uri_args: dict):
-        """Take query params from the GET request and store them"""
+        """
+        Take query params from the GET request and queue them for writing.
+        QueueFullError if queue_size records are already waiting
+        """
         # Time processed - not the same as when the emitter sent data, ok for now
         accept_time = int(time.time() * 1000) / 1000
+        self.enqueue([self.to_record(uri_args, accept_time)])
 
-        # Extract or generate fields for this request
-        topic = "placeholder_topic"
-        val_or = lambda key, default: uri_args[key] if key in uri_args else default
-        dev_typ = val_or("device_type", "NULL")
-        dev_mod = val_or("device_model", "NULL")
-        dev_freemem = int(val_or("heapfree", -1))
-        databuf = "teststring"
-
-        # Insert the row.
-        qstr = "INSERT INTO Live(accept_time, topic, device_id, device_type, freemem, data)"
-        qstr += "   VALUES ({},'{}', '{}', '{}', {}, '{}');".format(
-            accept_time, topic, dev_typ, dev_mod, dev_freemem, databuf
-        )
-        self.dbconn.execute(qstr)
-        self.dbconn.commit()
-
-        # - Should the leading column have a NOT NULL constraint? count(*) vs count(1) consideration
-        # - None of these aggregates should require materializing the table, so it
-        #   should be fast. If it gets bogged down it's time to look at query plans.
-        cursor = self.dbconn.execute(
-            "SELECT count(*), min(accept_time), max(accept_time) FROM Live"
+    def acceptBatch(self, records: list):
+        """
+        Queue many records at once, each a dict like acceptData's params
+        that may carry its own ts (epoch seconds) for when it was sampled.
+        All or nothing: QueueFullError unless the queue has room for all,
+        ValueError naming the first record that can't be stored. They're
+        written in the same transaction unless a flush splits them
+        """
+        accept_time = int(time.time() * 1000) / 1000
+        queued = []
+        for i, rec in enumerate(records):
+            try:
+                queued.append(self.to_record(rec, accept_time))
+            except ValueError as e:
+                raise ValueError("record {}: {}".format(i, str(e)))
+        self.enqueue(queued)
+
+    def flush(self):
+        """
+        Write every queued record in one transaction. If that fails they're
+        written one at a time, so only the records that can't be written
+        are dropped, counted as failed. Whatever went wrong, the writer
+        carries on with the next batch rather than leave the queue to fill
+        for good
+        """
+        with self.writing:
+            with self.lock:
+                records, self.pending = self.pending, []
+            if not records or self.dbconn is None:
+                return
+            try:
+                self.write(records)
+                return
+            except Exception as e:
+                error = e
+                self.forget_names()
+
+            lost = 1
+            if len(records) > 1:
+                # Part of the batch may be committed already, its samples
+                # are ignored as repeats the second time
+                lost = 0
+                for rec in records:
+                    try:
+                        self.write([rec])
+                    except Exception as e:
+                        error = e
+                        lost += 1
+                        self.forget_names()
+            print(
+                "warn: write of {} records failed, {} dropped: {}".format(
+                    len(records), lost, str(error)
+                )
+            )
+            with self.lock:
+                self.failed += lost
+
+    def query(
+        self, device: str, metric: str, start: float, end: float, bucket_s: float
+    ):
+        """
+        Iterator of (bucket start, count, min, max, avg, last) for every
+        bucket_s wide bucket in [start, end) holding samples of metric from
+        device, oldest first, buckets starting at multiples of bucket_s.
+        min, max and avg are over the numeric samples, None if there are
+        none. last is the newest sample, numeric or not.
+
+        Reads the coarsest rollup bucket_s is a multiple of, see
+        resolution(). Where the range starts or ends partway into one of
+        its buckets that part is read from the next finer rollup, down to
+        the samples themselves, so the answer is the same whichever is
+        used. Each piece is one range scan of a primary key per partition
+        overlapping it, and rows come out as they're read, nothing is
+        collected first. ValueError for a bad bucket_s, raised right away
+        """
+        if not bucket_s > 0:
+            raise ValueError("bucket must be positive, not {}".format(bucket_s))
+        dev_id = self.device_ids.get(device)
+        metric_id = self.metric_ids.get(metric)
+        if dev_id is None or metric_id is None or end <= start:
+            return iter(())
+        pieces = self.pieces(start, end, self.resolution(bucket_s))
+        return self.scan_buckets(pieces, dev_id, metric_id, bucket_s)
+
+    def resolution(self, bucket_s: float) -> int:
+        """
+        Width of the coarsest rollup query() reads for bucket_s wide
+        buckets, 0 for the samples themselves
+        """
+        for res in reversed(ROLLUP_RESOLUTIONS):
+            multiple = bucket_s / res
+            if multiple >= 1 and abs(multiple - round(multiple)) < 1e-9:
+                return res
+        return 0
+
+    def check_ts(self, ts: float, now: float) -> float:
+        """
+        ts if a sample from then can be stored, ValueError if it's more
+        than MAX_FUTURE_S after now or from before the epoch. With retain,
+        also if it's older than the oldest partition retain keeps, the
+        sample would only be dropped again
+        """
+        oldest = 0
+        if self.data_dir is not None and self.retain:
+            oldest = self.partition_start(now) - (self.retain - 1) * self.partition_s
+        if ts < oldest:
+            raise ValueError("ts is before {}".format(oldest))
+        if ts > now + MAX_FUTURE_S:
+            raise ValueError("ts is over {}s ahead of now".format(MAX_FUTURE_S))
+        return ts
+
+    def partitions(self) -> list:
+        """(start time, path) of every partition file, oldest first"""
+        found = []
+        for name in os.listdir(self.data_dir):
+            m = PARTITION_RE.match(name)
+            if m:
+                start = calendar.timegm(time.strptime(m.group(1), "%Y%m%d-%H%M%S"))
+                found.append((start, os.path.join(self.data_dir, name)))
+        return sorted(found)
+
+    def drop_partitions(self, before: float) -> list:
+        """
+        Unlink partition files that only hold records from before, never
+        the one being written. stats() keeps counting them, it's about what
+        was accepted. Returns the paths removed.
+        """
+        parts = self.partitions()
+        dropped = []
+        for (_, path), (until, _) in zip(parts, parts[1:]):
+            if until > before:
+                break
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink(path + suffix)
+                except FileNotFoundError:
+                    pass
+            dropped.append(path)
+        return dropped
+
+    def stats(self) -> dict:
+        """
+        {"records", "first", "last", "pending", "devices": {device_id:
+        {"records", "first", "last"}}} for committed records, pending is
+        how many are queued, of at most queue_size, dropped how many
+        were turned away with the queue full and failed how many were lost
+        to a write that failed
+        """
+        with self.lock:
+            out = self.totals.asdict()
+            out["pending"] = len(self.pending)
+            out["queue_size"] = self.queue_size
+            out["dropped"] = self.dropped
+            out["failed"] = self.failed
+            out["devices"] = {d: st.asdict() for d, st in self.devices.items()}
+        return out
+
+    # not public interface
+    def to_record(self, uri_args: dict, accept_time: float) -> tuple:
+        """
+        (ts, device, device_type, device_model, metrics) for the queue.
+        ValueError for anything the writer couldn't store, it's checked
+        here so a bad record is turned away instead of failing a batch
+        """
+        ts = uri_args.get("ts")
+        if ts is None:
+            ts = accept_time
+        else:
+            ts = int(self.check_ts(parse_ts(ts), accept_time) * 1000) / 1000
+        for param in NAME_PARAMS:
+            if not isinstance(uri_args.get(param, ""), str):
+                raise ValueError("{} must be a string".format(param))
+
+        # metric.psi=90 from the mocks, a0=512 straight from the firmware
+        dev_typ = uri_args.get("device_type")
+        dev_mod = uri_args.get("device_model")
+        device = uri_args.get("uuid") or dev_typ or UNKNOWN_DEVICE
+        metrics = {}
+        for name, val in uri_args.items():
+            if name not in ENVELOPE_PARAMS:
+                check_value(name, val)
+                metrics[name[7:] if name.startswith("metric.") else name] = val
+        return (ts, device, dev_typ, dev_mod, metrics)
+
+    def enqueue(self, records: list):
+        """Queue records for the writer, QueueFullError if they don't fit"""
+        with self.ready:
+            depth = len(self.pending)
+            if depth + len(records) > self.queue_size:
+                self.dropped += len(records)
+                raise QueueFullError(depth)
+            if not depth:
+                self.oldest = time.monotonic()
+            self.pending.extend(records)
+            # Start the writer's batch_ms clock, or wake it for a full batch
+            if depth == 0 or depth < self.batch_size <= len(self.pending):
+                self.ready.notify()
+
+    def open_db(self, path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, uri=True, check_same_thread=False)
+        if self.data_dir is not None:
+            for pragma in FILE_PRAGMAS:
+                conn.execute(pragma)
+        # Batch never needs to touch disk
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(CREATE_SAMPLE)
+        has_rollup = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'Rollup'"
+        ).fetchone()
+        conn.execute(CREATE_ROLLUP)
+        if not has_rollup:
+            # A partition from before rollups, catch them up with its samples
+            for res in ROLLUP_RESOLUTIONS:
+                conn.execute(ROLLUP_SAMPLES, (res,))
+        conn.execute(CREATE_BATCH)
+        conn.commit()
+        return conn
+
+    def insert_samples(self, conn: sqlite3.Connection, rows):
+        """
+        Insert sample rows and fold the new ones into every rollup, inside
+        the caller's transaction. Caller holds writing
+        """
+        conn.executemany(INSERT_BATCH, rows)
+        conn.execute(DROP_KNOWN)
+        conn.execute(INSERT_SAMPLES)
+        for res in ROLLUP_RESOLUTIONS:
+            conn.execute(ROLLUP_BATCH, (res,))
+        conn.execute("DELETE FROM Batch")
+
+    def create_catalog(self):
+        self.catalog.execute(CREATE_DEVICE)
+        self.catalog.execute(CREATE_METRIC)
+        self.catalog.commit()
+
+    def load_catalog(self):
+        """Fill the name to id caches from the catalog"""
+        for name, dev_id in self.catalog.execute("SELECT name, id FROM Device"):
+            self.device_ids[name] = dev_id
+        for name, metric_id in self.catalog.execute("SELECT name, id FROM Metric"):
+            self.metric_ids[name] = metric_id
+
+    def write(self, records: list):
+        """Insert records, the work of flush(). Caller holds writing"""
+        rows = self.to_samples(records)
+        if self.data_dir is None:
+            # New names went into the same transaction
+            with self.dbconn:
+                self.insert_samples(self.dbconn, rows)
+        else:
+            self.catalog.commit()
+            current = self.partition_start(time.time())
+            if current > self.partition:
+                self.rotate(current)
+            # A batch may straddle a boundary, bulk records may also be
+            # out of order. Nearly sorted already, cheap for timsort
+            rows.sort(key=lambda row: self.partition_start(row[2]))
+            by_partition = itertools.groupby(
+                rows, lambda row: self.partition_start(row[2])
+            )
+            for start, group in by_partition:
+                self.write_partition(start, group)
+        with self.lock:
+            self.count(records)
+
+    def forget_names(self):
+        """
+        After a failed write the name to id caches may hold ids that were
+        rolled back, start them over from what the catalog has
+        """
+        self.device_ids.clear()
+        self.metric_ids.clear()
+        try:
+            self.catalog.rollback()
+            self.load_catalog()
+        except sqlite3.Error:
+            # Names get looked up again as they come in
+            pass
+
+    def to_samples(self, records: list) -> list:
+        """
+        Sample rows for records, names not seen before are added to the
+        catalog (not committed). Caller holds writing
+        """
+        rows = []
+        for accept_time, device, dev_typ, dev_mod, metrics in records:
+            dev_id = self.device_ids.get(device)
+            if dev_id is None:
+                self.catalog.execute(
+                    "INSERT OR IGNORE INTO Device(name, device_type, device_model)"
+                    " VALUES (?, ?, ?)",
+                    (device, dev_typ, dev_mod),
+                )
+                dev_id = self.catalog.execute(
+                    "SELECT id FROM Device WHERE name = ?", (device,)
+                ).fetchone()[0]
+                self.device_ids[device] = dev_id
+            for name, val in metrics.items():
+                metric_id = self.metric_ids.get(name)
+                if metric_id is None:
+                    self.catalog.execute(
+                        "INSERT OR IGNORE INTO Metric(name) VALUES (?)", (name,)
+                    )
+                    metric_id = self.catalog.execute(
+                        "SELECT id FROM Metric WHERE name = ?", (name,)
+                    ).fetchone()[0]
+                    self.metric_ids[name] = metric_id
+                num, text = split_value(val)
+                rows.append((dev_id, metric_id, accept_time, num, text))
+        return rows
+
+    def overlapping(self, start: float, end: float) -> list:
+        """Paths of the partitions that may hold samples in [start, end)"""
+        parts = self.partitions()
+        ends = [p[0] for p in parts[1:]] + [float("inf")]
+        return [
+            path
+            for (begin, path), until in zip(parts, ends)
+            if (end is None or begin < end) and (start is None or until > start)
+        ]
+
+    def pieces(self, start: float, end: float, res: int) -> list:
+        """
+        [(res, start, end)] covering [start, end) in time order, each read
+        from the coarsest rollup, no coarser than res, whose buckets it
+        holds whole. 0 is the samples themselves
+        """
+        if not res:
+            return [(0, start, end)]
+        finer = ROLLUP_RESOLUTIONS.index(res) - 1
+        finer = ROLLUP_RESOLUTIONS[finer] if finer >= 0 else 0
+        lo = math.ceil(start / res) * res
+        hi = math.floor(end / res) * res
+        if lo >= hi:
+            return self.pieces(start, end, finer)
+        head = self.pieces(start, lo, finer) if start < lo else []
+        tail = self.pieces(hi, end, finer) if hi < end else []
+        return head + [(res, lo, hi)] + tail
+
+    def scan_buckets(self, pieces: list, dev_id: int, metric_id: int, bucket_s):
+        """Bucket rows of each piece and partition in time order, see query()"""
+        held = None
+        for res, start, end in pieces:
+            if self.data_dir is None:
+                sources = [self.memname]
+            else:
+                sources = [
+                    "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(p)))
+                    for p in self.overlapping(start, end)
+                ]
+            args = (dev_id, metric_id, start, end, bucket_s)
+            sql = BUCKET_QUERY
+            if res:
+                args += (res,)
+                sql = ROLLUP_QUERY
+            for source in sources:
+                conn = sqlite3.connect(source, uri=True, check_same_thread=False)
+                try:
+                    if self.data_dir is None:
+                        conn.execute("PRAGMA read_uncommitted=1")
+                    for row in conn.execute(sql, args):
+                        if held is not None and held[0] == row[0]:
+                            # A bucket straddling a partition or piece boundary
+                            held = merge_buckets(held, row)
+                            continue
+                        if held is not None:
+                            yield finish_bucket(held, bucket_s)
+                        held = row
+                finally:
+                    conn.close()
+        if held is not None:
+            yield finish_bucket(held, bucket_s)
+
+    def partition_start(self, t: float) -> int:
+        return int(t // self.partition_s) * self.partition_s
+
+    def partition_path(self, start: int) -> str:
+        return os.path.join(
+            self.data_dir, time.strftime(PARTITION_NAME, time.gmtime(start))
         )
-        row = cursor.fetchone()
+
+    def rotate(self, start: int):
+        """
+        Switch writing to the partition for start, the one for now. Caller
+        holds writing
+        """
+        if self.dbconn is not None:
+            self.dbconn.close()
+        self.dbconn = self.open_db(self.partition_path(start))
+        self.partition = start
+        if self.retain:
+            parts = self.partitions()
+            if len(parts) > self.retain:
+                # Samples from a fast clock may have started newer ones,
+                # those never push out the partition for now
+                self.drop_partitions(min(parts[-self.retain][0], start))
+
+    def write_partition(self, start: int, rows):
+        """Insert rows in one transaction. Caller holds writing"""
+        conn = self.dbconn
+        if start != self.partition:
+            # Late data, a fast emitter clock, or ours stepped back
+            conn = self.open_db(self.partition_path(start))
+        try:
+            with conn:
+                self.insert_samples(conn, rows)
+        finally:
+            if conn is not self.dbconn:
+                conn.close()
+
+    def load_stats(self):
+        """
+        Start the stats off from partitions already on disk, a record being
+        a distinct accept time of a device. Opening them also builds the
+        rollups of any written before there were rollups
+        """
+        names = {dev_id: name for name, dev_id in self.device_ids.items()}
+        for _, path in self.partitions():
+            conn = self.open_db(path)
+            rows = conn.execute(
+                "SELECT device_id, count(DISTINCT ts), min(ts), max(ts)"
+                " FROM Sample GROUP BY device_id"
+            ).fetchall()
+            conn.close()
+            for dev_id, records, first, last in rows:
+                dev = names.get(dev_id, UNKNOWN_DEVICE)
+                self.totals.add(records, first, last)
+                self.devices.setdefault(dev, IngestStats()).add(records, first, last)
+
+    def write_loop(self):
+        """
+        The writer thread, flushes once a batch is full or its oldest record
+        has waited batch_ms, until close()
+        """
+        interval = self.batch_ms / 1000
+        while True:
+            with self.ready:
+                while not self.stopping.is_set():
+                    if len(self.pending) >= self.batch_size:
+                        break
+                    wait = None
+                    if self.pending:
+                        wait = self.oldest + interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                    self.ready.wait(wait)
+                if self.stopping.is_set():
+                    return
+            self.flush()
+
+    def count(self, records: list):
+        """Fold a committed batch into the stats. Caller holds lock"""
+        before = self.totals.records
+        # Bulk records carry their own times, not necessarily in order
+        times = [rec[0] for rec in records]
+        self.totals.add(len(records), min(times), max(times))
+        for rec in records:
+            dev = self.devices.get(rec[1])
+            if dev is None:
+                dev = self.devices[rec[1]] = IngestStats()
+            dev.add(1, rec[0], rec[0])
 
         # Print some basic stats for debug.
-        if row[0] % 100 == 0:
+        if self.totals.records // 100 != before // 100:
             print(
                 "\ncommitted qry: cnt {} | mintime {} | maxtime {}|\n".format(
-                    row[0], row[1], row[2]
+                    self.totals.records, self.totals.first, self.totals.last
                 )
             )
-        cursor.close()
-
-        if False:
-            if row[0] % 10 == 0:
-                # Print last 5 entries (debug)
-                cursor = self.dbconn.execute(
-                    "SELECT * FROM Live ORDER BY 1 DESC LIMIT 5"
-                )
-                for row in cursor:
-                    print(str(row))
-                cursor.close()
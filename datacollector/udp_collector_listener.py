@@ -0,0 +1,213 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+import sqlite3_collector_backend
+
+"""
+Record per datagram, no connection and no answer. A datagram is a format
+version token, a space, then the record:
+
+  v1 uuid=8caab5...&device_type=ArduinoSimple8266&a0=512&d4=1&heapfree=40000
+
+v1 is the same key=value pairs the GET query carries, so firmware that
+builds the query string with snprintf can send it as is. A new format gets
+a new version token, old senders keep working.
+"""
+
+"Version tokens this listener understands"
+FORMAT_V1 = b"v1"
+
+"Datagrams read before they're handed to the backend as one batch"
+DEFAULT_UDP_BATCH = 256
+
+"Largest datagram accepted, the firmware's GET buffer is 2 KiB"
+MAX_DATAGRAM = 4096
+
+"Kernel receive buffer asked for, holds bursts while a batch is queued"
+RCVBUF_BYTES = 4 * 1024 * 1024
+
+"Seconds between checks for close() while no datagrams arrive"
+STOP_POLL_S = 0.5
+
+"""
+Linux counts datagrams it had no buffer room for and, with this option
+on, reports the running total with every datagram received
+"""
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+
+
+def parse_datagram(data: bytes) -> dict:
+    """
+    Record params from one datagram, ValueError if it's malformed. Whether
+    its ts is recent enough to store is up to the writer, see drain()
+    """
+    version, _, payload = data.partition(b" ")
+    if version != FORMAT_V1:
+        raise ValueError("unknown format {!r}".format(version[:8]))
+    rec = dict(
+        urllib.parse.parse_qsl(
+            payload.decode("utf-8"), keep_blank_values=True, strict_parsing=True
+        )
+    )
+    if not rec:
+        raise ValueError("empty record")
+    if "ts" in rec:
+        # Caught here, a bad one would fail the whole batch it's queued with
+        sqlite3_collector_backend.parse_ts(rec["ts"])
+    return rec
+
+
+class UDPListener:
+    """
+    Receives datagram records on host:port and queues them on a
+    sqlite3_collector_backend.DBWriter, the same backend the HTTP side
+    uses. A thread waits for the first datagram, then reads whatever else
+    is already waiting without blocking, up to batch of them, and queues
+    them with one acceptBatch, the recvmmsg pattern.
+
+    Counters: received, malformed (unparseable, truncated, an unknown
+    version or a ts the writer won't take), dropped (turned away with the write queue full) and, on
+    Linux, overflowed (lost to a full socket buffer before being read).
+    """
+
+    __slots__ = (
+        "writer",
+        "sock",
+        "batch",
+        "overflow_cmsg",
+        "lock",
+        "received",
+        "malformed",
+        "dropped",
+        "overflowed",
+        "stopping",
+        "thread",
+    )
+
+    def __init__(self, writer, host: str, port: int, batch: int = DEFAULT_UDP_BATCH):
+        self.writer = writer
+        self.batch = max(batch, 1)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.malformed = 0
+        self.dropped = 0
+        self.overflowed = 0
+        self.stopping = threading.Event()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_BYTES)
+        self.overflow_cmsg = 0
+        if sys.platform.startswith("linux"):
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.overflow_cmsg = socket.CMSG_SPACE(4)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+
+        self.thread = threading.Thread(target=self.recv_loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self) -> int:
+        """Port bound, useful after binding port 0"""
+        return self.sock.getsockname()[1]
+
+    def close(self):
+        """Stop receiving, records already read have been queued"""
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.sock.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "received": self.received,
+                "malformed": self.malformed,
+                "dropped": self.dropped,
+                "overflowed": self.overflowed,
+            }
+
+    # not public interface
+    def recv_loop(self):
+        while not self.stopping.is_set():
+            try:
+                ready, _, _ = select.select([self.sock], [], [], STOP_POLL_S)
+                if ready:
+                    self.drain()
+            except Exception as e:
+                # Whatever one bad datagram trips, the next ones still count
+                print("warn: udp listener: {}".format(str(e)))
+
+    def drain(self):
+        """Read up to batch waiting datagrams, queue the good ones"""
+        records = []
+        received = malformed = 0
+        overflowed = None
+        while received < self.batch:
+            try:
+                data, ancdata, flags, _ = self.sock.recvmsg(
+                    MAX_DATAGRAM, self.overflow_cmsg
+                )
+            except BlockingIOError:
+                break
+            received += 1
+            for level, kind, value in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                    # Running total since the socket was opened
+                    overflowed = struct.unpack("=I", value[:4])[0]
+            if flags & socket.MSG_TRUNC:
+                malformed += 1
+                continue
+            try:
+                rec = parse_datagram(data)
+                if "ts" in rec:
+                    self.writer.check_ts(float(rec["ts"]), time.time())
+                records.append(rec)
+            except ValueError:
+                malformed += 1
+
+        dropped = 0
+        if records:
+            try:
+                self.writer.acceptBatch(records)
+            except sqlite3_collector_backend.QueueFullError:
+                dropped = len(records)
+            except ValueError:
+                # A ts right at the edge of what's stored, offer them one
+                # at a time so only the bad one is lost
+                for rec in records:
+                    try:
+                        self.writer.acceptBatch([rec])
+                    except sqlite3_collector_backend.QueueFullError:
+                        dropped += 1
+                    except ValueError:
+                        malformed += 1
+
+        with self.lock:
+            self.received += received
+            self.malformed += malformed
+            self.dropped += dropped
+            if overflowed is not None:
+                self.overflowed = overflowed
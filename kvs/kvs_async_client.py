@@ -0,0 +1,346 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import collections
+import json
+import urllib.parse
+
+import kvs_client
+
+"Keep-alive connections per client, requests are pipelined over them"
+DEFAULT_CONNECTIONS = 4
+
+"Most requests in flight per client, extra callers wait their turn"
+DEFAULT_MAX_INFLIGHT = 256
+
+
+class PipelinedConnection:
+    """
+    One HTTP/1.1 keep-alive connection with requests written back to back,
+    without waiting for earlier responses. The server answers in order, so
+    a single reader task hands each response to the oldest pending future.
+    keepalive goes False if the server turns out to close connections
+    after each response (single mode), requests queued behind it then fail.
+    """
+
+    __slots__ = "reader", "writer", "pending", "closed", "keepalive", "task"
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = collections.deque()
+        self.closed = False
+        self.keepalive = True
+        self.task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    @classmethod
+    async def open(cls, host: str, port: int):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def send(self, request: bytes) -> asyncio.Future:
+        """
+        Queue a serialized request, returns a future for (status, headers,
+        body). Writing and queueing the future happen in one step, that's
+        what keeps responses matched to requests.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self.writer.write(request)
+        self.pending.append(fut)
+        return fut
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writer.close()
+
+    # not public interface
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionResetError("server closed the connection")
+                version, status = line.split(None, 2)[:2]
+                headers = {}
+                while True:
+                    hline = await self.reader.readline()
+                    if hline in (b"\r\n", b"\n"):
+                        break
+                    if not hline:
+                        raise ConnectionResetError("connection closed mid response")
+                    name, _, val = hline.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = val.strip()
+
+                length = int(headers.get("content-length", 0))
+                body = await self.reader.readexactly(length) if length else b""
+                fut = self.pending.popleft()
+                if not fut.done():
+                    fut.set_result((int(status), headers, body))
+
+                if version == b"HTTP/1.0" or headers.get("connection") == "close":
+                    self.keepalive = False
+                    raise ConnectionResetError("server won't keep the connection")
+        except (ConnectionError, OSError, ValueError, IndexError) as e:
+            error = e
+        except asyncio.CancelledError:
+            error = ConnectionResetError("connection closed")
+        except asyncio.IncompleteReadError as e:
+            error = ConnectionResetError(str(e))
+
+        self.closed = True
+        self.writer.close()
+        while self.pending:
+            fut = self.pending.popleft()
+            if not fut.done():
+                fut.set_exception(ConnectionResetError(str(error)))
+
+
+class AsyncConnectionPool:
+    """
+    Spreads requests over up to size pipelined connections to one
+    authority, each request going to the connection with the least in
+    flight. A new connection is only opened while all of them are busy.
+    Against a server that won't keep connections open every request gets
+    a connection of its own instead. Until the first answer says which it
+    is, requests go one at a time: a server that closes a connection with
+    pipelined requests still unread resets it, which can lose the answer
+    to a request it did carry out.
+    """
+
+    __slots__ = "host", "port", "size", "conns", "lock", "probe", "keepalive"
+
+    def __init__(self, authority: str, size: int = DEFAULT_CONNECTIONS):
+        host, _, port = authority.rpartition(":")
+        self.host = host
+        self.port = int(port)
+        self.size = size
+        self.conns = []
+        self.lock = asyncio.Lock()
+        self.probe = asyncio.Lock()
+        self.keepalive = None
+
+    async def request(
+        self, method: str, url: str, body: bytes = None, headers=None, retry=True
+    ):
+        """
+        Returns (status, headers, body). A request lost to a connection
+        the server closed (e.g. idle timeout) is retried once on another,
+        unless retry is False: a reset can also come after the server
+        carried the request out.
+        """
+        head = "{} {} HTTP/1.1\r\nHost: {}:{}\r\n".format(
+            method, url, self.host, self.port
+        )
+        for name, val in (headers or {}).items():
+            head += "{}: {}\r\n".format(name, val)
+        if body is not None:
+            head += "Content-Length: {}\r\n".format(len(body))
+        request = bytes(head + "\r\n", "latin-1") + (body or b"")
+
+        if self.keepalive is None:
+            async with self.probe:
+                if self.keepalive is None:
+                    return await self.send(request, retry)
+        return await self.send(request, retry)
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+
+    # not public interface
+    async def send(self, request: bytes, retry: bool):
+        for attempt in range(2):
+            conn = await self.pick()
+            try:
+                answer = await conn.send(request)
+                if self.keepalive is None:
+                    self.keepalive = conn.keepalive
+                return answer
+            except ConnectionResetError as e:
+                if not conn.keepalive:
+                    self.keepalive = False
+                if attempt or not retry:
+                    raise e
+
+    async def pick(self) -> PipelinedConnection:
+        if self.keepalive is False:
+            return await PipelinedConnection.open(self.host, self.port)
+        async with self.lock:
+            self.conns = [c for c in self.conns if not c.closed]
+            best = min(self.conns, key=lambda c: len(c.pending), default=None)
+            if best is None or (best.pending and len(self.conns) < self.size):
+                best = await PipelinedConnection.open(self.host, self.port)
+                self.conns.append(best)
+            return best
+
+
+class AsyncKVSClient:
+    """
+    asyncio counterpart of kvs_client.HttpKVSClient, same operations and
+    answers, as coroutines. Any number of calls may be in flight at once
+    from one event loop, they're multiplexed over a few pipelined
+    connections with at most max_inflight outstanding.
+
+    The *Many helpers fan single key calls out with asyncio.gather, getVals
+    and friends are the server side batch operations.
+    """
+
+    __slots__ = "uri_host", "pool", "inflight"
+
+    def __init__(
+        self,
+        host: str,
+        connections: int = DEFAULT_CONNECTIONS,
+        max_inflight: int = DEFAULT_MAX_INFLIGHT,
+    ):
+        self.uri_host = host
+        self.pool = AsyncConnectionPool(host, connections)
+        self.inflight = asyncio.Semaphore(max_inflight)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Drop the connections, calls still in flight fail"""
+        self.pool.close()
+
+    async def do_rpc(self, path: str, query: str = "", body: dict = None) -> object:
+        """Same contract as HttpKVSClient.do_rpc"""
+        url = path + "?" + query
+        retry = path not in kvs_client.NOT_IDEMPOTENT_PATHS
+        try:
+            async with self.inflight:
+                if body is None:
+                    status, _, data = await self.pool.request(
+                        "GET", url, None, None, retry
+                    )
+                else:
+                    payload = bytes(json.dumps(body), "utf-8")
+                    hdrs = {"Content-Type": "application/json"}
+                    status, _, data = await self.pool.request(
+                        "POST", url, payload, hdrs, retry
+                    )
+        except Exception as e:
+            print("warn: unexpected exception: {}".format(str(e)))
+            return {"error": "unexpected exception"}
+
+        if status == 404:
+            return {"error": "Resource not found (key missing)"}
+        if status != 200:
+            try:
+                doc = json.loads(data)
+            except ValueError:
+                doc = None
+            if isinstance(doc, dict) and "error" in doc:
+                return doc
+            return {"error": "http status {}".format(status)}
+        return json.loads(data)
+
+    async def getVal(self, key: str) -> object:
+        key = urllib.parse.quote_plus(key)
+        return await self.do_rpc("/get", "key={}".format(key))
+
+    async def setVal(self, key: str, val: str, ttl: float = None) -> object:
+        key = urllib.parse.quote_plus(key)
+        val = urllib.parse.quote_plus(val)
+        query = "key={}&value={}".format(key, val)
+        if ttl is not None:
+            query += "&ttl={}".format(ttl)
+        return await self.do_rpc("/set", query)
+
+    async def delVal(self, key: str) -> object:
+        key = urllib.parse.quote_plus(key)
+        return await self.do_rpc("/delete", "key={}".format(key))
+
+    async def casVal(
+        self, key: str, val: str, version: int, ttl: float = None
+    ) -> object:
+        key = urllib.parse.quote_plus(key)
+        val = urllib.parse.quote_plus(val)
+        query = "key={}&value={}&version={}".format(key, val, version)
+        if ttl is not None:
+            query += "&ttl={}".format(ttl)
+        return await self.do_rpc("/cas", query)
+
+    async def incrVal(self, key: str, by: int = 1) -> object:
+        key = urllib.parse.quote_plus(key)
+        return await self.do_rpc("/incr", "key={}&by={}".format(key, by))
+
+    async def addVal(self, key: str, delta) -> object:
+        key = urllib.parse.quote_plus(key)
+        delta = urllib.parse.quote_plus(repr(delta))
+        return await self.do_rpc("/add", "key={}&delta={}".format(key, delta))
+
+    async def stats(self) -> dict:
+        return await self.do_rpc("/stats")
+
+    async def listAll(
+        self,
+        keyregex: str = "",
+        prefix: str = "",
+        limit: int = None,
+        cursor: str = None,
+    ):
+        query = "filter={}".format(urllib.parse.quote_plus(keyregex))
+        if prefix:
+            query += "&prefix={}".format(urllib.parse.quote_plus(prefix))
+        if limit is not None:
+            query += "&limit={}".format(limit)
+        if cursor is not None:
+            query += "&cursor={}".format(urllib.parse.quote_plus(cursor))
+        return await self.do_rpc("/listall", query)
+
+    async def getVals(self, keys: list) -> dict:
+        return await self.do_rpc("/mget", body={"keys": list(keys)})
+
+    async def snapshot(self, keys: list, seq: int = None, epoch: str = None) -> dict:
+        body = {"keys": list(keys)}
+        if seq is not None:
+            body["seq"], body["epoch"] = seq, epoch
+        return await self.do_rpc("/snapshot", body=body)
+
+    async def setVals(self, items: dict, ttl: float = None) -> dict:
+        body = {"items": {k: str(v) for k, v in items.items()}}
+        if ttl is not None:
+            body["ttl"] = ttl
+        return await self.do_rpc("/mset", body=body)
+
+    async def delVals(self, keys: list) -> dict:
+        return await self.do_rpc("/mdelete", body={"keys": list(keys)})
+
+    async def getMany(self, keys: list) -> dict:
+        """{key: getVal(key)} with every get in flight at once"""
+        keys = list(keys)
+        found = await asyncio.gather(*(self.getVal(k) for k in keys))
+        return dict(zip(keys, found))
+
+    async def setMany(self, items: dict) -> dict:
+        """{key: setVal(key, value)} with every set in flight at once"""
+        keys = list(items)
+        done = await asyncio.gather(*(self.setVal(k, str(items[k])) for k in keys))
+        return dict(zip(keys, done))
+
+    async def delMany(self, keys: list) -> dict:
+        """{key: delVal(key)} with every delete in flight at once"""
+        keys = list(keys)
+        done = await asyncio.gather(*(self.delVal(k) for k in keys))
+        return dict(zip(keys, done))
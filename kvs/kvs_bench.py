@@ -0,0 +1,683 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import kvs_async_client
+import kvs_client
+
+"Where kvs_service.py lives, the benchmark starts its own copies"
+SERVICE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "kvs_service.py"
+)
+
+
+def start_service(port: int, env: dict = None) -> subprocess.Popen:
+    """Launch kvs_service.py on 127.0.0.1:port and wait until it accepts"""
+    procenv = dict(os.environ)
+    procenv.update(env or {})
+    procenv["KVS_HOST"] = "127.0.0.1"
+    procenv["KVS_PORT"] = str(port)
+    proc = subprocess.Popen(
+        [sys.executable, SERVICE_PATH],
+        env=procenv,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("kvs_service didn't come up on port {}".format(port))
+
+
+def stop_service(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def preload(client, keys: list, batch: int = 1000):
+    """Seed keys with "0" a batch at a time"""
+    for i in range(0, len(keys), batch):
+        client.setVals({k: "0" for k in keys[i : i + batch]})
+
+
+def connect(authority):
+    """A list of authorities means shards"""
+    if isinstance(authority, list):
+        return kvs_client.ShardedKVSClient(authority)
+    return kvs_client.HttpKVSClient(authority)
+
+
+def run_clients(
+    authority,
+    nclients: int,
+    duration_s: float,
+    keys: list,
+    write_ratio: float = 0.1,
+) -> int:
+    """
+    Run nclients threads doing gets, with write_ratio of ops being sets,
+    for duration_s. Returns the number of completed operations across all
+    clients. authority may be a list of shards.
+    """
+    counts = [0] * nclients
+    stop_at = time.time() + duration_s
+
+    def worker(slot: int):
+        client = connect(authority)
+        rng = random.Random(slot)
+        done = 0
+        while time.time() < stop_at:
+            key = rng.choice(keys)
+            if rng.random() >= write_ratio:
+                client.getVal(key)
+            else:
+                client.setVal(key, str(done))
+            done += 1
+        counts[slot] = done
+
+    threads = [threading.Thread(target=worker, args=[i]) for i in range(nclients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts)
+
+
+def bench_modes(
+    modes: list, client_counts: list, duration_s: float, nkeys: int, port: int
+):
+    """Throughput of each server mode at each client count"""
+    keys = ["bench/key{}".format(i) for i in range(nkeys)]
+    results = {}
+    for mode in modes:
+        proc = start_service(port, {"KVS_SERVER": mode})
+        try:
+            authority = "127.0.0.1:{}".format(port)
+            preload(kvs_client.HttpKVSClient(authority), keys)
+            for nclients in client_counts:
+                ops = run_clients(authority, nclients, duration_s, keys)
+                results[(mode, nclients)] = ops / duration_s
+        finally:
+            stop_service(proc)
+
+    print("{:>10} {:>8} {:>12}".format("mode", "clients", "ops/s"))
+    for mode in modes:
+        for nclients in client_counts:
+            rate = results[(mode, nclients)]
+            print("{:>10} {:>8} {:>12.1f}".format(mode, nclients, rate))
+    return results
+
+
+def bench_batch(batch_sizes: list, nkeys: int, port: int):
+    """
+    Write then read nkeys keys using mset/mget at each batch size. Batch
+    size 1 goes through setVal/getVal, i.e. one round trip per key.
+    """
+    keys = ["bench/batch{}".format(i) for i in range(nkeys)]
+    proc = start_service(port)
+    results = {}
+    try:
+        client = kvs_client.HttpKVSClient("127.0.0.1:{}".format(port))
+        for size in batch_sizes:
+            start = time.perf_counter()
+            for i in range(0, nkeys, size):
+                chunk = keys[i : i + size]
+                if size == 1:
+                    client.setVal(chunk[0], "1")
+                    client.getVal(chunk[0])
+                else:
+                    client.setVals({k: "1" for k in chunk})
+                    client.getVals(chunk)
+            elapsed = time.perf_counter() - start
+            trips = 2 * ((nkeys + size - 1) // size)
+            results[size] = (trips, elapsed)
+    finally:
+        stop_service(proc)
+
+    base = results[batch_sizes[0]][1]
+    print(
+        "{:>6} {:>12} {:>10} {:>12} {:>8}".format(
+            "batch", "roundtrips", "seconds", "keys/s", "speedup"
+        )
+    )
+    for size in batch_sizes:
+        trips, elapsed = results[size]
+        print(
+            "{:>6} {:>12} {:>10.3f} {:>12.1f} {:>7.1f}x".format(
+                size, trips, elapsed, 2 * nkeys / elapsed, base / elapsed
+            )
+        )
+    return results
+
+
+def bench_durability(
+    policies: list,
+    nclients: int,
+    duration_s: float,
+    nkeys: int,
+    port: int,
+    modes: list = ("threaded", "asyncio"),
+):
+    """
+    For each server mode and fsync policy: write throughput with nclients
+    writers, then restart time replaying a log where nkeys keys were each
+    written 5 times, then restart time once a snapshot has absorbed that
+    log.
+    """
+    keys = ["bench/durable{}".format(i) for i in range(nkeys)]
+    authority = "127.0.0.1:{}".format(port)
+    results = {}
+    for mode in modes:
+        for policy in policies:
+            with tempfile.TemporaryDirectory() as datadir:
+                env = {"KVS_DATA_DIR": datadir, "KVS_FSYNC": policy, "KVS_SERVER": mode}
+                proc = start_service(port, env)
+                try:
+                    ops = run_clients(authority, nclients, duration_s, keys[:1000], 1.0)
+                    loader = kvs_client.HttpKVSClient(authority)
+                    for _ in range(5):
+                        preload(loader, keys)
+                finally:
+                    stop_service(proc)
+
+                # Everything since startup is in the log
+                start = time.perf_counter()
+                proc = start_service(port, env)
+                replay_s = time.perf_counter() - start
+
+                # Let a snapshot absorb the log, then restart off of it
+                stop_service(proc)
+                proc = start_service(port, dict(env, KVS_SNAPSHOT_S="0.5"))
+                time.sleep(2)
+                stop_service(proc)
+                start = time.perf_counter()
+                proc = start_service(port, env)
+                snapshot_s = time.perf_counter() - start
+                stop_service(proc)
+
+            results[(mode, policy)] = (ops / duration_s, replay_s, snapshot_s)
+
+    print(
+        "{:>9} {:>8} {:>10} {:>14} {:>16}".format(
+            "mode", "fsync", "writes/s", "restart log s", "restart snap s"
+        )
+    )
+    for (mode, policy), (rate, replay_s, snapshot_s) in results.items():
+        print(
+            "{:>9} {:>8} {:>10.1f} {:>14.3f} {:>16.3f}".format(
+                mode, policy, rate, replay_s, snapshot_s
+            )
+        )
+    return results
+
+
+def bench_shards(
+    shard_counts: list,
+    nprocs: int,
+    nclients: int,
+    duration_s: float,
+    nkeys: int,
+    port: int,
+):
+    """
+    Aggregate throughput of 1..N shard processes (ports port..port+N-1)
+    driven by nprocs client processes of nclients threads each. A single
+    client process would top out on its own GIL long before the shards do.
+    """
+    keys = ["bench/shard{}".format(i) for i in range(nkeys)]
+    results = {}
+    for count in shard_counts:
+        hosts = ["127.0.0.1:{}".format(port + i) for i in range(count)]
+        procs = []
+        try:
+            for i in range(count):
+                procs.append(start_service(port + i))
+            loader = kvs_client.ShardedKVSClient(hosts)
+            preload(loader, keys)
+            loader.close()
+            with multiprocessing.Pool(nprocs) as pool:
+                work = [(hosts, nclients, duration_s, keys)] * nprocs
+                ops = sum(pool.starmap(run_clients, work))
+            results[count] = ops / duration_s
+        finally:
+            for proc in procs:
+                stop_service(proc)
+
+    base = results[shard_counts[0]]
+    print("{:>7} {:>12} {:>8}".format("shards", "ops/s", "scaling"))
+    for count in shard_counts:
+        rate = results[count]
+        print("{:>7} {:>12.1f} {:>7.2f}x".format(count, rate, rate / base))
+    return results
+
+
+def bench_contention(thread_counts: list, increments: int, port: int):
+    """
+    nthreads threads each add 1 to one counter increments times, three ways:
+        get+set  read-modify-write from the client, two round trips
+        cas      get then cas, retried on a version mismatch
+        incr     one incr round trip, applied on the server
+    Reports increments/s, lost increments and round trips per increment.
+    """
+    proc = start_service(port)
+    authority = "127.0.0.1:{}".format(port)
+    key = "bench/counter"
+
+    def get_set(client, trips):
+        cur = client.getVal(key)
+        client.setVal(key, str(int(cur["value"]) + 1))
+        trips[0] += 2
+
+    def cas(client, trips):
+        while True:
+            cur = client.getVal(key)
+            res = client.casVal(key, str(int(cur["value"]) + 1), cur["version"])
+            trips[0] += 2
+            if "error" not in res:
+                return
+
+    def incr(client, trips):
+        client.incrVal(key)
+        trips[0] += 1
+
+    methods = [("get+set", get_set), ("cas", cas), ("incr", incr)]
+    results = {}
+    try:
+        for nthreads in thread_counts:
+            for name, fn in methods:
+                kvs_client.HttpKVSClient(authority).setVal(key, "0")
+                trips = [[0] for _ in range(nthreads)]
+
+                def worker(slot: int):
+                    client = kvs_client.HttpKVSClient(authority)
+                    for _ in range(increments):
+                        fn(client, trips[slot])
+
+                threads = [
+                    threading.Thread(target=worker, args=[i]) for i in range(nthreads)
+                ]
+                start = time.perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.perf_counter() - start
+
+                final = kvs_client.HttpKVSClient(authority).getVal(key)["value"]
+                expected = nthreads * increments
+                rtts = sum(t[0] for t in trips) / expected
+                results[(nthreads, name)] = (
+                    expected / elapsed,
+                    expected - int(final),
+                    rtts,
+                )
+    finally:
+        stop_service(proc)
+
+    print(
+        "{:>8} {:>8} {:>10} {:>6} {:>12}".format(
+            "threads", "method", "incr/s", "lost", "trips/incr"
+        )
+    )
+    for nthreads in thread_counts:
+        for name, _ in methods:
+            rate, lost, rtts = results[(nthreads, name)]
+            print(
+                "{:>8} {:>8} {:>10.1f} {:>6} {:>12.2f}".format(
+                    nthreads, name, rate, lost, rtts
+                )
+            )
+    return results
+
+
+def bench_async(modes: list, concurrency: list, reads: int, nkeys: int, port: int):
+    """
+    Reads/s from a single thread: the blocking client one call at a time,
+    then AsyncKVSClient on one event loop with that many gets in flight.
+    """
+    keys = ["bench/async{}".format(i) for i in range(nkeys)]
+    authority = "127.0.0.1:{}".format(port)
+    results = {}
+
+    async def drive(inflight: int) -> float:
+        client = kvs_async_client.AsyncKVSClient(authority)
+        rng = random.Random(inflight)
+        per_task = reads // inflight
+
+        async def task():
+            for _ in range(per_task):
+                await client.getVal(rng.choice(keys))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(task() for _ in range(inflight)))
+        elapsed = time.perf_counter() - start
+        client.close()
+        return per_task * inflight / elapsed
+
+    for mode in modes:
+        proc = start_service(port, {"KVS_SERVER": mode})
+        try:
+            client = kvs_client.HttpKVSClient(authority)
+            preload(client, keys)
+            start = time.perf_counter()
+            for i in range(reads):
+                client.getVal(keys[i % nkeys])
+            results[(mode, "blocking")] = reads / (time.perf_counter() - start)
+            for inflight in concurrency:
+                results[(mode, inflight)] = asyncio.run(drive(inflight))
+        finally:
+            stop_service(proc)
+
+    print("{:>10} {:>10} {:>10}".format("server", "in flight", "reads/s"))
+    for mode in modes:
+        print(
+            "{:>10} {:>10} {:>10.1f}".format(
+                mode, "blocking", results[(mode, "blocking")]
+            )
+        )
+        for inflight in concurrency:
+            print(
+                "{:>10} {:>10} {:>10.1f}".format(
+                    mode, inflight, results[(mode, inflight)]
+                )
+            )
+    return results
+
+
+def bench_cache(value_size: int, nkeys: int, reads: int, port: int):
+    """
+    Repeated reads of unchanged keys, and of a listing of all of them,
+    without a cache, with a revalidating cache, and with max_staleness.
+    """
+    keys = ["bench/cache{}".format(i) for i in range(nkeys)]
+    proc = start_service(port)
+    authority = "127.0.0.1:{}".format(port)
+    setups = [
+        ("none", {}),
+        ("etag", {"cache_size": nkeys}),
+        ("stale 1s", {"cache_size": nkeys, "max_staleness": 1}),
+    ]
+    results = {}
+    try:
+        loader = kvs_client.HttpKVSClient(authority)
+        for i in range(0, nkeys, 1000):
+            loader.setVals({k: "x" * value_size for k in keys[i : i + 1000]})
+
+        for name, opts in setups:
+            client = kvs_client.HttpKVSClient(authority, **opts)
+            rng = random.Random(1)
+            start = time.perf_counter()
+            for _ in range(reads):
+                client.getVal(rng.choice(keys))
+            get_rate = reads / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(20):
+                client.listAll()
+            list_ms = (time.perf_counter() - start) / 20 * 1000
+            results[name] = (get_rate, list_ms)
+            client.close()
+    finally:
+        stop_service(proc)
+
+    print("{:>10} {:>10} {:>12}".format("cache", "gets/s", "listall ms"))
+    for name, _ in setups:
+        get_rate, list_ms = results[name]
+        print("{:>10} {:>10.1f} {:>12.2f}".format(name, get_rate, list_ms))
+    return results
+
+
+def process_rss_mb(pid: int) -> float:
+    """Resident set size from /proc, 0 where that isn't available"""
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0
+
+
+def bench_soak(
+    duration_s: float, ttl: float, cap_mb: float, port: int, interval_s: float = 10
+):
+    """
+    Device status style churn: every key name is new, half are written with
+    ttl and the other half never expire. Without a memory cap the permanent
+    half grows forever; with one, memory should level off at the cap while
+    evictions climb. A fixed set of heartbeat keys is rewritten with ttl
+    every round too, the expiry heap ("queued") shouldn't grow from it.
+    Prints a sample row every interval_s.
+    """
+    env = {"KVS_MEMORY_CAP_MB": str(cap_mb)} if cap_mb else {}
+    proc = start_service(port, env)
+    client = kvs_client.HttpKVSClient("127.0.0.1:{}".format(port))
+    print(
+        "{:>8} {:>9} {:>10} {:>8} {:>9} {:>9} {:>9}".format(
+            "elapsed", "keys", "est MB", "rss MB", "expired", "evicted", "queued"
+        )
+    )
+    start = time.time()
+    next_sample = start
+    serial = 0
+    try:
+        while True:
+            now = time.time()
+            if now >= next_sample:
+                stats = client.stats()
+                print(
+                    "{:>8.0f} {:>9} {:>10.1f} {:>8.1f} {:>9} {:>9} {:>9}".format(
+                        now - start,
+                        stats["keys"],
+                        stats["memory"] / 1024 / 1024,
+                        process_rss_mb(proc.pid),
+                        stats["expired"],
+                        stats["evicted"],
+                        stats["pending_expiry"],
+                    ),
+                    flush=True,
+                )
+                next_sample += interval_s
+                if now - start >= duration_s:
+                    break
+            batch = {"soak/ttl/{}".format(serial + i): "up" for i in range(100)}
+            client.setVals(batch, ttl)
+            batch = {"soak/perm/{}".format(serial + i): "up" for i in range(100)}
+            client.setVals(batch)
+            batch = {"soak/beat/{}".format(i): "up" for i in range(100)}
+            client.setVals(batch, ttl)
+            serial += 100
+    finally:
+        stop_service(proc)
+
+
+def bench_watchers(nwatchers: int, port: int, mode: str = "asyncio"):
+    """
+    Park nwatchers long-polls on one prefix, then time how long a single
+    set takes to reach all of them.
+    """
+    proc = start_service(port, {"KVS_SERVER": mode})
+    client = kvs_client.HttpKVSClient("127.0.0.1:{}".format(port))
+    request = b"GET /watch?prefix=bench/watch/&timeout=60 HTTP/1.1\r\n\r\n"
+
+    async def park(parked: list):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request)
+        await writer.drain()
+        parked.append(1)
+        await reader.readuntil(b"\r\n\r\n")
+        done = time.perf_counter()
+        writer.close()
+        return done
+
+    async def run():
+        parked = []
+        tasks = [asyncio.create_task(park(parked)) for _ in range(nwatchers)]
+        while len(parked) < nwatchers:
+            await asyncio.sleep(0.05)
+        # Give the server a moment to register the last of them
+        await asyncio.sleep(1)
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(
+            None, client.setVal, "bench/watch/key", "1"
+        )
+        done = await asyncio.gather(*tasks)
+        return start, done
+
+    try:
+        start, done = asyncio.run(run())
+    finally:
+        stop_service(proc)
+
+    spread = sorted(t - start for t in done)
+    print(
+        "{} watchers ({}): first woken {:.1f} ms, last {:.1f} ms".format(
+            nwatchers, mode, spread[0] * 1000, spread[-1] * 1000
+        )
+    )
+    return spread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KVS server throughput comparison")
+    parser.add_argument("--modes", default="single,threaded,asyncio")
+    parser.add_argument("--clients", default="1,8,64")
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=int(os.getenv("KVS_PORT", 9091)))
+    parser.add_argument(
+        "--batch",
+        default="",
+        help="e.g. 1,10,100,1000 to run the batch benchmark instead",
+    )
+    parser.add_argument(
+        "--durability",
+        default="",
+        help="e.g. always,batch,never to run the WAL benchmark instead",
+    )
+    parser.add_argument(
+        "--watchers",
+        type=int,
+        default=0,
+        help="park this many watches and time a change reaching them",
+    )
+    parser.add_argument(
+        "--shards",
+        default="",
+        help="e.g. 1,2,4,8 to run the sharding benchmark instead",
+    )
+    parser.add_argument(
+        "--client-procs",
+        type=int,
+        default=8,
+        help="client processes for the sharding benchmark",
+    )
+    parser.add_argument(
+        "--contention",
+        default="",
+        help="e.g. 1,4,16 threads bumping one counter, instead",
+    )
+    parser.add_argument(
+        "--soak",
+        type=float,
+        default=0,
+        help="seconds of key churn with ttls (e.g. 86400), instead",
+    )
+    parser.add_argument("--soak-ttl", type=float, default=60)
+    parser.add_argument("--soak-cap-mb", type=float, default=64)
+    parser.add_argument(
+        "--cache",
+        type=int,
+        default=0,
+        help="value size in bytes for the client cache benchmark, instead",
+    )
+    parser.add_argument(
+        "--async-inflight",
+        default="",
+        help="e.g. 1,16,128 to time the asyncio client at those depths, instead",
+    )
+    args = parser.parse_args()
+
+    if args.async_inflight:
+        depths = [int(d) for d in args.async_inflight.split(",")]
+        modes = args.modes.split(",")
+        modes = [m for m in modes if m != "single"]
+        bench_async(modes, depths, args.keys * 10, args.keys, args.port)
+        sys.exit(0)
+
+    if args.cache:
+        bench_cache(args.cache, args.keys, args.keys * 5, args.port)
+        sys.exit(0)
+
+    if args.soak:
+        interval = max(args.soak / 20, 1)
+        bench_soak(args.soak, args.soak_ttl, args.soak_cap_mb, args.port, interval)
+        sys.exit(0)
+
+    if args.contention:
+        counts = [int(c) for c in args.contention.split(",")]
+        bench_contention(counts, args.keys // 2, args.port)
+        sys.exit(0)
+
+    if args.shards:
+        counts = [int(c) for c in args.shards.split(",")]
+        nclients = int(args.clients.split(",")[0])
+        bench_shards(
+            counts, args.client_procs, nclients, args.duration, args.keys, args.port
+        )
+        sys.exit(0)
+
+    if args.watchers:
+        bench_watchers(args.watchers, args.port)
+        sys.exit(0)
+
+    if args.durability:
+        policies = args.durability.split(",")
+        bench_durability(policies, 8, args.duration, args.keys * 100, args.port)
+        sys.exit(0)
+
+    if args.batch:
+        bench_batch([int(b) for b in args.batch.split(",")], args.keys * 10, args.port)
+        sys.exit(0)
+
+    bench_modes(
+        args.modes.split(","),
+        [int(c) for c in args.clients.split(",")],
+        args.duration,
+        args.keys,
+        args.port,
+    )
@@ -14,69 +14,746 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import bisect
+import concurrent.futures
+import hashlib
+import http.client
 import json
-import urllib.error
+import threading
+import time
 import urllib.parse
-import urllib.request
+from collections import OrderedDict
+
+"Seconds before giving up on a connect or a response"
+DEFAULT_TIMEOUT = 10
+
+"Read timeout for watch requests, has to outlast the server's longest watch"
+WATCH_TIMEOUT = 330
+
+"Idle connections kept around per client, extras get closed on release"
+DEFAULT_POOL_SIZE = 8
+
+"Pause between attempts while a replicated cluster elects a leader"
+CLUSTER_RETRY_S = 0.05
+
+"Points each shard gets on the hash ring, more evens out the key split"
+DEFAULT_VNODES = 160
+
+"Read operations whose answers carry an ETag and can be cached"
+CACHEABLE_PATHS = ("/get", "/listall")
+
+"Writes that mustn't be sent again once the server may have seen them"
+NOT_IDEMPOTENT_PATHS = ("/cas", "/incr", "/add")
+
+"""
+Those writes only go out on a pooled connection idle for less than this,
+well inside the server's IDLE_TIMEOUT_S, older ones may be closed already
+"""
+FRESH_CONNECTION_S = 0.5
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections to one authority.
+    Connections are checked out for a single request/response at a time.
+    idle holds (connection, time it was released), newest last.
+    """
+
+    __slots__ = "authority", "timeout", "max_idle", "idle", "lock"
+
+    def __init__(
+        self,
+        authority: str,
+        max_idle: int = DEFAULT_POOL_SIZE,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        self.authority = authority
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, max_idle_s: float = None) -> tuple:
+        """
+        Returns (connection, reused). Most recently used goes out first.
+        With max_idle_s, pooled connections idle longer than that are closed
+        and a new one is opened instead.
+        """
+        stale = []
+        with self.lock:
+            if self.idle and max_idle_s is not None:
+                if time.time() - self.idle[-1][1] > max_idle_s:
+                    # The rest were released earlier still
+                    stale, self.idle = self.idle, []
+            if self.idle:
+                return self.idle.pop()[0], True
+        for conn, _ in stale:
+            conn.close()
+        return http.client.HTTPConnection(self.authority, timeout=self.timeout), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            conns, self.idle = self.idle, []
+        for conn, _ in conns:
+            conn.close()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: bytes = None,
+        headers: dict = None,
+        retry: bool = True,
+    ):
+        """
+        Send a request, returns (status, headers, body).
+        A pooled connection may have been closed by the server while idle,
+        in that case the request is retried once on a fresh connection.
+        The server may also have died after carrying it out, so retry=False
+        raises instead, for requests that can't safely run twice. Those
+        don't get a connection that may have idled out, see
+        FRESH_CONNECTION_S.
+        """
+        conn, reused = self.acquire(None if retry else FRESH_CONNECTION_S)
+        while True:
+            try:
+                conn.request(method, url, body=body, headers=headers or {})
+                res = conn.getresponse()
+                data = res.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as e:
+                conn.close()
+                if not reused or not retry:
+                    raise e
+                conn = http.client.HTTPConnection(self.authority, timeout=self.timeout)
+                reused = False
+            except OSError as e:
+                # timeouts and such, connection state is unknown
+                conn.close()
+                raise e
+
+        if res.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        return res.status, res.headers, data
+
+
+class ResponseCache:
+    """
+    Bounded LRU of read responses by URL, each kept with its ETag.
+    A cached entry is revalidated with If-None-Match, so a hit costs a
+    round trip but no body. Entries validated less than max_staleness
+    seconds ago are served without asking the server at all.
+    hits/revalidated/misses count how reads were answered.
+    """
+
+    __slots__ = (
+        "capacity",
+        "max_staleness",
+        "entries",
+        "lock",
+        "hits",
+        "revalidated",
+        "misses",
+    )
+
+    def __init__(self, capacity: int, max_staleness: float = None):
+        self.capacity = capacity
+        self.max_staleness = max_staleness
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def lookup(self, url: str) -> tuple:
+        """Returns (etag, data, fresh) or None"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            self.entries.move_to_end(url)
+            etag, data, checked = entry
+        fresh = (
+            self.max_staleness is not None
+            and time.monotonic() - checked < self.max_staleness
+        )
+        return etag, data, fresh
+
+    def store(self, url: str, etag: str, data: bytes):
+        with self.lock:
+            self.entries[url] = (etag, data, time.monotonic())
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def forget(self, url: str):
+        with self.lock:
+            self.entries.pop(url, None)
 
 
 class HttpKVSClient:
-    """Makes http requests to kvs service"""
+    """
+    Makes http requests to kvs service.
+    Keeps no per-call state so one instance can be shared between threads.
 
-    __slots__ = "uri_host", "uri_path", "uri_query"
+    With cache_size set, getVal and listAll answers are kept in a
+    ResponseCache and revalidated by ETag. max_staleness (seconds) lets
+    cached answers be used without a request for that long, reads may then
+    miss other clients' writes for up to that long. Writes made through this
+    client drop its cached getVal of the key.
+    """
 
-    def __init__(self, host):
+    __slots__ = "uri_host", "pool", "watchpool", "cache"
+
+    def __init__(self, host, cache_size: int = 0, max_staleness: float = None):
         self.uri_host = host
-        self.uri_path = ""
-        self.uri_query = ""
+        self.pool = ConnectionPool(host)
+        # Watches park on the server, keep them off the normal connections
+        self.watchpool = ConnectionPool(host, timeout=WATCH_TIMEOUT)
+        self.cache = None
+        if cache_size:
+            self.cache = ResponseCache(cache_size, max_staleness)
 
     def notImplemented(self, fname):
         """Generate a response for something not implemented yet"""
         return {"error": "not implemented"}
 
-    def do_rpc(self) -> str:
-        """Put together a URI and load it"""
-        url = "http://" + self.uri_host + self.uri_path + "?" + self.uri_query
+    def close(self):
+        """Drop pooled connections"""
+        self.pool.close()
+        self.watchpool.close()
+
+    def forget(self, key: str):
+        """Drop the cached getVal of key, if caching"""
+        if self.cache is not None:
+            self.cache.forget("/get?key=" + urllib.parse.quote_plus(key))
+
+    def do_rpc(
+        self, path: str, query: str = "", body: dict = None, pool=None
+    ) -> object:
+        """Put together a URI and load it, POSTing body as JSON if given"""
+        url = path + "?" + query
+        pool = pool or self.pool
+        cache = self.cache if body is None and path in CACHEABLE_PATHS else None
+        cached = cache.lookup(url) if cache is not None else None
+        retry = path not in NOT_IDEMPOTENT_PATHS
+        if cached is not None and cached[2]:
+            cache.hits += 1
+            return json.loads(cached[1])
+
         try:
-            res = urllib.request.urlopen(url)
-        except urllib.error.HTTPError as e:
-            return {"error": "Resource not found (key missing)"}
+            if body is None:
+                hdrs = {"If-None-Match": cached[0]} if cached else None
+                status, headers, data = pool.request("GET", url, None, hdrs, retry)
+            else:
+                payload = bytes(json.dumps(body), "utf-8")
+                hdrs = {"Content-Type": "application/json"}
+                status, headers, data = pool.request("POST", url, payload, hdrs, retry)
         except Exception as e:
             print("warn: unexpected exception: {}".format(str(e)))
             return {"error": "unexpected exception"}
 
-        # Expext single line json value
-        ret = json.loads([line for line in res][0])
+        if cache is not None:
+            if status == 304 and cached is not None:
+                cache.revalidated += 1
+                cache.store(url, cached[0], cached[1])
+                return json.loads(cached[1])
+            if status == 200 and headers.get("ETag"):
+                cache.misses += 1
+                cache.store(url, headers["ETag"], data)
+            else:
+                cache.forget(url)
+
+        if status == 404:
+            return {"error": "Resource not found (key missing)"}
+        if status != 200:
+            # Replicated nodes explain why, e.g. {"error": "not leader", ...}
+            try:
+                doc = json.loads(data)
+            except ValueError:
+                doc = None
+            if isinstance(doc, dict) and "error" in doc:
+                return doc
+            return {"error": "http status {}".format(status)}
+
+        # Expect a single json value
+        return json.loads(data)
 
     def getVal(self, key: str) -> object:
         """Get a value"""
-        self.uri_path = "/get"
         key = urllib.parse.quote_plus(key)
-        self.uri_query = "key={}".format(key)
-        return self.do_rpc()
+        return self.do_rpc("/get", "key={}".format(key))
 
-    def setVal(self, key: str, val: str) -> object:
-        """Set a value"""
-        self.uri_path = "/set"
+    def setVal(self, key: str, val: str, ttl: float = None) -> object:
+        """Set a value, gone after ttl seconds if given"""
+        self.forget(key)
         key = urllib.parse.quote_plus(key)
         val = urllib.parse.quote_plus(val)
-        self.uri_query = "key={}&value={}".format(key, val)
-        return self.do_rpc()
+        query = "key={}&value={}".format(key, val)
+        if ttl is not None:
+            query += "&ttl={}".format(ttl)
+        return self.do_rpc("/set", query)
 
     def delVal(self, key: str) -> object:
         """Delete a value"""
-        self.uri_path = "/delete"
+        self.forget(key)
+        key = urllib.parse.quote_plus(key)
+        return self.do_rpc("/delete", "key={}".format(key))
+
+    def casVal(self, key: str, val: str, version: int, ttl: float = None) -> object:
+        """
+        Set only if key is still at version (-1: doesn't exist yet).
+        On a mismatch returns {"error": "version mismatch", "version": current}
+        """
+        self.forget(key)
+        key = urllib.parse.quote_plus(key)
+        val = urllib.parse.quote_plus(val)
+        query = "key={}&value={}&version={}".format(key, val, version)
+        if ttl is not None:
+            query += "&ttl={}".format(ttl)
+        return self.do_rpc("/cas", query)
+
+    def incrVal(self, key: str, by: int = 1) -> object:
+        """Atomically add an integer, returns {"value", "version"}"""
+        self.forget(key)
+        key = urllib.parse.quote_plus(key)
+        return self.do_rpc("/incr", "key={}&by={}".format(key, by))
+
+    def addVal(self, key: str, delta) -> object:
+        """Atomically add a number, int or float, returns {"value", "version"}"""
+        self.forget(key)
         key = urllib.parse.quote_plus(key)
-        self.uri_query = "key={}".format(key)
-        return self.do_rpc()
+        delta = urllib.parse.quote_plus(repr(delta))
+        return self.do_rpc("/add", "key={}&delta={}".format(key, delta))
 
-    def listAll(self, keyregex: str = ""):
-        """Return all values in table.
-        Server doesn't support filter yet
+    def listAll(
+        self,
+        keyregex: str = "",
+        prefix: str = "",
+        limit: int = None,
+        cursor: str = None,
+        seq: int = None,
+        epoch: str = None,
+    ):
+        """Return values in table, filtered server side by prefix and regex.
+        With limit set returns one page: {"entries": {...}, "cursor": ...,
+        "seq": ..., "epoch": ...}. seq/epoch of an earlier page list the
+        table as of that page.
         """
-        if keyregex != "":
-            print('warn: ignoring listAll regex "{}"'.format(keyregex))
-        self.uri_path = "/listall"
         encodedexp = urllib.parse.quote_plus(keyregex)
-        self.uri_query = "filter={}".format(encodedexp)
-        return self.do_rpc()
+        query = "filter={}".format(encodedexp)
+        if prefix:
+            query += "&prefix={}".format(urllib.parse.quote_plus(prefix))
+        if limit is not None:
+            query += "&limit={}".format(limit)
+        if cursor is not None:
+            query += "&cursor={}".format(urllib.parse.quote_plus(cursor))
+        if seq is not None:
+            query += "&seq={}&epoch={}".format(seq, epoch)
+        return self.do_rpc("/listall", query)
+
+    def scan(self, prefix: str = "", keyregex: str = "", page_size: int = 1000):
+        """
+        Iterate over (key, {"value", "version"}) a page at a time, every
+        page from the snapshot the first one was taken at, unless the
+        server can't go back that far any more.
+        """
+        cursor = None
+        seq = epoch = None
+        while True:
+            page = self.listAll(keyregex, prefix, page_size, cursor, seq, epoch)
+            if seq is not None and page.get("error") == "snapshot expired":
+                # Writes outran the change log, carry on from a newer one
+                seq = epoch = None
+                continue
+            if "error" in page:
+                return
+            yield from page["entries"].items()
+            cursor, seq, epoch = page["cursor"], page["seq"], page["epoch"]
+            if cursor is None:
+                return
+
+    def snapshot(self, keys: list, seq: int = None, epoch: str = None) -> dict:
+        """
+        Several values as of one table revision, returns {"seq", "epoch",
+        "entries": {key: {"value", "version"}}} with missing keys left out.
+        seq/epoch of an earlier answer read as of that revision again.
+        """
+        body = {"keys": list(keys)}
+        if seq is not None:
+            body["seq"], body["epoch"] = seq, epoch
+        return self.do_rpc("/snapshot", body=body)
+
+    def getVals(self, keys: list) -> dict:
+        """Get several values in one round trip, missing keys are left out"""
+        return self.do_rpc("/mget", body={"keys": list(keys)})
+
+    def setVals(self, items: dict, ttl: float = None) -> dict:
+        """Set several values in one round trip, returns {"versions": {key: ver}}"""
+        if self.cache is not None:
+            for key in items:
+                self.forget(key)
+        body = {"items": {k: str(v) for k, v in items.items()}}
+        if ttl is not None:
+            body["ttl"] = ttl
+        return self.do_rpc("/mset", body=body)
+
+    def delVals(self, keys: list) -> dict:
+        """Delete several values in one round trip, returns {"lastversions": ...}"""
+        keys = list(keys)
+        if self.cache is not None:
+            for key in keys:
+                self.forget(key)
+        return self.do_rpc("/mdelete", body={"keys": keys})
+
+    def watch(
+        self,
+        key: str = None,
+        prefix: str = None,
+        since: int = None,
+        timeout: float = 30,
+    ):
+        """
+        Iterate over changes to key, or to keys under prefix, as they happen.
+        Yields {key: {"value", "version"} or None} for each batch of changes.
+        since is a version for key watches and a table revision for prefix
+        watches, by default only changes from now on are reported.
+        Stops if the server reports an error.
+        """
+        if key is not None:
+            query = "key={}".format(urllib.parse.quote_plus(key))
+        else:
+            query = "prefix={}".format(urllib.parse.quote_plus(prefix))
+        query += "&timeout={}".format(timeout)
+
+        while True:
+            q = query if since is None else query + "&since={}".format(since)
+            res = self.do_rpc("/watch", q, pool=self.watchpool)
+            if "error" in res:
+                return
+            since = res["version"] if key is not None else res["revision"]
+            if res["changes"]:
+                yield res["changes"]
+
+    def stats(self) -> dict:
+        """Key count, estimated memory, expired and evicted counts"""
+        return self.do_rpc("/stats")
+
+    def expiries(self, keys: list) -> dict:
+        """{key: seconds left, 0 for never} for the keys that exist"""
+        return self.do_rpc("/expiries", body={"keys": list(keys)})
+
+    def changes(self, since: int, epoch: str = None, limit: int = None) -> dict:
+        """Raw change feed, see VersionedHash.changes"""
+        query = "since={}".format(since)
+        if epoch is not None:
+            query += "&epoch={}".format(epoch)
+        if limit is not None:
+            query += "&limit={}".format(limit)
+        return self.do_rpc("/changes", query)
+
+
+class KVSMirror:
+    """
+    Local copy of the KVS kept current with the change feed. Catching up
+    costs O(changes), a full listing is only pulled on the first sync or
+    when the server says the feed can't cover the gap.
+    """
+
+    __slots__ = "client", "table", "epoch", "seq"
+
+    def __init__(self, client: HttpKVSClient):
+        self.client = client
+        self.table = {}
+        self.epoch = None
+        self.seq = 0
+
+    def sync(self) -> int:
+        """Pull everything new, returns how many changes were applied"""
+        applied = 0
+        while True:
+            res = self.client.changes(self.seq, self.epoch)
+            if "error" in res:
+                raise RuntimeError("change feed: {}".format(res["error"]))
+
+            if res.get("reset"):
+                # Listing is taken after seq was read, replaying the feed
+                # from seq on top of it is safe
+                self.epoch, self.seq = res["epoch"], res["seq"]
+                self.table = self.client.listAll()
+                applied += len(self.table)
+                continue
+
+            for change in res["changes"]:
+                if change["entry"] is None:
+                    self.table.pop(change["key"], None)
+                else:
+                    self.table[change["key"]] = change["entry"]
+            applied += len(res["changes"])
+            if res["seq"] == self.seq:
+                return applied
+            self.seq = res["seq"]
+
+
+class ClusterKVSClient:
+    """
+    Client for a raft replicated KVS (see kvs_raft.py), takes every node's
+    authority. Writes go to the leader, found by following the hint a
+    follower answers with. Reads are spread round robin over all nodes, a
+    node that can't vouch for its freshness refuses and the read is retried
+    on the leader. Requests keep being retried through an election for up
+    to retry_s seconds.
+
+    A set/delete whose node died before answering is retried too, so it
+    may be applied twice, harmless except for the version. cas/incr/add
+    aren't: once the request may have reached a node, the error is
+    returned instead, only a "not leader" refusal is retried.
+    """
+
+    __slots__ = "hosts", "clients", "leader", "nextread", "retry_s"
+
+    def __init__(self, hosts: list, retry_s: float = 10):
+        self.hosts = list(hosts)
+        self.clients = {h: HttpKVSClient(h) for h in self.hosts}
+        self.leader = self.hosts[0]
+        self.nextread = 0
+        self.retry_s = retry_s
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+    def getVal(self, key: str) -> object:
+        return self.read("getVal", key)
+
+    def setVal(self, key: str, val: str, ttl: float = None) -> object:
+        return self.write("setVal", key, val, ttl)
+
+    def delVal(self, key: str) -> object:
+        return self.write("delVal", key)
+
+    def casVal(self, key: str, val: str, version: int, ttl: float = None) -> object:
+        return self.write("casVal", key, val, version, ttl)
+
+    def incrVal(self, key: str, by: int = 1) -> object:
+        return self.write("incrVal", key, by)
+
+    def addVal(self, key: str, delta) -> object:
+        return self.write("addVal", key, delta)
+
+    def listAll(self, *args) -> object:
+        return self.read("listAll", *args)
+
+    def getVals(self, keys: list) -> dict:
+        return self.read("getVals", keys)
+
+    def snapshot(self, *args) -> dict:
+        return self.read("snapshot", *args)
+
+    def setVals(self, items: dict, ttl: float = None) -> dict:
+        return self.write("setVals", items, ttl)
+
+    def delVals(self, keys: list) -> dict:
+        return self.write("delVals", keys)
+
+    # not public interface
+    def write(self, fname: str, *args):
+        retryable = ("not leader", "unavailable", "unexpected exception")
+        if fname in ("casVal", "incrVal", "addVal"):
+            retryable = ("not leader",)
+        deadline = time.time() + self.retry_s
+        while True:
+            res = getattr(self.clients[self.leader], fname)(*args)
+            error = res.get("error") if isinstance(res, dict) else None
+            if error not in retryable:
+                return res
+            if time.time() >= deadline:
+                return res
+
+            hint = res.get("leader")
+            if hint in self.clients and hint != self.leader:
+                self.leader = hint
+                continue
+            if error != "unavailable":
+                # Node is gone or mid election, try the next one
+                at = self.hosts.index(self.leader)
+                self.leader = self.hosts[(at + 1) % len(self.hosts)]
+            time.sleep(CLUSTER_RETRY_S)
+
+    def read(self, fname: str, *args):
+        host = self.hosts[self.nextread % len(self.hosts)]
+        self.nextread += 1
+        res = getattr(self.clients[host], fname)(*args)
+        error = res.get("error") if isinstance(res, dict) else None
+        if error in ("unavailable", "unexpected exception"):
+            return self.write(fname, *args)
+        return res
+
+
+def ring_hash(name: str) -> int:
+    """Stable across processes, unlike hash()"""
+    return int.from_bytes(hashlib.md5(bytes(name, "utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto shard authorities. Each shard owns
+    vnodes points on the ring and a key belongs to the first point at or
+    after its hash. Adding or removing a shard only moves the keys between
+    its points and their predecessors, about 1/N of them.
+    """
+
+    __slots__ = "points", "owners"
+
+    def __init__(self, hosts: list, vnodes: int = DEFAULT_VNODES):
+        ring = sorted(
+            (ring_hash("{}#{}".format(host, i)), host)
+            for host in hosts
+            for i in range(vnodes)
+        )
+        self.points = [point for point, _ in ring]
+        self.owners = [host for _, host in ring]
+
+    def lookup(self, key: str) -> str:
+        """Authority of the shard holding key"""
+        at = bisect.bisect_left(self.points, ring_hash(key))
+        return self.owners[at % len(self.owners)]
+
+    def split(self, keys) -> dict:
+        """Group keys by shard, {authority: [key, ...]}"""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.lookup(key), []).append(key)
+        return groups
+
+
+class ShardedKVSClient:
+    """
+    Spreads keys over several independent kvs_service processes with a
+    HashRing. Single key operations go to the owning shard, batches and
+    listings fan out to the shards involved in parallel and the results
+    are merged into the same shapes HttpKVSClient returns.
+
+    Shards share nothing, a batch isn't atomic across them. If any shard
+    fails its error is returned for the whole call.
+    """
+
+    __slots__ = "hosts", "ring", "clients", "executor"
+
+    def __init__(self, hosts: list, vnodes: int = DEFAULT_VNODES):
+        self.hosts = list(hosts)
+        self.ring = HashRing(self.hosts, vnodes)
+        self.clients = {h: HttpKVSClient(h) for h in self.hosts}
+        self.executor = concurrent.futures.ThreadPoolExecutor(len(self.hosts))
+
+    def close(self):
+        self.executor.shutdown()
+        for client in self.clients.values():
+            client.close()
+
+    def shard(self, key: str) -> HttpKVSClient:
+        """Client for the shard holding key"""
+        return self.clients[self.ring.lookup(key)]
+
+    def getVal(self, key: str) -> object:
+        return self.shard(key).getVal(key)
+
+    def setVal(self, key: str, val: str, ttl: float = None) -> object:
+        return self.shard(key).setVal(key, val, ttl)
+
+    def delVal(self, key: str) -> object:
+        return self.shard(key).delVal(key)
+
+    def casVal(self, key: str, val: str, version: int, ttl: float = None) -> object:
+        return self.shard(key).casVal(key, val, version, ttl)
+
+    def incrVal(self, key: str, by: int = 1) -> object:
+        return self.shard(key).incrVal(key, by)
+
+    def addVal(self, key: str, delta) -> object:
+        return self.shard(key).addVal(key, delta)
+
+    def getVals(self, keys: list) -> dict:
+        calls = {h: ("getVals", (ks,)) for h, ks in self.ring.split(keys).items()}
+        return self.merge(self.fanout(calls))
+
+    def setVals(self, items: dict, ttl: float = None) -> dict:
+        calls = {
+            h: ("setVals", ({k: items[k] for k in ks}, ttl))
+            for h, ks in self.ring.split(items).items()
+        }
+        return self.merge(self.fanout(calls), "versions")
+
+    def delVals(self, keys: list) -> dict:
+        calls = {h: ("delVals", (ks,)) for h, ks in self.ring.split(keys).items()}
+        return self.merge(self.fanout(calls), "lastversions")
+
+    def listAll(
+        self,
+        keyregex: str = "",
+        prefix: str = "",
+        limit: int = None,
+        cursor: str = None,
+    ):
+        """
+        Same as HttpKVSClient.listAll over every shard, in key order.
+        A page asks each shard for up to limit keys after cursor and keeps
+        the lowest limit of them, so pages line up across shards.
+        """
+        args = (keyregex, prefix, limit, cursor)
+        results = self.fanout({h: ("listAll", args) for h in self.hosts})
+        for res in results:
+            if "error" in res:
+                return res
+
+        if limit is None:
+            return dict(sorted(kv for res in results for kv in res.items()))
+
+        merged = sorted(kv for res in results for kv in res["entries"].items())
+        more = len(merged) > limit or any(r["cursor"] is not None for r in results)
+        page = merged[:limit]
+        next_cursor = page[-1][0] if more and page else None
+        return {"cursor": next_cursor, "entries": dict(page)}
+
+    def scan(self, prefix: str = "", keyregex: str = "", page_size: int = 1000):
+        """Iterate over (key, {"value", "version"}) a page at a time"""
+        cursor = None
+        while True:
+            page = self.listAll(keyregex, prefix, page_size, cursor)
+            if "error" in page:
+                return
+            yield from page["entries"].items()
+            cursor = page["cursor"]
+            if cursor is None:
+                return
+
+    # not public interface
+    def fanout(self, calls: dict) -> list:
+        """Run {authority: (method, args)} concurrently, results in any order"""
+        if len(calls) == 1:
+            # Skip the thread handoff
+            ((host, (fname, args)),) = calls.items()
+            return [getattr(self.clients[host], fname)(*args)]
+        futures = [
+            self.executor.submit(getattr(self.clients[h], fname), *args)
+            for h, (fname, args) in calls.items()
+        ]
+        return [f.result() for f in futures]
+
+    def merge(self, results: list, field: str = None) -> dict:
+        """Combine per shard maps, or the map under field in each result"""
+        merged = {}
+        for res in results:
+            if "error" in res:
+                return res
+            merged.update(res[field] if field else res)
+        return {field: merged} if field else merged
@@ -0,0 +1,398 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+import bisect
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import string
+import sys
+import threading
+import time
+
+import kvs_bench
+import kvs_client
+
+"""
+Drives a configurable workload against kvs_service.py and reports throughput
+and latency percentiles per concurrency level, optionally as JSON. A stored
+JSON result can be given as a baseline, the run then exits 1 if throughput
+or tail latency got worse than the tolerance allows.
+
+Latency is measured in the client, request written to answer parsed, so it
+includes the client's own GIL. Use --client-procs to spread high client
+counts over several processes.
+"""
+
+"Percentiles reported for every run, p100 is reported as max"
+PERCENTILES = (50, 95, 99)
+
+"Relative change in throughput or p99 that counts as a regression"
+DEFAULT_TOLERANCE = 0.15
+
+"http.server and asyncio both cap a request line near 64 KiB, sets go in it"
+MAX_VALUE_SIZE = 60000
+
+
+class Workload:
+    """
+    What every client does: gets and sets in read_ratio proportion over
+    nkeys keys of value_size byte values. Keys are picked uniformly or
+    zipfian with exponent zipf_s, hot ranks scattered over the key space so
+    they don't all sort next to each other.
+    """
+
+    __slots__ = "read_ratio", "nkeys", "value_size", "skew", "zipf_s", "cdf", "order"
+
+    def __init__(
+        self,
+        read_ratio: float = 0.9,
+        nkeys: int = 10000,
+        value_size: int = 100,
+        skew: str = "uniform",
+        zipf_s: float = 0.99,
+    ):
+        if skew not in ("uniform", "zipf"):
+            raise ValueError("skew is uniform or zipf, not {}".format(skew))
+        self.read_ratio = read_ratio
+        self.nkeys = nkeys
+        self.value_size = value_size
+        self.skew = skew
+        self.zipf_s = zipf_s
+
+        self.cdf = None
+        if skew == "zipf":
+            total = 0.0
+            self.cdf = []
+            for rank in range(nkeys):
+                total += 1.0 / (rank + 1) ** zipf_s
+                self.cdf.append(total)
+        self.order = list(range(nkeys))
+        random.Random(0).shuffle(self.order)
+
+    def key(self, index: int) -> str:
+        return "load/key{:08d}".format(index)
+
+    def keys(self) -> list:
+        return [self.key(i) for i in range(self.nkeys)]
+
+    def pick(self, rng: random.Random) -> str:
+        if self.cdf is None:
+            return self.key(rng.randrange(self.nkeys))
+        rank = bisect.bisect_left(self.cdf, rng.random() * self.cdf[-1])
+        return self.key(self.order[min(rank, self.nkeys - 1)])
+
+    def value(self, rng: random.Random) -> str:
+        return "".join(rng.choices(string.ascii_letters, k=self.value_size))
+
+    def describe(self) -> dict:
+        desc = {
+            "read_ratio": self.read_ratio,
+            "keys": self.nkeys,
+            "value_size": self.value_size,
+            "skew": self.skew,
+        }
+        if self.skew == "zipf":
+            desc["zipf_s"] = self.zipf_s
+        return desc
+
+
+def preload(authority: str, workload: Workload, batch: int = 500):
+    """Give every key a value so gets never miss"""
+    client = kvs_client.HttpKVSClient(authority)
+    rng = random.Random(1)
+    value = workload.value(rng)
+    keys = workload.keys()
+    for i in range(0, len(keys), batch):
+        client.setVals({k: value for k in keys[i : i + batch]})
+    client.close()
+
+
+def drive(
+    authority: str,
+    workload: Workload,
+    nclients: int,
+    seed: int,
+    begin: float,
+    measure_from: float,
+    stop_at: float,
+) -> dict:
+    """
+    nclients threads from begin to stop_at (time.time()), ops completed
+    after measure_from are recorded. Returns {"get": [s], "set": [s],
+    "errors": n}. Runs in a client process of its own under --client-procs.
+    """
+    samples = {"get": [], "set": [], "errors": 0}
+    lock = threading.Lock()
+
+    def worker(slot: int):
+        rng = random.Random(seed * 10007 + slot)
+        client = kvs_client.HttpKVSClient(authority)
+        value = workload.value(rng)
+        gets, sets, errors = [], [], 0
+        time.sleep(max(begin - time.time(), 0))
+        while True:
+            key = workload.pick(rng)
+            reading = rng.random() < workload.read_ratio
+            start = time.perf_counter()
+            if reading:
+                resp = client.getVal(key)
+            else:
+                resp = client.setVal(key, value)
+            elapsed = time.perf_counter() - start
+            now = time.time()
+            if now >= stop_at:
+                break
+            if now < measure_from:
+                continue
+            if "error" in resp:
+                errors += 1
+            elif reading:
+                gets.append(elapsed)
+            else:
+                sets.append(elapsed)
+        client.close()
+        with lock:
+            samples["get"].extend(gets)
+            samples["set"].extend(sets)
+            samples["errors"] += errors
+
+    threads = [threading.Thread(target=worker, args=[i]) for i in range(nclients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+def summarize(samples: list) -> dict:
+    """Count plus nearest-rank percentiles and max, in ms"""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    summary = {"count": len(samples)}
+    for pct in PERCENTILES:
+        rank = max(math.ceil(pct / 100 * len(samples)) - 1, 0)
+        summary["p{}".format(pct)] = round(samples[rank] * 1000, 3)
+    summary["max"] = round(samples[-1] * 1000, 3)
+    return summary
+
+
+def run(
+    authority: str,
+    workload: Workload,
+    nclients: int,
+    duration_s: float,
+    warmup_s: float,
+    nprocs: int = 1,
+) -> dict:
+    """One measured run at a concurrency of nclients, over nprocs processes"""
+    begin = time.time() + 0.2 + 0.1 * nprocs
+    measure_from = begin + warmup_s
+    stop_at = measure_from + duration_s
+
+    nprocs = max(min(nprocs, nclients), 1)
+    shares = [nclients // nprocs + (i < nclients % nprocs) for i in range(nprocs)]
+    work = [
+        (authority, workload, share, seed, begin, measure_from, stop_at)
+        for seed, share in enumerate(shares)
+    ]
+    if nprocs == 1:
+        parts = [drive(*work[0])]
+    else:
+        with multiprocessing.Pool(nprocs) as pool:
+            parts = pool.starmap(drive, work)
+
+    gets = [s for part in parts for s in part["get"]]
+    sets = [s for part in parts for s in part["set"]]
+    return {
+        "clients": nclients,
+        "ops_per_s": round((len(gets) + len(sets)) / duration_s, 1),
+        "errors": sum(part["errors"] for part in parts),
+        "latency_ms": {
+            "all": summarize(gets + sets),
+            "get": summarize(gets),
+            "set": summarize(sets),
+        },
+    }
+
+
+def compare(baseline: dict, result: dict, tolerance: float) -> list:
+    """
+    Print how each run did against the baseline run at the same client
+    count. Returns descriptions of the regressions, empty if none.
+    """
+    regressions = []
+    if baseline.get("workload") != result["workload"]:
+        print(
+            "warn: baseline ran a different workload: {}".format(baseline["workload"])
+        )
+    before = {r["clients"]: r for r in baseline.get("runs", [])}
+
+    print(
+        "{:>8} {:>10} {:>12} {:>12} {:>8}".format(
+            "clients", "", "baseline", "now", "change"
+        )
+    )
+    for now in result["runs"]:
+        then = before.get(now["clients"])
+        if then is None:
+            continue
+        rows = [
+            ("ops/s", then["ops_per_s"], now["ops_per_s"], False),
+            (
+                "p50 ms",
+                then["latency_ms"]["all"].get("p50"),
+                now["latency_ms"]["all"].get("p50"),
+                True,
+            ),
+            (
+                "p99 ms",
+                then["latency_ms"]["all"].get("p99"),
+                now["latency_ms"]["all"].get("p99"),
+                True,
+            ),
+        ]
+        for label, old, new, lower_is_better in rows:
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if lower_is_better else change < -tolerance
+            print(
+                "{:>8} {:>10} {:>12.3f} {:>12.3f} {:>+7.1f}%{}".format(
+                    now["clients"], label, old, new, change * 100, " !" if worse else ""
+                )
+            )
+            # p50 moves around too much at this resolution to gate on
+            if worse and label != "p50 ms":
+                regressions.append(
+                    "{} clients: {} {} -> {}".format(now["clients"], label, old, new)
+                )
+    return regressions
+
+
+def print_runs(result: dict):
+    print(
+        "{:>8} {:>10} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+            "clients", "ops/s", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms"
+        )
+    )
+    for r in result["runs"]:
+        lat = r["latency_ms"]["all"]
+        print(
+            "{:>8} {:>10.1f} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                r["clients"],
+                r["ops_per_s"],
+                r["errors"],
+                lat.get("p50", 0),
+                lat.get("p95", 0),
+                lat.get("p99", 0),
+                lat.get("max", 0),
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KVS load generator")
+    parser.add_argument("--reads", type=float, default=0.9, help="fraction of gets")
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--clients", default="1,8,32", help="one run per count")
+    parser.add_argument("--skew", choices=("uniform", "zipf"), default="uniform")
+    parser.add_argument("--zipf-s", type=float, default=0.99)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--client-procs", type=int, default=1)
+    parser.add_argument("--mode", default="threaded", help="KVS_SERVER to start")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        help="NAME=value for the started server, repeatable",
+    )
+    parser.add_argument(
+        "--authority",
+        default="",
+        help="host:port of a running server to use instead of starting one",
+    )
+    parser.add_argument("--port", type=int, default=int(os.getenv("KVS_PORT", 9092)))
+    parser.add_argument("--json", default="", help="write the results here")
+    parser.add_argument("--baseline", default="", help="results JSON to compare to")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    if not 0 <= args.reads <= 1:
+        parser.error("--reads is a fraction between 0 and 1")
+    if args.value_size > MAX_VALUE_SIZE:
+        parser.error("--value-size over {}".format(MAX_VALUE_SIZE))
+
+    workload = Workload(args.reads, args.keys, args.value_size, args.skew, args.zipf_s)
+    server = {"mode": args.mode, "env": dict(e.split("=", 1) for e in args.env)}
+    proc = None
+    authority = args.authority
+    if not authority:
+        env = dict(server["env"], KVS_SERVER=args.mode)
+        proc = kvs_bench.start_service(args.port, env)
+        authority = "127.0.0.1:{}".format(args.port)
+    else:
+        server = {"authority": authority}
+
+    result = {
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "host": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "server": server,
+        "workload": workload.describe(),
+        "duration_s": args.duration,
+        "runs": [],
+    }
+    try:
+        preload(authority, workload)
+        for nclients in [int(c) for c in args.clients.split(",")]:
+            result["runs"].append(
+                run(
+                    authority,
+                    workload,
+                    nclients,
+                    args.duration,
+                    args.warmup,
+                    args.client_procs,
+                )
+            )
+    finally:
+        if proc is not None:
+            kvs_bench.stop_service(proc)
+
+    print_runs(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, result, args.tolerance)
+        for regression in regressions:
+            print("regression: {}".format(regression))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,511 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import random
+import threading
+import time
+
+import kvs_client
+
+"""
+Raft replication for VersionedHash, one RaftNode per kvs_service process.
+
+Every node gets the same list of peer authorities (host:port, itself
+included). Nodes elect a leader, the leader appends each write operation
+to its log and ships it to the others with AppendEntries. Once a majority
+holds an entry it is committed, and every node applies committed entries to
+its own VersionedHash in log order. Since operations are deterministic the
+tables, versions included, come out the same everywhere.
+
+Node to node RPCs ride the same HTTP server as clients:
+    POST /raft/vote     RequestVote
+    POST /raft/append   AppendEntries, also the leader heartbeat
+    GET  /raft/status   role, term, leader and log positions, for tooling
+
+Writes sent to a follower are refused with the leader's address so the
+client can go there. Reads are answered by whichever node gets them as long
+as it heard from a leader recently enough (bounded staleness), a leader
+only answers while a majority has acked it within the election timeout.
+
+Expiry and eviction are per node, so writes with a ttl are refused and
+kvs_service won't start with a memory cap.
+
+The log lives in memory and is never compacted. A restarted node comes
+back empty and the leader resends the whole log to it, which is why this
+doesn't mix with the write-ahead log in kvs_wal.py.
+"""
+
+"Leader sends AppendEntries at least this often"
+HEARTBEAT_S = 0.05
+
+"Followers call an election after hearing nothing for a random time in here"
+ELECTION_MIN_S = 0.3
+ELECTION_MAX_S = 0.6
+
+"How often the election timer is checked"
+TICK_S = 0.01
+
+"Timeout for one node to node RPC"
+RPC_TIMEOUT_S = 0.5
+
+"Longest a write waits to be committed before the client gets a 503"
+WRITE_TIMEOUT_S = 5.0
+
+"Most entries shipped in one AppendEntries"
+MAX_APPEND_ENTRIES = 512
+
+"Default bound on how far behind the leader a follower read may be"
+DEFAULT_MAX_STALE_MS = 1000
+
+"Operations that change the table and have to go through the log"
+WRITE_OPS = frozenset(["set", "delete", "mset", "mdelete", "cas", "incr", "add"])
+
+"Entry a new leader appends so entries from earlier terms get committed"
+NOOP = "noop"
+
+FOLLOWER = "follower"
+CANDIDATE = "candidate"
+LEADER = "leader"
+
+
+class NotLeaderError(BaseException):
+    """
+    A write reached a node that isn't the leader.
+    leader is the authority of the node believed to be leader, or None
+    """
+
+    __slots__ = "leader"
+
+    def __init__(self, leader):
+        self.leader = leader
+
+    def __str__(self):
+        return "NotLeaderError: leader is {}".format(self.leader)
+
+
+class UnavailableError(BaseException):
+    """
+    The node can't serve the request right now: a write didn't commit in
+    time, or a read would be staler than allowed. Retrying may work.
+    """
+
+    __slots__ = "reason"
+
+    def __init__(self, reason: str):
+        self.reason = reason
+
+    def __str__(self):
+        return "UnavailableError: {}".format(self.reason)
+
+
+class RaftNode(object):
+    """
+    Stands in front of a VersionedHash with the same call()/finish_watch()
+    interface, so kvs_service dispatches to it unchanged.
+
+    Locking: lock (a Condition) covers all raft state. It's never held
+    during an RPC or while applying an entry. Threads:
+        ticker      election timeout, and a leader that lost its majority
+                    stepping down
+        replicator  one per peer, sends AppendEntries while leader
+        applier     applies committed entries and hands results to writers
+    """
+
+    __slots__ = (
+        "me",
+        "peers",
+        "state",
+        "lock",
+        "role",
+        "term",
+        "voted_for",
+        "leader",
+        "log",
+        "commit_index",
+        "last_applied",
+        "next_index",
+        "match_index",
+        "ack_time",
+        "waiting",
+        "election_deadline",
+        "leader_contact",
+        "max_stale_s",
+        "pools",
+        "running",
+    )
+
+    def __init__(
+        self, me: str, peers: list, state, max_stale_ms: int = DEFAULT_MAX_STALE_MS
+    ):
+        if me not in peers:
+            raise ValueError("{} isn't in the peer list".format(me))
+        self.me = me
+        self.peers = [p for p in peers if p != me]
+        self.state = state
+        self.lock = threading.Condition()
+        self.role = FOLLOWER
+        self.term = 0
+        self.voted_for = None
+        self.leader = None
+        # Index 0 is a placeholder so real entries start at 1
+        self.log = [{"term": 0, "op": NOOP, "args": {}}]
+        self.commit_index = 0
+        self.last_applied = 0
+        self.next_index = {}
+        self.match_index = {}
+        self.ack_time = {}
+        self.waiting = {}
+        self.election_deadline = 0
+        self.leader_contact = 0
+        self.max_stale_s = max_stale_ms / 1000
+        self.pools = {
+            p: kvs_client.ConnectionPool(p, 2, RPC_TIMEOUT_S) for p in self.peers
+        }
+        self.running = False
+
+    def start(self):
+        self.running = True
+        with self.lock:
+            self.reset_election_deadline()
+        threading.Thread(target=self.ticker, daemon=True).start()
+        threading.Thread(target=self.applier, daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self.replicator, args=[peer], daemon=True).start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+
+    def call(self, uri_path: str, body: bytes = None, etag: str = None):
+        """Raft RPCs are handled here, writes go through the log, reads local"""
+        if uri_path.startswith("/raft/"):
+            return self.rpc(uri_path[len("/raft/") :].split("?")[0], body)
+
+        oper, args = self.state.parse(uri_path, body, etag)
+        if oper in WRITE_OPS:
+            if "ttl" in args:
+                # Each node would turn it into a deadline when it applies the
+                # entry and reap on its own clock, so the tables drift apart
+                raise ValueError("ttl isn't supported with raft replication")
+            return self.replicate(oper, args)
+
+        self.check_fresh(args)
+        return self.state.dispatch_lut[oper](args)
+
+    def finish_watch(self, w):
+        return self.state.finish_watch(w)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "id": self.me,
+                "role": self.role,
+                "term": self.term,
+                "leader": self.leader,
+                "last_index": len(self.log) - 1,
+                "commit": self.commit_index,
+                "applied": self.last_applied,
+            }
+
+    # not public interface
+    def rpc(self, name: str, body: bytes):
+        if name == "status":
+            return self.status()
+        req = json.loads(body or b"{}")
+        if name == "vote":
+            return self.on_vote(req)
+        if name == "append":
+            return self.on_append(req)
+        raise ValueError("unknown raft rpc: {}".format(name))
+
+    def send(self, peer: str, name: str, req: dict):
+        """POST a raft RPC to peer, returns the decoded reply or None"""
+        payload = bytes(json.dumps(req, separators=(",", ":")), "utf-8")
+        hdrs = {"Content-Type": "application/json"}
+        try:
+            status, _, data = self.pools[peer].request(
+                "POST", "/raft/" + name, payload, hdrs
+            )
+        except Exception:
+            return None
+        if status != 200:
+            return None
+        return json.loads(data)
+
+    def replicate(self, oper: str, args: dict):
+        """Append a write to the log, wait for it to be applied here"""
+        entry = {"term": 0, "op": oper, "args": args}
+        with self.lock:
+            if self.role != LEADER:
+                raise NotLeaderError(self.leader)
+            entry["term"] = self.term
+            self.log.append(entry)
+            index = len(self.log) - 1
+            self.waiting[index] = None
+            self.lock.notify_all()
+
+            deadline = time.time() + WRITE_TIMEOUT_S
+            try:
+                while self.waiting[index] is None:
+                    remaining = deadline - time.time()
+                    if self.role != LEADER:
+                        # Already in the log, the next leader may commit it
+                        raise UnavailableError("lost leadership, write may apply")
+                    if remaining <= 0:
+                        raise UnavailableError("write not committed in time")
+                    self.lock.wait(remaining)
+                applied, result, failed = self.waiting[index]
+            finally:
+                del self.waiting[index]
+
+        # A new leader may have replaced the entry with a different one
+        if applied is not entry:
+            raise NotLeaderError(self.leader)
+        if failed:
+            raise result
+        return result
+
+    def check_fresh(self, args: dict):
+        """Refuse a read this node can't vouch for, see module docstring"""
+        bound = self.max_stale_s
+        if "maxstale" in args:
+            bound = int(args["maxstale"]) / 1000
+        with self.lock:
+            if self.role == LEADER:
+                if self.has_lease():
+                    return
+                raise UnavailableError("leader lost contact with a majority")
+            age = time.time() - self.leader_contact
+        if age > bound:
+            raise UnavailableError("no word from a leader in {:.3f}s".format(age))
+
+    def majority_ack(self) -> float:
+        """Send time of the newest heartbeat a majority (us included) acked"""
+        acks = sorted([time.time()] + list(self.ack_time.values()), reverse=True)
+        return acks[(len(self.peers) + 1) // 2]
+
+    def has_lease(self) -> bool:
+        """
+        Followers that acked a heartbeat won't elect anyone else until an
+        election timeout after it, so until then no other leader can exist
+        """
+        return self.majority_ack() > time.time() - ELECTION_MIN_S
+
+    def reset_election_deadline(self):
+        delay = random.uniform(ELECTION_MIN_S, ELECTION_MAX_S)
+        self.election_deadline = time.time() + delay
+
+    def become_follower(self, term: int):
+        if term > self.term:
+            self.term = term
+            self.voted_for = None
+        self.role = FOLLOWER
+        self.lock.notify_all()
+
+    def become_leader(self):
+        self.role = LEADER
+        self.leader = self.me
+        self.log.append({"term": self.term, "op": NOOP, "args": {}})
+        now = time.time()
+        for peer in self.peers:
+            self.next_index[peer] = len(self.log) - 1
+            self.match_index[peer] = 0
+            self.ack_time[peer] = now
+        self.advance_commit()
+        self.lock.notify_all()
+
+    def ticker(self):
+        while self.running:
+            time.sleep(TICK_S)
+            with self.lock:
+                if self.role == LEADER:
+                    # Cut off from the majority, let clients find whoever
+                    # the majority side elects
+                    if time.time() - self.majority_ack() > 2 * ELECTION_MAX_S:
+                        self.leader = None
+                        self.become_follower(self.term)
+                        self.reset_election_deadline()
+                elif time.time() >= self.election_deadline:
+                    self.start_election()
+
+    def start_election(self):
+        """Caller holds lock"""
+        self.role = CANDIDATE
+        self.term += 1
+        self.voted_for = self.me
+        self.leader = None
+        self.reset_election_deadline()
+        votes = set([self.me])
+        req = {
+            "term": self.term,
+            "candidate": self.me,
+            "last_index": len(self.log) - 1,
+            "last_term": self.log[-1]["term"],
+        }
+        if not self.peers:
+            self.become_leader()
+            return
+
+        def ask(peer: str):
+            reply = self.send(peer, "vote", req)
+            if reply is None:
+                return
+            with self.lock:
+                if reply["term"] > self.term:
+                    self.become_follower(reply["term"])
+                    return
+                if self.role != CANDIDATE or self.term != req["term"]:
+                    return
+                if reply["granted"]:
+                    votes.add(peer)
+                    if len(votes) * 2 > len(self.peers) + 1:
+                        self.become_leader()
+
+        for peer in self.peers:
+            threading.Thread(target=ask, args=[peer], daemon=True).start()
+
+    def on_vote(self, req: dict) -> dict:
+        with self.lock:
+            if req["term"] > self.term:
+                self.become_follower(req["term"])
+            granted = False
+            if req["term"] == self.term and self.voted_for in (None, req["candidate"]):
+                ours = (self.log[-1]["term"], len(self.log) - 1)
+                if (req["last_term"], req["last_index"]) >= ours:
+                    granted = True
+                    self.voted_for = req["candidate"]
+                    self.reset_election_deadline()
+            return {"term": self.term, "granted": granted}
+
+    def on_append(self, req: dict) -> dict:
+        with self.lock:
+            if req["term"] < self.term:
+                return {"term": self.term, "success": False, "hint": len(self.log)}
+            if req["term"] > self.term or self.role != FOLLOWER:
+                self.become_follower(req["term"])
+            self.leader = req["leader"]
+            self.leader_contact = time.time()
+            self.reset_election_deadline()
+
+            prev = req["prev_index"]
+            if prev >= len(self.log):
+                return {"term": self.term, "success": False, "hint": len(self.log)}
+            if self.log[prev]["term"] != req["prev_term"]:
+                # Skip back over the whole conflicting term in one go
+                bad = self.log[prev]["term"]
+                hint = prev
+                while hint > 1 and self.log[hint - 1]["term"] == bad:
+                    hint -= 1
+                return {"term": self.term, "success": False, "hint": hint}
+
+            index = prev
+            for entry in req["entries"]:
+                index += 1
+                if index < len(self.log):
+                    if self.log[index]["term"] == entry["term"]:
+                        continue
+                    del self.log[index:]
+                self.log.append(entry)
+
+            if req["commit"] > self.commit_index:
+                self.commit_index = min(req["commit"], index)
+                self.lock.notify_all()
+            return {"term": self.term, "success": True}
+
+    def replicator(self, peer: str):
+        """Keep one peer's log in step with ours while we're leader"""
+        last_sent = 0
+        retry_at = 0
+        while self.running:
+            with self.lock:
+                while self.running:
+                    now = time.time()
+                    if self.role == LEADER and now >= retry_at:
+                        pending = self.next_index[peer] < len(self.log)
+                        if pending or now - last_sent >= HEARTBEAT_S:
+                            break
+                        self.lock.wait(HEARTBEAT_S - (now - last_sent))
+                    else:
+                        self.lock.wait(HEARTBEAT_S)
+                if not self.running:
+                    return
+
+                term = self.term
+                prev = self.next_index[peer] - 1
+                entries = self.log[prev + 1 : prev + 1 + MAX_APPEND_ENTRIES]
+                req = {
+                    "term": term,
+                    "leader": self.me,
+                    "prev_index": prev,
+                    "prev_term": self.log[prev]["term"],
+                    "entries": entries,
+                    "commit": self.commit_index,
+                }
+
+            last_sent = time.time()
+            reply = self.send(peer, "append", req)
+
+            with self.lock:
+                if reply is None:
+                    # Peer is down or slow, don't spin on it
+                    retry_at = time.time() + HEARTBEAT_S
+                    continue
+                if reply["term"] > self.term:
+                    self.become_follower(reply["term"])
+                    continue
+                if self.role != LEADER or self.term != term:
+                    continue
+                self.ack_time[peer] = last_sent
+                if reply["success"]:
+                    matched = prev + len(entries)
+                    self.match_index[peer] = max(self.match_index[peer], matched)
+                    self.next_index[peer] = self.match_index[peer] + 1
+                    self.advance_commit()
+                else:
+                    lower = min(self.next_index[peer] - 1, reply["hint"])
+                    self.next_index[peer] = max(1, lower)
+
+    def advance_commit(self):
+        """Commit the highest index a majority holds, only for our own term"""
+        held = sorted([len(self.log) - 1] + list(self.match_index.values()))
+        index = held[(len(held) - 1) // 2]
+        if index > self.commit_index and self.log[index]["term"] == self.term:
+            self.commit_index = index
+            self.lock.notify_all()
+
+    def applier(self):
+        """Apply committed entries in order, hand results to waiting writers"""
+        while self.running:
+            with self.lock:
+                while self.running and self.last_applied >= self.commit_index:
+                    self.lock.wait(0.5)
+                first = self.last_applied + 1
+                batch = self.log[first : self.commit_index + 1]
+
+            for offset, entry in enumerate(batch):
+                result, failed = None, False
+                if entry["op"] != NOOP:
+                    try:
+                        result = self.state.dispatch_lut[entry["op"]](entry["args"])
+                    except BaseException as e:
+                        result, failed = e, True
+                with self.lock:
+                    self.last_applied = first + offset
+                    if self.last_applied in self.waiting:
+                        self.waiting[self.last_applied] = (entry, result, failed)
+                        self.lock.notify_all()
@@ -0,0 +1,195 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+import sys
+import time
+
+import kvs_bench
+import kvs_client
+
+"""
+Runs replicated clusters as local kvs_service processes on consecutive
+ports starting at KVS_PORT (default 9101) and checks replication, follower
+redirects and leader failover, then compares write latency of a single node
+with one and with two followers.
+"""
+
+
+def start_cluster(nodes: int, base_port: int) -> dict:
+    """Returns {authority: process}"""
+    hosts = ["127.0.0.1:{}".format(base_port + i) for i in range(nodes)]
+    env = {"KVS_RAFT_PEERS": ",".join(hosts)}
+    procs = {}
+    try:
+        for i, host in enumerate(hosts):
+            procs[host] = kvs_bench.start_service(base_port + i, env)
+    except Exception as e:
+        stop_cluster(procs)
+        raise e
+    return procs
+
+
+def stop_cluster(procs: dict):
+    for proc in procs.values():
+        kvs_bench.stop_service(proc)
+
+
+def raft_status(host: str) -> dict:
+    pool = kvs_client.ConnectionPool(host, 1, 1)
+    try:
+        status, _, data = pool.request("GET", "/raft/status")
+    except Exception:
+        return None
+    finally:
+        pool.close()
+    return json.loads(data) if status == 200 else None
+
+
+def wait_for_leader(hosts: list, timeout: float = 10) -> str:
+    """Authority of the node every live node agrees is leader"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        seen = [raft_status(h) for h in hosts]
+        leaders = set(s["leader"] for s in seen if s is not None)
+        if len(leaders) == 1 and None not in leaders:
+            leader = leaders.pop()
+            if any(s and s["id"] == leader and s["role"] == "leader" for s in seen):
+                return leader
+        time.sleep(0.05)
+    raise RuntimeError("no leader elected among {}".format(hosts))
+
+
+def test_replication(client, hosts: list):
+    """Writes through the leader show up on every node, same versions"""
+    for i in range(20):
+        client.setVal("raft/repl", str(i))
+    client.setVals({"raft/a": "1", "raft/b": "2"})
+    client.delVal("raft/b")
+
+    # Expiry would happen per node, so it's refused
+    assert "error" in client.setVal("raft/ttl", "x", ttl=60)
+
+    time.sleep(0.2)
+    for host in hosts:
+        node = kvs_client.HttpKVSClient(host)
+        resp = node.getVal("raft/repl")
+        assert resp == {"value": "19", "version": 19}, (host, resp)
+        assert node.getVals(["raft/a", "raft/b"]) == {
+            "raft/a": {"value": "1", "version": 0}
+        }
+        node.close()
+
+
+def test_follower_redirect(hosts: list, leader: str):
+    """A follower refuses writes and names the leader"""
+    follower = [h for h in hosts if h != leader][0]
+    node = kvs_client.HttpKVSClient(follower)
+    resp = node.setVal("raft/redirect", "x")
+    assert resp == {"error": "not leader", "leader": leader}, resp
+
+    # Reads are fine, and can demand fresher data than the default
+    resp = node.do_rpc("/get", "key=raft%2Frepl&maxstale=5000")
+    assert resp["value"] == "19", resp
+    node.close()
+
+
+def test_leader_failover(client, procs: dict, leader: str) -> str:
+    """Kill the leader, acknowledged writes survive and writes resume"""
+    acked = {}
+    for i in range(100):
+        key = "raft/failover{}".format(i)
+        acked[key] = client.setVal(key, str(i))["version"]
+
+    procs[leader].kill()
+    procs[leader].wait()
+    killed_at = time.perf_counter()
+    survivors = [h for h in procs if h != leader]
+
+    resp = client.setVal("raft/after", "1")
+    recovered_s = time.perf_counter() - killed_at
+    assert resp == {"version": 0}, resp
+
+    new_leader = wait_for_leader(survivors)
+    assert new_leader != leader
+    for key, version in acked.items():
+        resp = kvs_client.HttpKVSClient(new_leader).getVal(key)
+        assert resp["version"] == version, (key, resp)
+
+    print(
+        "leader {} killed, writes resumed on {} after {:.0f} ms".format(
+            leader, new_leader, recovered_s * 1000
+        )
+    )
+    return new_leader
+
+
+def write_latency(host: str, count: int) -> list:
+    """Sorted latencies in ms of count sequential sets"""
+    client = kvs_client.HttpKVSClient(host)
+    client.setVal("raft/latency", "warmup")
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        client.setVal("raft/latency", str(i))
+        samples.append((time.perf_counter() - start) * 1000)
+    client.close()
+    return sorted(samples)
+
+
+def bench_write_latency(base_port: int, count: int = 2000):
+    """Single node against clusters with one and two followers"""
+    print("{:>10} {:>9} {:>9} {:>9}".format("followers", "p50 ms", "p99 ms", "max ms"))
+    for nodes in (1, 2, 3):
+        if nodes == 1:
+            procs = {
+                "127.0.0.1:{}".format(base_port): kvs_bench.start_service(base_port)
+            }
+            leader = list(procs)[0]
+        else:
+            procs = start_cluster(nodes, base_port)
+            leader = wait_for_leader(list(procs))
+        try:
+            samples = write_latency(leader, count)
+        finally:
+            stop_cluster(procs)
+        p50 = samples[len(samples) // 2]
+        p99 = samples[int(len(samples) * 0.99)]
+        label = "none" if nodes == 1 else str(nodes - 1)
+        print("{:>10} {:>9.3f} {:>9.3f} {:>9.3f}".format(label, p50, p99, samples[-1]))
+
+
+if __name__ == "__main__":
+    PORT = int(os.getenv("KVS_PORT", 9101))
+    NODES = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    procs = start_cluster(NODES, PORT)
+    try:
+        hosts = list(procs)
+        leader = wait_for_leader(hosts)
+        client = kvs_client.ClusterKVSClient(hosts)
+
+        test_replication(client, hosts)
+        test_follower_redirect(hosts, leader)
+        test_leader_failover(client, procs, leader)
+        client.close()
+    finally:
+        stop_cluster(procs)
+
+    bench_write_latency(PORT)
+
+    print("Got here without breaking an assert - PASS")
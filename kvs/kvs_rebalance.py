@@ -0,0 +1,136 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+
+import kvs_client
+
+"""
+Moves entries after the shard list of a ShardedKVSClient changes. Every old
+shard is scanned, and keys the new ring assigns elsewhere are copied to their
+new owner and then deleted from the old one. Only those keys cross the
+network, roughly 1/N of them when one shard is added or removed.
+
+Switch clients over to the new shard list first, then run this. Copies
+are made with cas on "doesn't exist yet", so a key a client already wrote
+on its new owner is left alone rather than clobbered with the old copy.
+Moved keys start over at version 0 on their new shard, a key with a ttl
+keeps the time it had left. Keys that expire or get deleted before they're
+copied are skipped.
+
+A key is only deleted from its old shard once its new owner is known to
+hold it, and only if a read just before the delete finds the old copy
+still as it was scanned. Anything else (an error, a write that hit the old
+shard since) stays put and is counted as failed.
+"""
+
+
+def rebalance(
+    old_hosts: list,
+    new_hosts: list,
+    batch: int = 1000,
+    dry_run: bool = False,
+    vnodes: int = kvs_client.DEFAULT_VNODES,
+) -> dict:
+    """
+    Returns {"scanned": n, "moved": n, "kept": n, "failed": n,
+    "routes": {"src->dst": n}} where kept counts keys the new owner already
+    had and failed the ones left on the old shard.
+    """
+    ring = kvs_client.HashRing(new_hosts, vnodes)
+    clients = {h: kvs_client.HttpKVSClient(h) for h in set(old_hosts) | set(new_hosts)}
+    report = {"scanned": 0, "moved": 0, "kept": 0, "failed": 0, "routes": {}}
+
+    def flush(src: str, dst: str, items: dict):
+        """items is {key: scanned entry}"""
+        route = "{}->{}".format(src, dst)
+        report["routes"][route] = report["routes"].get(route, 0) + len(items)
+        if dry_run:
+            report["moved"] += len(items)
+            return
+
+        left = clients[src].expiries(list(items))
+        if "error" in left:
+            print("warn: reading expiries {} failed: {}".format(route, left))
+            report["failed"] += len(items)
+            return
+
+        copied = []
+        vanished = 0
+        for key, entry in items.items():
+            if key not in left:
+                vanished += 1
+                continue
+            ttl = left[key] or None
+            res = clients[dst].casVal(key, entry["value"], -1, ttl)
+            if "version" in res and "error" not in res:
+                report["moved"] += 1
+            elif res.get("error") == "version mismatch":
+                report["kept"] += 1
+            else:
+                # Likely the rest would fail too, they stay where they are
+                print("warn: copy of {} to {} failed: {}".format(key, dst, res))
+                break
+            copied.append(key)
+
+        # Leave the old copy if it changed since the scan
+        now = clients[src].getVals(copied) if copied else {}
+        if "error" in now:
+            print("warn: reading back {} from {} failed: {}".format(route, src, now))
+            now = {}
+        gone = [k for k in copied if k in now and now[k] == items[k]]
+        res = clients[src].delVals(gone) if gone else {}
+        if "error" in res:
+            print("warn: delete from {} failed: {}".format(src, res))
+            gone = []
+        report["failed"] += len(items) - vanished - len(gone)
+
+    for src in old_hosts:
+        pending = {}
+        for key, entry in clients[src].scan(page_size=batch):
+            report["scanned"] += 1
+            dst = ring.lookup(key)
+            if dst == src:
+                continue
+            items = pending.setdefault(dst, {})
+            items[key] = entry
+            if len(items) >= batch:
+                flush(src, dst, pending.pop(dst))
+        for dst, items in pending.items():
+            flush(src, dst, items)
+
+    for client in clients.values():
+        client.close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move KVS keys to new shards")
+    parser.add_argument("--old", required=True, help="host:port,... before")
+    parser.add_argument("--new", required=True, help="host:port,... after")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    report = rebalance(
+        args.old.split(","), args.new.split(","), args.batch, args.dry_run
+    )
+    for route, count in sorted(report["routes"].items()):
+        print("{:>40} {:>10}".format(route, count))
+    print(
+        "scanned {scanned}, moved {moved}, already on new owner {kept}, "
+        "left behind {failed}".format(**report)
+    )
@@ -14,15 +14,59 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
+import bisect
+import heapq
+from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
+import math
 import os
-import pickle
+import random
+import re
+import socketserver
+import threading
+import time
 import urllib.parse
+import uuid
+
+import kvs_raft
+import kvs_wal
+from kvs_watch import Watch, WatchRegistry
 
 "Skip a full DNS lookup for the FQDN"
 DISABLE_LOG_DNS_LOOKUP = True
 
+"Seconds a keep-alive connection may sit idle before the server drops it"
+IDLE_TIMEOUT_S = 30
+
+"How long a watch parks when the request doesn't say"
+DEFAULT_WATCH_TIMEOUT_S = 30
+
+"Most entries one listall page may hold"
+MAX_LIST_PAGE = 10000
+
+"Changes kept for changes?since=, older ones need a full listall to catch up"
+DEFAULT_CHANGELOG_SIZE = 100000
+
+"Number of lock stripes the table is split into, a power of 2 isn't required"
+DEFAULT_STRIPE_COUNT = 64
+
+"How often the background reaper drops expired keys"
+REAP_INTERVAL_S = 0.5
+
+"Most expired keys dropped under one pass of the heap lock"
+REAP_BATCH = 1000
+
+"Times a snapshot read starts over when writes outran the change log mid scan"
+SNAPSHOT_RETRIES = 3
+
+"Rough per entry cost beyond its encoded bytes: slot, dict entry, key/value str"
+ENTRY_OVERHEAD_BYTES = 450
+
+"Keys looked at per eviction, the least recently used of them goes"
+EVICTION_SAMPLES = 5
+
 
 class InvalidOperationError(BaseException):
     """
@@ -52,165 +96,1348 @@ class HashKeyNotFoundError(BaseException):
         return "HashKeyNotFoundError: {}".format(self.keystr)
 
 
-class VersionedPickle(object):
+class VersionMismatchError(BaseException):
     """
-    Serialize contents, bump version number on assignment
-    TODO: No reason left to use pickle.
+    A compare-and-set found a different version than the caller expected
     """
 
-    __slots__ = "bytes", "version"
+    __slots__ = "keystr", "expected", "actual"
 
-    def __init__(self):
+    def __init__(self, k, expected: int, actual: int):
+        self.keystr = k
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return "VersionMismatchError: {} is at {}, not {}".format(
+            self.keystr, self.actual, self.expected
+        )
+
+
+class SnapshotExpiredError(BaseException):
+    """
+    A read asked for a table revision the change log no longer reaches
+    back to, or one from another process
+    """
+
+    __slots__ = "seq"
+
+    def __init__(self, seq: int):
+        self.seq = seq
+
+    def __str__(self):
+        return "SnapshotExpiredError: revision {} is gone".format(self.seq)
+
+
+def key_arg(args: dict) -> str:
+    """The request's key, ValueError if it's missing or not a string"""
+    key = args.get("key")
+    if not isinstance(key, str):
+        raise ValueError("key must be a string")
+    return key
+
+
+def keys_arg(args: dict) -> list:
+    """A batch request's keys, ValueError unless they're a list of strings"""
+    keys = args["keys"]
+    if not isinstance(keys, list) or not all(isinstance(k, str) for k in keys):
+        raise ValueError("keys must be a list of strings")
+    return keys
+
+
+def parse_number(text: str):
+    """int if it looks like one, else float. ValueError for anything else"""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+class Tagged(object):
+    """
+    A response body along with its ETag. body is None when the client's
+    If-None-Match already names the current tag, i.e. a 304.
+    """
+
+    __slots__ = "body", "etag"
+
+    def __init__(self, body, etag: str):
+        self.body = body
+        self.etag = etag
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match holds a comma separated list of tags, or *"""
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [t.strip() for t in header.split(",")]
+
+
+def expiry_from(args: dict, keep: float = 0) -> float:
+    """
+    Absolute expiry time for a write's ttl arg (seconds from now), 0 for
+    never. A write without ttl gets keep.
+    """
+    if "ttl" not in args:
+        return keep
+    ttl = float(args["ttl"])
+    # A nan in the expiry heap breaks its ordering, reap() would stall
+    if not math.isfinite(ttl) or ttl <= 0:
+        raise ValueError("ttl must be positive and finite")
+    return time.time() + ttl
+
+
+class VersionedValue(object):
+    """
+    Store contents as-is, bump version number on assignment.
+    The JSON for {"value", "version"} is built once per update so reads are
+    just a byte copy, item is the same prefixed with the key for listings.
+    revision is the table-wide revision of the last update.
+    expires is a time.time() the entry is gone after, 0 for never. queued
+    is the deadline of the key's one expiry heap entry, 0 if it has none.
+    touched is when it was last read or written, for eviction. size is an
+    estimate of the memory it holds.
+    """
+
+    __slots__ = (
+        "value",
+        "version",
+        "revision",
+        "encoded",
+        "item",
+        "keyjson",
+        "expires",
+        "queued",
+        "touched",
+        "size",
+    )
+
+    def __init__(self, key: str):
+        self.keyjson = bytes(json.dumps(key), "utf-8")
+        self.value = None
         self.version = -1
-        self.bytes = pickle.dumps(None)
+        self.revision = 0
+        self.expires = 0
+        self.queued = 0
+        self.touched = 0
+        self.encode()
 
-    def update(self, obj):
-        self.bytes = pickle.dumps(obj)
+    def update(self, val: str, revision: int):
+        self.value = val
         self.version += 1
+        self.revision = revision
+        self.encode()
         return self
 
-    def value(self):
-        return pickle.loads(self.bytes)
+    def encode(self):
+        doc = {"value": self.value, "version": self.version}
+        self.encoded = bytes(json.dumps(doc), "utf-8")
+        self.item = self.keyjson + b": " + self.encoded
+        self.size = ENTRY_OVERHEAD_BYTES + 2 * len(self.item)
+
+    def expired(self, now: float) -> bool:
+        return self.expires != 0 and self.expires <= now
 
     def __repr__(self):
-        return "VersionedPickle: {}".format(
-            str({"version": self.version, "strval": self.value()})
+        return "VersionedValue: {}".format(
+            str({"version": self.version, "strval": self.value})
         )
 
     def __str__(self):
         return self.__repr__()
 
 
+class SortedKeyIndex(object):
+    """
+    Every key in the table, kept sorted so prefix scans are a bisect plus
+    a walk over the matching run instead of a pass over the whole table.
+    Only inserts and deletes of keys touch it, updates don't.
+    """
+
+    __slots__ = "lock", "keys"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = []
+
+    def add(self, key: str):
+        with self.lock:
+            bisect.insort(self.keys, key)
+
+    def discard(self, key: str):
+        with self.lock:
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def scan(self, prefix: str = "", after: str = None, limit: int = None) -> list:
+        """
+        Sorted keys starting with prefix, only those > after if given, at
+        most limit of them
+        """
+        with self.lock:
+            keys = self.keys
+            lo = bisect.bisect_left(keys, prefix)
+            if after is not None:
+                lo = max(lo, bisect.bisect_right(keys, after))
+            hi = len(keys)
+            if prefix:
+                hi = bisect.bisect_left(keys, prefix + "\U0010ffff", lo)
+                while hi < len(keys) and keys[hi].startswith(prefix):
+                    hi += 1
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            return keys[lo:hi]
+
+
+class ChangeLog(object):
+    """
+    Ring buffer of the most recent changes, indexed by sequence number.
+    Sequence numbers are table revisions and each revision is exactly one
+    change, so the slot for a sequence number is just seq % capacity.
+    Entries are (key, encoded key, encoded entry or None for a delete,
+    prior). prior is the (item, expires) the key had before the change, or
+    None if it didn't exist, so a reader can roll a key back to any revision
+    the log still covers. That keeps up to capacity old values alive.
+    Caller holds VersionedHash.seqlock for everything here.
+    """
+
+    __slots__ = "ring", "last"
+
+    def __init__(self, capacity: int = DEFAULT_CHANGELOG_SIZE):
+        self.ring = [None] * max(capacity, 1)
+        self.last = 0
+
+    def append(self, seq: int, key: str, keyjson: bytes, encoded: bytes, prior):
+        self.ring[seq % len(self.ring)] = (key, keyjson, encoded, prior)
+        self.last = seq
+
+    def covers(self, since: int) -> bool:
+        """Is every change after since still here"""
+        return max(self.last - len(self.ring), 0) <= since <= self.last
+
+    def after(self, since: int, limit: int) -> list:
+        """Changes since+1 .. since+limit as (seq, key, keyjson, encoded, prior)"""
+        end = min(self.last, since + limit)
+        return [(s,) + self.ring[s % len(self.ring)] for s in range(since + 1, end + 1)]
+
+
+def literal_prefix(pattern: str) -> str:
+    """
+    Literal text a ^-anchored regex has to start with, lets a filter like
+    ^shop/compressor/ be served from the index. Empty if there isn't any.
+    """
+    # An alternation anywhere can let a match start with something else
+    if not pattern.startswith("^") or "|" in pattern:
+        return ""
+    out = []
+    for i, c in enumerate(pattern[1:], 1):
+        if c in ".^$*+?{}[]\\|()":
+            # A quantifier applies to the char before it
+            if c in "*?{" and out:
+                out.pop()
+            break
+        out.append(c)
+    return "".join(out)
+
+
+def encode_listing(items) -> bytes:
+    """Join cached item fragments into a {key: {"value", "version"}} document"""
+    return b"{" + b", ".join(items) + b"}"
+
+
 class VersionedHash(object):
     """Hash table that versions contents
     Intended as a quick & dirty way to publish data
+
+    The table is split into lock stripes so requests on keys that land in
+    different stripes never wait on each other. A stripe lock is only held
+    long enough to find the slot and bump/read its version, serialization
+    happens outside of it.
+
+    If a journal (kvs_wal.WriteAheadLog) is attached, sets and deletes are
+    appended to it under the stripe lock, so the log agrees with the version
+    order, and waited on after the lock is released.
+
+    Every change also bumps a table-wide revision. It's assigned, the change
+    published and recorded in the change log under seqlock (always taken
+    after a stripe lock), so anything at or below a revision read under
+    seqlock is visible. Watches on changed keys are woken once the stripe
+    lock is released.
+
+    Writes can carry a ttl. Expired entries read as missing right away and
+    are dropped by reap(), which pops them off a heap ordered by expiry
+    rather than scanning the table. A key has at most one heap entry, a
+    rewrite with a later deadline is requeued by reap() when the old one
+    comes due, so rewriting a key with a ttl doesn't grow the heap. With memory_cap set, writers that push
+    the estimated size over it evict entries until it's back under, picking
+    the least recently used of a few sampled keys each time.
+
+    Multi-key reads (listall, mget, snapshot) see the table as of a single
+    revision without taking a lock writers wait on, see snapshot_items().
     """
 
-    __slots__ = "bigmap", "dispatch_lut", "table"
+    __slots__ = (
+        "dispatch_lut",
+        "stripes",
+        "locks",
+        "journal",
+        "seqlock",
+        "revision",
+        "watches",
+        "index",
+        "changelog",
+        "epoch",
+        "expiry_heap",
+        "expirylock",
+        "stale_expiry",
+        "memory",
+        "memory_cap",
+        "defer_sync",
+        "expired",
+        "evicted",
+    )
 
-    def __init__(self):
-        self.table = {}
+    def __init__(self, stripe_count: int = DEFAULT_STRIPE_COUNT):
+        self.stripes = [{} for _ in range(stripe_count)]
+        self.locks = [threading.Lock() for _ in range(stripe_count)]
+        self.journal = None
+        self.seqlock = threading.Lock()
+        self.revision = 0
+        self.watches = WatchRegistry()
+        self.index = SortedKeyIndex()
+        self.changelog = ChangeLog()
+        # Sequence numbers mean nothing across restarts, see changes()
+        self.epoch = uuid.uuid4().hex
+        self.expiry_heap = []
+        self.expirylock = threading.Lock()
+        self.stale_expiry = 0
+        self.memory = 0
+        self.memory_cap = 0
+        # The asyncio server waits for fsyncs itself, off the event loop
+        self.defer_sync = False
+        self.expired = 0
+        self.evicted = 0
         lut = {}
         lut["get"] = self.get
         lut["set"] = self.set
         lut["delete"] = self.delete
         lut["listall"] = self.listAll
+        lut["mget"] = self.mget
+        lut["snapshot"] = self.snapshot
+        lut["cas"] = self.cas
+        lut["incr"] = self.incr
+        lut["add"] = self.add
+        lut["stats"] = self.stats
+        lut["expiries"] = self.expiries
+        lut["mset"] = self.mset
+        lut["mdelete"] = self.mdelete
+        lut["watch"] = self.watch
+        lut["changes"] = self.changes
         self.dispatch_lut = lut
 
-    def call(self, uri_path: str):
+    def call(self, uri_path: str, body: bytes = None, etag: str = None):
+        """Run the operation encoded in a URI path and optional POST body"""
+        oper, args = self.parse(uri_path, body, etag)
+        return self.dispatch_lut[oper](args)
+
+    def parse(self, uri_path: str, body: bytes = None, etag: str = None) -> tuple:
         """
-        Parse the path to figure out action and params
+        Parse the path to figure out action and params, returns (oper, args)
         TODO: This is the same(ish) code as SHOP-316, refactor when that's merged
+        etag is the request's If-None-Match, if any, kept as "ifnonematch".
+
+        Query params end up in args by name (last one wins, "val" is an alias
+        of "value"). Every key/value param is also kept in order under
+        "keys"/"values" for the batch operations. A POSTed JSON object is
+        merged over the top so big batches don't need to fit in a URI.
         """
-        oper = uri_path.split("/")[1]
-        oper = oper.split("?")[0]
+        parsed = urllib.parse.urlsplit(uri_path)
+        oper = parsed.path.split("/")[1]
 
         # Validate operation
         if oper not in self.dispatch_lut:
             raise InvalidOperationError(oper)
 
-        query = uri_path.split("?")[1]
-        argpairs = query.split("&")
-
-        args = {}
-        for apair in argpairs:
-            v = apair.split("=")
-            decoded = urllib.parse.unquote_plus(v[1])
-            args[v[0]] = decoded
-
-        k = None
-        if "key" in args:
-            k = args["key"]
-        v = None
-        if "value" in args:
-            v = args["value"]
-        elif "val" in args:
-            v = args["val"]
-
-        if oper in self.dispatch_lut:
-            return self.dispatch_lut[oper]((k, v))
-        else:
-            return {"error": "invalid operation: {}".format(oper)}
-
-    def set(self, kvtup):
-        """Bump version number on each set call, even if same value"""
-        key, val = kvtup
-        self.addslot(key)
-        self.table[key].update(str(val))
-        return {"version": self.table[key].version}
-
-    def get(self, keytup: tuple):
-        """Fetch the value and associated version"""
-        key, _ = keytup
-        if key not in self.table:
-            raise HashKeyNotFoundError(key)
-
-        o = self.table[key]
-        return {"value": o.value(), "version": o.version}
-
-    def delete(self, keytup: tuple):
-        key, _ = keytup
-        if key not in self.table:
+        args = {"keys": [], "values": []}
+        for name, decoded in urllib.parse.parse_qsl(parsed.query, True):
+            if name == "val":
+                name = "value"
+            args[name] = decoded
+            if name == "key":
+                args["keys"].append(decoded)
+            elif name == "value":
+                args["values"].append(decoded)
+
+        if body:
+            doc = json.loads(body)
+            if not isinstance(doc, dict):
+                raise ValueError("request body must be a JSON object")
+            args.update(doc)
+        if etag:
+            args["ifnonematch"] = etag
+
+        return oper, args
+
+    def set(self, args: dict):
+        """
+        Bump version number on each set call, even if same value.
+        ttl (seconds) makes the key expire, a set without one clears it.
+        """
+        key, val = key_arg(args), args.get("value")
+        expires = expiry_from(args)
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            slot = self.addslot(key, idx)
+            self.publish(key, slot, str(val), expires)
+            version = slot.version
+            lsn = self.journal_set(key, slot)
+        self.watches.fire(key)
+        self.commit(lsn)
+        return {"version": version}
+
+    def cas(self, args: dict):
+        """
+        Set only if the key is still at version, -1 meaning it must not
+        exist yet. Otherwise VersionMismatchError with the current version.
+        """
+        key, val = key_arg(args), args.get("value")
+        expected = int(args.get("version", -1))
+        expires = expiry_from(args)
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            slot = self.live(key, idx)
+            actual = -1 if slot is None else slot.version
+            if actual != expected:
+                raise VersionMismatchError(key, expected, actual)
+            slot = self.addslot(key, idx)
+            self.publish(key, slot, str(val), expires)
+            version = slot.version
+            lsn = self.journal_set(key, slot)
+        self.watches.fire(key)
+        self.commit(lsn)
+        return {"version": version}
+
+    def incr(self, args: dict):
+        """Add an integer, by (default 1), to the key's value"""
+        by = args.get("by", 1)
+        if isinstance(by, str):
+            by = int(by)
+        if not isinstance(by, int) or isinstance(by, bool):
+            raise ValueError("incr takes an integer")
+        return self.add(dict(args, delta=by))
+
+    def add(self, args: dict):
+        """
+        Add delta to the key's numeric value under the stripe lock, a
+        missing key counts as 0. Answers {"value", "version"} after the add.
+        Keeps the key's expiry unless a new ttl is given.
+        """
+        key = key_arg(args)
+        delta = args.get("delta", 0)
+        if isinstance(delta, str):
+            delta = parse_number(delta)
+        if not isinstance(delta, (int, float)) or isinstance(delta, bool):
+            raise ValueError("add takes a number")
+        if not math.isfinite(delta):
+            raise ValueError("add takes a finite number")
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            slot = self.live(key, idx)
+            current = 0 if slot is None else parse_number(slot.value)
+            expires = expiry_from(args, 0 if slot is None else slot.expires)
+            val = str(current + delta)
+            slot = self.addslot(key, idx)
+            self.publish(key, slot, val, expires)
+            version = slot.version
+            lsn = self.journal_set(key, slot)
+        self.watches.fire(key)
+        self.commit(lsn)
+        return {"value": val, "version": version}
+
+    def get(self, args: dict):
+        """
+        Fetch the value and associated version, already JSON encoded.
+        Tagged "<version>-<revision>-<epoch>", no body if that's current.
+        """
+        key = key_arg(args)
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            o = self.live(key, idx)
+            if o is None:
+                raise HashKeyNotFoundError(key)
+            body, version, revision = o.encoded, o.version, o.revision
+        etag = '"{}-{}-{}"'.format(version, revision, self.epoch[:8])
+        if etag_matches(args.get("ifnonematch"), etag):
+            return Tagged(None, etag)
+        return Tagged(body, etag)
+
+    def delete(self, args: dict):
+        key = key_arg(args)
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            ref = self.unlink(key, idx)
+            if ref is None:
+                return {"version": -1}
+            lsn = self.journal_delete(key)
+        self.watches.fire(key)
+        self.commit(lsn)
+        if ref.expired(time.time()):
             return {"version": -1}
-        ref = self.table[key]
-        del self.table[key]
         return {"lastversion": ref.version}
 
-    def listAll(self, keytup: tuple):
+    def listAll(self, args: dict):
         """
-        Serialize the whole map
-        Client may send a regex filter in the query, for now that's unused
+        Serialize the map, in key order, optionally narrowed down by
+            prefix: keys starting with this, served from the sorted index
+            filter: regex keys have to match (re.search)
+        With limit set the listing is paged: the answer is
+        {"entries": {...}, "cursor": key or null, "seq", "epoch"}, pass
+        cursor back to get the next page, and seq and epoch too for it to
+        come from the same snapshot. Without limit the whole match comes
+        back as one map.
+
+        The listing is the table as of one revision, see snapshot_items(),
+        writers never wait on it. Result is the join of each entry's cached
+        JSON.
+
+        Tagged with the snapshot's revision. A listing can only differ from
+        another with the same tag if the table changed, so a matching
+        If-None-Match against the current revision skips the scan entirely.
         """
-        doc = {}
-        for key in self.table:
-            vref = self.table[key]
-            doc[key] = {"value": vref.value(), "version": vref.version}
-        return doc
+        at = None
+        if "seq" in args:
+            at = int(args["seq"])
+            if args.get("epoch", self.epoch) != self.epoch:
+                raise SnapshotExpiredError(at)
+        else:
+            etag = '"{}-{}"'.format(self.revision, self.epoch[:8])
+            if etag_matches(args.get("ifnonematch"), etag):
+                return Tagged(None, etag)
 
-    # not public interface
-    def addslot(self, keytup):
-        """Make sure there's a slot (and table) set up. Don't need latter anymore"""
-        key = keytup
-        if key in self.table:
+        prefix = args.get("prefix", "")
+        pattern = args.get("filter", "")
+        after = args.get("cursor")
+        limit = None
+        if "limit" in args:
+            limit = min(max(int(args["limit"]), 1), MAX_LIST_PAGE)
+
+        regex = None
+        possible = True
+        if pattern:
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                raise ValueError(str(e))
+            hint = literal_prefix(pattern)
+            if hint.startswith(prefix):
+                prefix = hint
+            elif not prefix.startswith(hint):
+                possible = False  # prefix and regex can't both match
+
+        # Without a regex a page never needs more keys than its size
+        scanlimit = limit if regex is None else None
+        scanned = []
+
+        def candidates():
+            scanned[:] = self.index.scan(prefix, after, scanlimit) if possible else []
+            return scanned
+
+        def in_range(key: str) -> bool:
+            """Could a key deleted since the snapshot belong in this listing"""
+            if not possible or not key.startswith(prefix):
+                return False
+            if after is not None and key <= after:
+                return False
+            full = scanlimit is not None and len(scanned) == scanlimit
+            return not full or key <= scanned[-1]
+
+        seq, found = self.snapshot_items(candidates, in_range, at)
+        keys = list(found)
+        if regex is not None:
+            keys = [k for k in keys if regex.search(k)]
+        cursor = None
+        if limit is not None and len(keys) >= limit:
+            keys = keys[:limit]
+            cursor = keys[-1]
+        elif scanlimit is not None and len(scanned) == scanlimit:
+            cursor = scanned[-1]
+
+        etag = '"{}-{}"'.format(seq, self.epoch[:8])
+        items = found.values() if len(keys) == len(found) else [found[k] for k in keys]
+        listing = encode_listing(items)
+        if limit is None:
+            return Tagged(listing, etag)
+
+        head = {"cursor": cursor, "seq": seq, "epoch": self.epoch}
+        head = bytes(json.dumps(head)[:-1], "utf-8")
+        return Tagged(head + b', "entries": ' + listing + b"}", etag)
+
+    def mget(self, args: dict):
+        """
+        Fetch several keys in one request, same document shape as listAll.
+        Missing keys are left out rather than failing the batch. The values
+        are all as of one revision, like snapshot without the wrapper.
+        """
+        return encode_listing(self.read_keys(args)[1].values())
+
+    def snapshot(self, args: dict):
+        """
+        Several keys as they all were at one table revision, for values
+        that only make sense together. Keys as for mget, answers
+        {"seq", "epoch", "entries": {key: {"value", "version"}}}. seq (and
+        epoch) from an earlier answer reads as of that revision again, as
+        long as the change log still reaches back to it.
+        """
+        seq, found = self.read_keys(args)
+        head = {"seq": seq, "epoch": self.epoch}
+        head = bytes(json.dumps(head)[:-1], "utf-8")
+        return head + b', "entries": ' + encode_listing(found.values()) + b"}"
+
+    def mset(self, args: dict):
+        """
+        Set several keys in one request, each stripe lock is taken once.
+        Takes {"items": {key: value}} in the body or key=&value= pairs.
+        A ttl applies to every key in the batch.
+        """
+        if "items" in args:
+            values = args["items"]
+        else:
+            if len(args["keys"]) != len(args["values"]):
+                raise ValueError("mset needs a value for every key")
+            values = dict(zip(args["keys"], args["values"]))
+        if not isinstance(values, dict) or not all(
+            isinstance(v, str) for v in values.values()
+        ):
+            raise ValueError("mset items must map keys to string values")
+        expires = expiry_from(args)
+
+        versions = {}
+        lsn = 0
+        for idx, keys in self.group_by_stripe(values).items():
+            with self.locks[idx]:
+                for key in keys:
+                    slot = self.addslot(key, idx)
+                    self.publish(key, slot, values[key], expires)
+                    versions[key] = slot.version
+                    lsn = self.journal_set(key, slot)
+        for key in versions:
+            self.watches.fire(key)
+        self.commit(lsn)
+        return {"versions": versions}
+
+    def mdelete(self, args: dict):
+        """Delete several keys, -1 is reported for keys that didn't exist"""
+        lastversions = {}
+        lsn = 0
+        for idx, keys in self.group_by_stripe(keys_arg(args)).items():
+            with self.locks[idx]:
+                for key in keys:
+                    ref = self.unlink(key, idx)
+                    if ref is None:
+                        lastversions[key] = -1
+                        continue
+                    lastversions[key] = ref.version
+                    lsn = self.journal_delete(key)
+        for key, version in lastversions.items():
+            if version != -1:
+                self.watches.fire(key)
+        self.commit(lsn)
+        return {"lastversions": lastversions}
+
+    def watch(self, args: dict):
+        """
+        Long-poll for changes to key, or to any key starting with prefix.
+        key form: since is a version, answers once the key's version differs
+            (-1 meaning missing). Defaults to the current version.
+        prefix form: since is a table revision from an earlier answer,
+            answers once something under prefix changed after it. Defaults
+            to the current revision.
+        Answers {"revision", "changes": {key: {"value", "version"} or null}}
+        plus "version" for the key form. changes is empty on timeout.
+        Returns a Watch instead when there's nothing yet, the server waits
+        on it and then calls finish_watch.
+        """
+        key, prefix = args.get("key"), args.get("prefix")
+        if key is None and prefix is None:
+            raise ValueError("watch needs a key or a prefix")
+        if key is not None:
+            key, prefix = key_arg(args), None
+        elif not isinstance(prefix, str):
+            raise ValueError("prefix must be a string")
+        timeout = float(args.get("timeout", DEFAULT_WATCH_TIMEOUT_S))
+        since = int(args["since"]) if "since" in args else None
+
+        # Register before looking so a change in between can't slip past
+        w = Watch(key, prefix, timeout)
+        self.watches.add(w)
+
+        if key is not None:
+            version = self.current_version(key)
+            if since is not None and since != version:
+                w.changed.append(key)
+        elif since is not None:
+            with self.seqlock:
+                revision = self.revision
+                logged = None
+                if self.changelog.covers(since):
+                    logged = self.changelog.after(since, revision - since)
+            if logged is not None:
+                w.changed.extend(c[1] for c in logged if c[1].startswith(prefix))
+            elif since < revision:
+                w.changed.extend(self.changed_under(prefix, since))
+
+        if w.changed:
+            return self.finish_watch(w)
+        return w
+
+    def changes(self, args: dict):
+        """
+        Incremental sync. Returns the changes after sequence number since,
+        oldest first, as {"seq", "key", "entry": {"value", "version"} or
+        null for a delete}, at most limit of them. "seq" in the answer is
+        where to resume from.
+        If the log doesn't reach back to since, or epoch isn't this
+        process's, the answer has "reset": true instead. The caller should
+        take a full listall and resume from the returned seq; replaying
+        changes over a newer listing converges on the same state.
+        """
+        since = int(args.get("since", 0))
+        limit = min(max(int(args.get("limit", MAX_LIST_PAGE)), 1), MAX_LIST_PAGE)
+        epoch = args.get("epoch", self.epoch)
+
+        with self.seqlock:
+            current = self.revision
+            stale = epoch != self.epoch or not self.changelog.covers(since)
+            if not stale:
+                logged = self.changelog.after(since, limit)
+
+        head = {"epoch": self.epoch, "seq": current}
+        if stale:
+            head["reset"] = True
+            return head
+        if logged:
+            head["seq"] = logged[-1][0]
+
+        frags = []
+        for seq, _, keyjson, encoded, _ in logged:
+            frag = '{{"seq": {}, "key": '.format(seq).encode("utf-8") + keyjson
+            frags.append(frag + b', "entry": ' + (encoded or b"null") + b"}")
+        head = bytes(json.dumps(head)[:-1], "utf-8")
+        return head + b', "changes": [' + b", ".join(frags) + b"]}"
+
+    def finish_watch(self, w: Watch) -> bytes:
+        """Unpark w and encode whatever changed while it waited"""
+        # Where the client resumes from is read while w still collects
+        # changes, a write in between shows up twice rather than never
+        with self.seqlock:
+            revision = self.revision
+        head = {"revision": revision}
+        if w.key is not None:
+            head["version"] = self.current_version(w.key)
+        self.watches.remove(w)
+
+        frags = []
+        for key in dict.fromkeys(w.changed):
+            idx = self.stripe_index(key)
+            with self.locks[idx]:
+                o = self.stripes[idx].get(key)
+                encoded = b"null" if o is None else o.encoded
+            frags.append(bytes(json.dumps(key), "utf-8") + b": " + encoded)
+
+        head = bytes(json.dumps(head)[:-1], "utf-8")
+        return head + b', "changes": {' + b", ".join(frags) + b"}}"
+
+    def stats(self, args: dict):
+        """Size of the table and what expiry/eviction have dropped so far"""
+        with self.seqlock:
+            return {
+                "keys": len(self.index.keys),
+                "memory": self.memory,
+                "memory_cap": self.memory_cap,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "pending_expiry": len(self.expiry_heap),
+                "revision": self.revision,
+            }
+
+    def expiries(self, args: dict):
+        """
+        Seconds each of keys has left before it expires, 0 for keys that
+        never do. Missing and expired keys are left out.
+        """
+        now = time.time()
+        left = {}
+        for idx, keys in self.group_by_stripe(keys_arg(args)).items():
+            with self.locks[idx]:
+                for key in keys:
+                    o = self.stripes[idx].get(key)
+                    if o is None or o.version < 0 or o.expired(now):
+                        continue
+                    left[key] = o.expires - now if o.expires else 0
+        return left
+
+    def entries(self):
+        """Yield (key, value, version, expires), copying one stripe at a time"""
+        for idx, stripe in enumerate(self.stripes):
+            with self.locks[idx]:
+                items = [(k, o.value, o.version, o.expires) for k, o in stripe.items()]
+            yield from items
+
+    def load_entry(self, key: str, value: str, version: int, expires: float = 0):
+        """Put back an entry exactly as it was, used when recovering"""
+        if expires and expires <= time.time():
+            self.drop_entry(key)
             return
-        self.table[key] = VersionedPickle()
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            slot = self.addslot(key, idx)
+            slot.version = version - 1
+            self.publish(key, slot, value, expires)
+
+    def drop_entry(self, key: str):
+        """Remove an entry without logging it, used when recovering"""
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            self.unlink(key, idx)
+
+    # not public interface
+    def stripe_index(self, key) -> int:
+        """Stripe that owns key"""
+        return hash(key) % len(self.stripes)
+
+    def group_by_stripe(self, keys) -> dict:
+        """Bucket keys by owning stripe so a batch takes each lock once"""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.stripe_index(key), []).append(key)
+        return groups
+
+    def read_keys(self, args: dict) -> tuple:
+        """snapshot_items() for the keys of an mget/snapshot request"""
+        keys = keys_arg(args)
+        at = None
+        if "seq" in args:
+            at = int(args["seq"])
+            if args.get("epoch", self.epoch) != self.epoch:
+                raise SnapshotExpiredError(at)
+        return self.snapshot_items(lambda: keys, set(keys).__contains__, at, True)
+
+    def snapshot_items(self, candidates, in_range, at: int = None, touch=False):
+        """
+        Entries as of one table revision, the current one or at. Returns
+        (revision, {key: item}) without keys that were missing or expired,
+        in the order candidates() gave them.
+        candidates() lists the keys to look at that exist now. in_range(key)
+        says whether a key that has been deleted since belongs in the answer.
+
+        Slots are read without locks. Every write at or below the revision
+        had finished when it was read under seqlock, so a slot read that's
+        torn or too new belongs to a key changed after it. Those keys are
+        rolled back to the prior state their first later change log entry
+        kept. If writes wrap the change log during the scan it starts over.
+        touch counts the reads as uses for eviction.
+        """
+        stripes, nstripes = self.stripes, len(self.stripes)
+        for _ in range(SNAPSHOT_RETRIES):
+            with self.seqlock:
+                seq = self.revision if at is None else at
+                if seq > self.revision or not self.changelog.covers(seq):
+                    raise SnapshotExpiredError(seq)
+
+            found = {}
+            now, used = time.time(), time.monotonic()
+            for key in candidates():
+                o = stripes[hash(key) % nstripes].get(key)
+                if o is None or o.version < 0:
+                    continue
+                if o.expires == 0 or o.expires > now:
+                    found[key] = o.item
+                    if touch:
+                        o.touched = used
+
+            with self.seqlock:
+                if not self.changelog.covers(seq):
+                    continue
+                logged = self.changelog.after(seq, self.revision - seq)
+
+            undone = set()
+            restored = False
+            for _, key, _, _, prior in logged:
+                if key in undone or not in_range(key):
+                    continue
+                undone.add(key)
+                if prior is not None and (prior[1] == 0 or prior[1] > now):
+                    restored = restored or key not in found
+                    found[key] = prior[0]
+                else:
+                    found.pop(key, None)
+
+            # Keys came in order, ones put back go where they belong
+            if restored:
+                found = dict(sorted(found.items()))
+            return seq, found
+        raise SnapshotExpiredError(seq)
+
+    def publish(self, key: str, slot: VersionedValue, val: str, expires: float = 0):
+        """Update slot under the next revision. Caller holds the stripe lock"""
+        with self.seqlock:
+            self.revision += 1
+            prior = None
+            before = 0
+            if slot.version >= 0:
+                prior = (slot.item, slot.expires)
+                before = slot.size
+            slot.update(val, self.revision)
+            slot.expires = expires
+            self.memory += slot.size - before
+            self.changelog.append(self.revision, key, slot.keyjson, slot.encoded, prior)
+        slot.touched = time.monotonic()
+        if expires:
+            with self.expirylock:
+                # A sooner entry already queued gets this one requeued by reap()
+                if slot.queued == 0 or expires < slot.queued:
+                    if slot.queued:
+                        self.stale_expiry += 1
+                    slot.queued = expires
+                    heapq.heappush(self.expiry_heap, (expires, key))
+
+    def unlink(self, key: str, idx: int):
+        """Remove key under the next revision. Caller holds the stripe lock"""
+        with self.seqlock:
+            ref = self.stripes[idx].pop(key, None)
+            if ref is not None:
+                self.revision += 1
+                prior = None
+                if ref.version >= 0:
+                    self.memory -= ref.size
+                    prior = (ref.item, ref.expires)
+                self.changelog.append(self.revision, key, ref.keyjson, None, prior)
+        if ref is not None:
+            self.index.discard(key)
+            if ref.queued:
+                with self.expirylock:
+                    self.stale_expiry += 1
+        return ref
+
+    def live(self, key: str, idx: int):
+        """
+        Slot for key unless it's missing or expired, counts as a use for
+        eviction. Caller holds the stripe lock
+        """
+        o = self.stripes[idx].get(key)
+        if o is None or o.expired(time.time()):
+            return None
+        o.touched = time.monotonic()
+        return o
+
+    def reap(self) -> int:
+        """Drop every entry whose expiry has passed, returns how many"""
+        dropped = 0
+        while True:
+            now = time.time()
+            due = []
+            with self.expirylock:
+                if self.stale_expiry > max(len(self.expiry_heap) // 2, REAP_BATCH):
+                    self.compact_expiry()
+                heap = self.expiry_heap
+                while heap and heap[0][0] <= now and len(due) < REAP_BATCH:
+                    due.append(heapq.heappop(heap))
+            if not due:
+                return dropped
+
+            gone = []
+            lsn = 0
+            for queued, key in due:
+                idx = self.stripe_index(key)
+                with self.locks[idx]:
+                    slot = self.stripes[idx].get(key)
+                    if slot is None or slot.queued != queued:
+                        # Deleted, or superseded by a sooner entry
+                        with self.expirylock:
+                            self.stale_expiry -= 1
+                        continue
+                    if not slot.expired(now):
+                        # Rewritten since with a later deadline, or none
+                        with self.expirylock:
+                            slot.queued = slot.expires
+                            if slot.expires:
+                                heapq.heappush(self.expiry_heap, (slot.expires, key))
+                        continue
+                    with self.expirylock:
+                        slot.queued = 0
+                    self.unlink(key, idx)
+                    lsn = self.journal_delete(key)
+                gone.append(key)
+
+            with self.seqlock:
+                self.expired += len(gone)
+            for key in gone:
+                self.watches.fire(key)
+            self.commit(lsn)
+            dropped += len(gone)
+
+    def compact_expiry(self):
+        """
+        Rebuild the expiry heap without entries no key points at anymore.
+        Caller holds expirylock, queued only changes under it
+        """
+        live = []
+        for queued, key in self.expiry_heap:
+            slot = self.stripes[self.stripe_index(key)].get(key)
+            if slot is not None and slot.queued == queued:
+                live.append((queued, key))
+        heapq.heapify(live)
+        self.expiry_heap = live
+        self.stale_expiry = 0
+
+    def start_reaper(self, interval_s: float = REAP_INTERVAL_S):
+        """Background thread that calls reap() every interval_s"""
+
+        def loop():
+            while True:
+                time.sleep(interval_s)
+                self.reap()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def evict(self):
+        """
+        Drop entries until memory is back under memory_cap. Each victim is
+        the least recently used of EVICTION_SAMPLES random keys, an
+        approximation of LRU that needs no ordering kept on every read.
+        """
+        lsn = 0
+        while self.memory > self.memory_cap:
+            keys = self.index.keys
+            victim = None
+            for _ in range(EVICTION_SAMPLES):
+                try:
+                    key = random.choice(keys)
+                except IndexError:
+                    # Emptied out from under us
+                    break
+                o = self.stripes[self.stripe_index(key)].get(key)
+                if o is not None and (victim is None or o.touched < victim[1].touched):
+                    victim = (key, o)
+            if victim is None:
+                if not keys:
+                    break
+                continue
+
+            key, o = victim
+            idx = self.stripe_index(key)
+            with self.locks[idx]:
+                if self.stripes[idx].get(key) is not o:
+                    continue
+                self.unlink(key, idx)
+                lsn = self.journal_delete(key)
+            with self.seqlock:
+                self.evicted += 1
+            self.watches.fire(key)
+
+        if lsn:
+            self.journal.sync(lsn)
+
+    def current_version(self, key: str) -> int:
+        """Version of key, -1 when missing"""
+        idx = self.stripe_index(key)
+        with self.locks[idx]:
+            o = self.stripes[idx].get(key)
+            return -1 if o is None else o.version
+
+    def changed_under(self, prefix: str, since: int) -> list:
+        """
+        Keys under prefix updated after revision since, for when the change
+        log doesn't reach back that far. Deletes leave nothing behind to
+        find, those are only seen by a parked watch.
+        """
+        changed = []
+        for key in self.index.scan(prefix):
+            o = self.stripes[self.stripe_index(key)].get(key)
+            if o is not None and o.revision > since:
+                changed.append(key)
+        return changed
+
+    def journal_set(self, key, slot) -> int:
+        """Log a set, caller holds the stripe lock. Returns lsn, 0 if no journal"""
+        if self.journal is None:
+            return 0
+        rec = ["s", key, slot.value, slot.version]
+        if slot.expires:
+            rec.append(slot.expires)
+        return self.journal.append(rec)
+
+    def journal_delete(self, key) -> int:
+        """Log a delete, caller holds the stripe lock"""
+        if self.journal is None:
+            return 0
+        return self.journal.append(["d", key])
+
+    def commit(self, lsn: int):
+        """
+        Wait for logged changes up to lsn, then make room if writes went
+        over memory_cap. Called without stripe locks. With defer_sync the
+        caller's server does the waiting instead
+        """
+        if lsn and not self.defer_sync:
+            self.journal.sync(lsn)
+        if self.memory_cap and self.memory > self.memory_cap:
+            self.evict()
+
+    def addslot(self, key, idx: int):
+        """Make sure there's a slot set up. Caller holds the stripe lock"""
+        stripe = self.stripes[idx]
+        slot = stripe.get(key)
+        if slot is not None and slot.expired(time.time()):
+            # Starts over as a new key, like it had been reaped
+            self.unlink(key, idx)
+            with self.seqlock:
+                self.expired += 1
+            slot = None
+        if slot is None:
+            # Index first, a failure there mustn't leave a slot behind
+            slot = VersionedValue(key)
+            self.index.add(key)
+            stripe[key] = slot
+        return slot
+
+
+def dispatch(
+    state: VersionedHash, path: str, body: bytes = None, etag: str = None
+) -> tuple:
+    """
+    Run the command encoded in a URI path (and optional POST body) against state.
+    etag is the request's If-None-Match header.
+    Returns (http status, result). The result may be a Watch the server
+    still has to wait on before calling state.finish_watch, or Tagged.
+    """
+    # Handle browser stuff better..
+    if path.find("/favicon.ico") == 0:
+        return 204, b""  # no content
+
+    # Dispatch, catch errors due to malformed requests
+    try:
+        obj = state.call(path, body, etag)
+        if isinstance(obj, Tagged) and obj.body is None:
+            return 304, obj  # Client's copy is current
+        return 200, obj
+    except InvalidOperationError as e:
+        return 400, b""  # Operation not found
+    except ValueError as e:
+        return 400, b""  # Malformed body or argument
+    except HashKeyNotFoundError as e:
+        return 404, b""  # Resource not found
+    except VersionMismatchError as e:
+        return 409, {"error": "version mismatch", "version": e.actual}
+    except SnapshotExpiredError as e:
+        return 410, {"error": "snapshot expired", "seq": e.seq}
+    except kvs_raft.NotLeaderError as e:
+        return 421, {"error": "not leader", "leader": e.leader}
+    except kvs_raft.UnavailableError as e:
+        return 503, {"error": "unavailable", "reason": e.reason}
+
+
+def encode_result(obj) -> bytes:
+    """Hot paths hand back pre-encoded JSON"""
+    if isinstance(obj, bytes):
+        return obj
+    if isinstance(obj, Tagged):
+        return obj.body or b""
+    return bytes(json.dumps(obj), "utf-8")
+
+
+def handle_path(
+    state: VersionedHash, path: str, body: bytes = None, etag: str = None
+) -> tuple:
+    """
+    dispatch() for thread based servers, a watch blocks the calling thread.
+    Returns (http status, response body, ETag or None).
+    """
+    code, obj = dispatch(state, path, body, etag)
+    if isinstance(obj, Watch):
+        obj.wait()
+        obj = state.finish_watch(obj)
+    tag = obj.etag if isinstance(obj, Tagged) else None
+    return code, encode_result(obj), tag
 
 
 class KVSHandler(BaseHTTPRequestHandler):
-    """Exists to forward requests from do_GET to the singletonState class var"""
+    """
+    Exists to forward requests from do_GET to the singletonState class var
+    Speaks HTTP/1.1 so clients can keep connections open between requests,
+    which means every response has to carry a Content-Length.
+    """
 
     singletonState = VersionedHash()
 
+    protocol_version = "HTTP/1.1"
+
+    # Idle keep-alive connections get dropped after this
+    timeout = IDLE_TIMEOUT_S
+
+    # Header and body go out in separate writes, don't let them wait on ACKs
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         """Process command encoded in a URI"""
+        etag = self.headers.get("If-None-Match")
+        res = handle_path(KVSHandler.singletonState, self.path, None, etag)
+        self.respond(*res)
+
+    def do_POST(self):
+        """Same commands as GET, args may also come in as a JSON body"""
+        length = int(self.headers.get("Content-Length", 0))
+        reqbody = self.rfile.read(length)
+        etag = self.headers.get("If-None-Match")
+        res = handle_path(KVSHandler.singletonState, self.path, reqbody, etag)
+        self.respond(*res)
+
+    def log_request(self, code="-", size="-"):
+        """Raft heartbeats would drown out everything else"""
+        if not self.path.startswith("/raft/"):
+            super().log_request(code, size)
+
+    def respond(self, code: int, body: bytes, etag: str = None):
+        """Status header, followed by data"""
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
 
-        def setup_response(code: int):
-            """Util to send HTTP header"""
-            self.send_response(code)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
 
-        # Handle browser stuff better..
-        if self.path.find("/favicon.ico") == 0:
-            setup_response(204)  # no content
-            self.wfile.write(bytes("", "utf-8"))
+class KVSHTTPServer(HTTPServer):
+    """Single threaded server, one request is handled at a time"""
+
+    # Lots of clients may connect at once, default backlog of 5 drops SYNs
+    request_queue_size = 128
+
+
+class ThreadingKVSHTTPServer(socketserver.ThreadingMixIn, KVSHTTPServer):
+    """Thread per connection, VersionedHash stripes keep them out of each other's way"""
+
+    daemon_threads = True
+
+
+class AsyncKVSServer(object):
+    """
+    Event loop server. Slow clients only cost a parked coroutine rather
+    than a thread. Operations run inline on the loop since none of them block,
+    watches are parked as futures so thousands of them cost no threads.
+    Same HTTP/1.1 keep-alive behavior as KVSHandler.
+
+    With a write-ahead log the fsync a write waits for runs in an executor
+    thread, see durable(), and the answer goes out once it's done. Deletes
+    the reaper logs ride along with the next one.
+    """
+
+    __slots__ = "host", "port", "state", "flush"
+
+    def __init__(self, host: str, port: int, state: VersionedHash):
+        self.host = host
+        self.port = port
+        self.state = state
+        self.flush = None
+        state.defer_sync = True
+
+    async def durable(self, lsn: int):
+        """
+        Wait until the log is synced through lsn. One fsync runs at a
+        time, writers arriving meanwhile wait for it and then share the
+        next one, which covers everything appended by then.
+        """
+        journal = self.state.journal
+        if journal.policy != kvs_wal.FSYNC_ALWAYS:
             return
+        while journal.synced_lsn < lsn:
+            flush = self.flush
+            if flush is None or flush.done():
+                loop = asyncio.get_running_loop()
+                flush = loop.run_in_executor(None, journal.sync, journal.lsn)
+                self.flush = flush
+            await flush
 
-        # Dispatch, catch errors due to malformed requests
-        obj = None
+    async def handle_conn(self, reader, writer):
+        """
+        Serve requests on a connection until the client closes it, asks
+        for close, speaks HTTP/1.0 without keep-alive, or goes idle.
+        """
         try:
-            obj = KVSHandler.singletonState.call(self.path)
-        except InvalidOperationError as e:
-            setup_response(400)  # Operation not found
-            return
-        except HashKeyNotFoundError as e:
-            setup_response(404)  # Resource not found
-            return
+            keepalive = True
+            while keepalive:
+                reqline = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT_S)
+                if not reqline:
+                    break
+                parts = reqline.decode("latin-1").split()
+                keepalive = len(parts) == 3 and parts[2] == "HTTP/1.1"
+
+                # Only Content-Length, Connection and If-None-Match matter
+                length = 0
+                etag = None
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, val = line.decode("latin-1").partition(":")
+                    name, val = name.strip().lower(), val.strip()
+                    if name == "content-length":
+                        length = int(val)
+                    elif name == "if-none-match":
+                        etag = val
+                    elif name == "connection":
+                        val = val.lower()
+                        keepalive = val == "keep-alive" or (
+                            keepalive and val != "close"
+                        )
 
-        # Success header, followed by data
-        setup_response(200)
-        outbytes = json.dumps(obj)
-        self.wfile.write(bytes(outbytes, "utf-8"))
+                reqbody = await reader.readexactly(length) if length else None
+                tag = None
+                if len(parts) < 2:
+                    code, body = 400, b""
+                    keepalive = False
+                elif parts[0] not in ("GET", "POST"):
+                    code, body = 501, b""
+                else:
+                    journal = self.state.journal
+                    logged = journal.lsn if journal else 0
+                    code, obj = dispatch(self.state, parts[1], reqbody, etag)
+                    if journal and journal.lsn != logged:
+                        await self.durable(journal.lsn)
+                    if isinstance(obj, Watch):
+                        await obj.wait_async()
+                        obj = self.state.finish_watch(obj)
+                    if isinstance(obj, Tagged):
+                        tag = obj.etag
+                    body = encode_result(obj)
+
+                head = "HTTP/1.1 {} {}\r\n".format(code, HTTPStatus(code).phrase)
+                head += "Content-type: application/json\r\n"
+                head += "Content-Length: {}\r\n".format(len(body))
+                if tag:
+                    head += "ETag: {}\r\n".format(tag)
+                if not keepalive:
+                    head += "Connection: close\r\n"
+                writer.write(bytes(head + "\r\n", "latin-1") + body)
+                await writer.drain()
+        except (
+            ConnectionError,
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+            ValueError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        srv = await asyncio.start_server(
+            self.handle_conn, self.host, self.port, backlog=128
+        )
+        async with srv:
+            await srv.serve_forever()
 
 
 if __name__ == "__main__":
@@ -219,12 +1446,76 @@ if __name__ == "__main__":
     HOST = os.getenv("KVS_HOST", "127.0.0.1")
     PORT = int(os.getenv("KVS_PORT", 9090))
 
-    srv = HTTPServer((HOST, PORT), KVSHandler)
-    KVSHandler.singleton_state = VersionedHash()
+    # threaded | single | asyncio
+    MODE = os.getenv("KVS_SERVER", "threaded")
+    IDLE_TIMEOUT_S = float(os.getenv("KVS_IDLE_TIMEOUT_S", IDLE_TIMEOUT_S))
+    KVSHandler.timeout = IDLE_TIMEOUT_S
 
-    # Start listening
-    try:
-        srv.serve_forever()
-        print("kvs server started {}:{}".format(HOST, PORT))
-    except KeyboardInterrupt:
-        srv.socket.close()
+    # Durability is off unless a data directory is given
+    DATA_DIR = os.getenv("KVS_DATA_DIR", "")
+    FSYNC = os.getenv("KVS_FSYNC", kvs_wal.FSYNC_ALWAYS)
+    FSYNC_MS = int(os.getenv("KVS_FSYNC_MS", 5))
+    SNAPSHOT_S = float(os.getenv("KVS_SNAPSHOT_S", 300))
+    CHANGELOG_SIZE = int(os.getenv("KVS_CHANGELOG_SIZE", DEFAULT_CHANGELOG_SIZE))
+
+    # Comma separated host:port of every node, this one included
+    RAFT_PEERS = os.getenv("KVS_RAFT_PEERS", "")
+    RAFT_MAX_STALE_MS = int(
+        os.getenv("KVS_RAFT_MAX_STALE_MS", kvs_raft.DEFAULT_MAX_STALE_MS)
+    )
+
+    # Evict least recently used entries past this many MB, 0 for no cap
+    MEMORY_CAP_MB = float(os.getenv("KVS_MEMORY_CAP_MB", 0))
+
+    KVSHandler.singletonState.changelog = ChangeLog(CHANGELOG_SIZE)
+    KVSHandler.singletonState.memory_cap = int(MEMORY_CAP_MB * 1024 * 1024)
+
+    if DATA_DIR:
+        wal = kvs_wal.WriteAheadLog(DATA_DIR, FSYNC, FSYNC_MS)
+        replayed = wal.recover(KVSHandler.singletonState)
+        print("kvs recovered from {}, replayed {} records".format(DATA_DIR, replayed))
+        KVSHandler.singletonState.journal = wal
+        wal.start(KVSHandler.singletonState, SNAPSHOT_S)
+
+    KVSHandler.singletonState.start_reaper()
+
+    if RAFT_PEERS:
+        if DATA_DIR or MODE != "threaded":
+            raise ValueError("KVS_RAFT_PEERS needs KVS_SERVER=threaded, no data dir")
+        if MEMORY_CAP_MB:
+            raise ValueError("KVS_RAFT_PEERS can't be used with KVS_MEMORY_CAP_MB")
+        node = kvs_raft.RaftNode(
+            "{}:{}".format(HOST, PORT),
+            RAFT_PEERS.split(","),
+            KVSHandler.singletonState,
+            RAFT_MAX_STALE_MS,
+        )
+        KVSHandler.singletonState = node
+        node.start()
+
+    print("kvs server starting {}:{} ({})".format(HOST, PORT, MODE))
+
+    if MODE == "asyncio":
+        srv = AsyncKVSServer(HOST, PORT, KVSHandler.singletonState)
+        try:
+            asyncio.run(srv.serve_forever())
+        except KeyboardInterrupt:
+            pass
+    else:
+        if MODE == "single":
+            # A kept-alive connection would starve everyone else
+            KVSHandler.protocol_version = "HTTP/1.0"
+            srv = KVSHTTPServer((HOST, PORT), KVSHandler)
+        elif MODE == "threaded":
+            srv = ThreadingKVSHTTPServer((HOST, PORT), KVSHandler)
+        else:
+            raise ValueError("unknown KVS_SERVER mode: {}".format(MODE))
+
+        # Start listening
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            srv.socket.close()
+
+    if DATA_DIR:
+        wal.close()
@@ -0,0 +1,134 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+
+import kvs_bench
+import kvs_client
+import kvs_rebalance
+
+"""
+Starts shard processes on consecutive ports from KVS_PORT (default 9111),
+checks fan-out operations through ShardedKVSClient, then grows the shard
+list and rebalances.
+"""
+
+
+def test_ring_movement():
+    """Adding a 5th shard moves about 1/5 of the keys, all to the new one"""
+    keys = ["ring/key{}".format(i) for i in range(20000)]
+    hosts = ["10.0.0.{}:9090".format(i) for i in range(4)]
+    before = kvs_client.HashRing(hosts)
+    after = kvs_client.HashRing(hosts + ["10.0.0.9:9090"])
+
+    moved = [k for k in keys if before.lookup(k) != after.lookup(k)]
+    assert all(after.lookup(k) == "10.0.0.9:9090" for k in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.25, len(moved)
+
+    # No shard ends up with a wildly uneven share
+    shares = [len(ks) for ks in before.split(keys).values()]
+    assert max(shares) < 1.3 * len(keys) / len(hosts), shares
+
+
+def test_fanout(client):
+    items = {"shard/k{:03d}".format(i): str(i) for i in range(200)}
+    resp = client.setVals(items)
+    assert set(resp["versions"]) == set(items)
+
+    # Every shard got some of them
+    for host in client.hosts:
+        assert kvs_client.HttpKVSClient(host).listAll(prefix="shard/")
+
+    resp = client.getVals(list(items) + ["shard/missing"])
+    assert {k: e["value"] for k, e in resp.items()} == items
+    assert client.getVal("shard/k007")["value"] == "7"
+
+    # Merged listing comes back in key order, paging lines up across shards
+    listing = client.listAll(prefix="shard/")
+    assert list(listing) == sorted(items)
+    assert [k for k, _ in client.scan(prefix="shard/", page_size=7)] == sorted(items)
+    assert list(client.listAll("7$", "shard/")) == sorted(
+        k for k in items if k.endswith("7")
+    )
+
+    resp = client.delVals(["shard/k000", "shard/k001"])
+    assert resp == {"lastversions": {"shard/k000": 0, "shard/k001": 0}}
+
+
+def test_rebalance(old_hosts: list, new_hosts: list):
+    client = kvs_client.ShardedKVSClient(old_hosts)
+    client.setVals({"shard/ttl{}".format(i): "t" for i in range(20)}, ttl=600)
+    expected = client.listAll(prefix="shard/")
+    client.close()
+
+    # Nothing is deleted from the old shards when the copies fail
+    dead = kvs_rebalance.rebalance(old_hosts, old_hosts + ["127.0.0.1:1"], 50)
+    assert dead["moved"] == 0 and dead["failed"] > 0, dead
+    client = kvs_client.ShardedKVSClient(old_hosts)
+    assert client.listAll(prefix="shard/") == expected
+    client.close()
+
+    # A key a client already wrote on its new owner wins over the old copy
+    ring = kvs_client.HashRing(new_hosts)
+    newer = [k for k in expected if ring.lookup(k) not in old_hosts][0]
+    owner = kvs_client.HttpKVSClient(ring.lookup(newer))
+    owner.setVal(newer, "newer")
+    owner.close()
+
+    report = kvs_rebalance.rebalance(old_hosts, new_hosts, batch=50)
+    assert report["scanned"] == len(expected)
+    assert 0 < report["moved"] < len(expected) / 2, report
+    assert report["kept"] == 1 and report["failed"] == 0, report
+    expected[newer] = {"value": "newer"}
+
+    client = kvs_client.ShardedKVSClient(new_hosts)
+    after = client.listAll(prefix="shard/")
+    assert {k: e["value"] for k, e in after.items()} == {
+        k: e["value"] for k, e in expected.items()
+    }
+
+    # Moved or not, ttl keys keep about the time they had left
+    for host, keys in client.ring.split(k for k in after if "/ttl" in k).items():
+        left = kvs_client.HttpKVSClient(host).expiries(keys)
+        assert all(500 < left[k] <= 600 for k in keys), left
+    # Every key is where the new ring says, and only there
+    for host in new_hosts:
+        for key in kvs_client.HttpKVSClient(host).listAll(prefix="shard/"):
+            assert client.ring.lookup(key) == host, (key, host)
+    client.close()
+    print("rebalance moved {} of {} keys".format(report["moved"], len(expected)))
+
+
+if __name__ == "__main__":
+    PORT = int(os.getenv("KVS_PORT", 9111))
+
+    test_ring_movement()
+
+    hosts = ["127.0.0.1:{}".format(PORT + i) for i in range(4)]
+    procs = []
+    try:
+        for i in range(len(hosts)):
+            procs.append(kvs_bench.start_service(PORT + i))
+
+        client = kvs_client.ShardedKVSClient(hosts[:3])
+        test_fanout(client)
+        client.close()
+        test_rebalance(hosts[:3], hosts)
+    finally:
+        for proc in procs:
+            kvs_bench.stop_service(proc)
+
+    print("Got here without breaking an assert - PASS")
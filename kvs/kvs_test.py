@@ -14,12 +14,20 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import asyncio
+import kvs_async_client
+import kvs_bench
 import kvs_client
 import os
+import signal
+import socket
+import tempfile
 import urllib.error
 import urllib.parse
 import urllib.request
 import json
+import threading
+import time
 
 
 def test_clear_all(client):
@@ -27,9 +35,9 @@ def test_clear_all(client):
     if contents == None:
         return
     startCount = len(contents)
+    resp = client.delVals(list(contents))
     for key in contents:
-        resp = client.delVal(key)
-        assert "lastversion" in resp
+        assert key in resp["lastversions"]
 
     contents = client.listAll()
     endCount = len(contents)
@@ -56,6 +64,457 @@ def test_query_val_escape(client):
     assert "lastversion" in resp
 
 
+def test_bad_requests(client):
+    """Malformed keys and batches are a 400, nothing gets half created"""
+    before = client.listAll()
+    assert "error" in client.do_rpc("/set", "value=1")
+    assert "error" in client.do_rpc("/set", "", {"key": 5, "value": "1"})
+    assert "error" in client.do_rpc("/incr", "", {"key": ["x"]})
+    assert "error" in client.do_rpc("/get", "")
+    assert "error" in client.do_rpc("/watch", "", {"prefix": 1, "timeout": 0})
+    for body in ({"delta": None}, {"delta": [1]}, {"delta": "x"}, {"by": True}):
+        path = "/incr" if "by" in body else "/add"
+        body = dict(body, key="bad_key_test")
+        assert "error" in client.do_rpc(path, "", body), body
+    assert "error" in client.do_rpc("/add", "key=bad_key_test&delta=nan")
+
+    # Batches need a list of string keys, mset a map of strings
+    for body in ({"keys": 5}, {"keys": [[1]]}, {"keys": "abc"}):
+        for path in ("/mget", "/snapshot", "/mdelete"):
+            assert "error" in client.do_rpc(path, "", body), (path, body)
+    assert "error" in client.do_rpc("/mset", "key=a&value=1&key=b")
+    assert "error" in client.do_rpc("/mset", "key=a&value=1&value=2")
+    for items in (["a"], {"a": 1}, {"a": None}):
+        assert "error" in client.do_rpc("/mset", "", {"items": items}), items
+    assert client.listAll() == before
+
+    # The connection survives it
+    assert client.setVal("bad_key_test", "x")["version"] == 0
+    client.delVal("bad_key_test")
+
+
+def test_batch_ops(client):
+    items = {"batch_test_key{}".format(i): str(i) for i in range(100)}
+    resp = client.setVals(items)
+    assert all(resp["versions"][k] == 0 for k in items)
+    resp = client.setVals(items)
+    assert all(resp["versions"][k] == 1 for k in items)
+
+    keys = list(items) + ["batch_test_missing"]
+    resp = client.getVals(keys)
+    assert len(resp) == len(items)
+    for k, v in items.items():
+        assert resp[k] == {"value": v, "version": 1}
+
+    resp = client.delVals(keys)
+    assert resp["lastversions"]["batch_test_missing"] == -1
+    assert all(resp["lastversions"][k] == 1 for k in items)
+    assert client.getVals(keys) == {}
+
+
+def test_watch(client):
+    TEST_KEY = "watch_test/key"
+
+    client.setVal(TEST_KEY, "before")
+    delayed = lambda: (time.sleep(0.2), client.setVal(TEST_KEY, "after"))
+    threading.Thread(target=delayed).start()
+
+    changes = next(client.watch(key=TEST_KEY, timeout=5))
+    assert changes[TEST_KEY]["value"] == "after"
+
+    delayed = lambda: (time.sleep(0.2), client.delVal(TEST_KEY))
+    threading.Thread(target=delayed).start()
+    changes = next(client.watch(prefix="watch_test/", timeout=5))
+    assert changes == {TEST_KEY: None}
+
+
+def test_filtered_listing(client):
+    items = {"list_test/a/{}".format(i): str(i) for i in range(25)}
+    items["list_test/b/0"] = "b"
+    client.setVals(items)
+
+    resp = client.listAll(prefix="list_test/a/")
+    assert len(resp) == 25 and "list_test/b/0" not in resp
+    resp = client.listAll("^list_test/.*/0$")
+    assert sorted(resp) == ["list_test/a/0", "list_test/b/0"]
+    resp = client.listAll("^list_test/a/1$|^list_test/b/")
+    assert sorted(resp) == ["list_test/a/1", "list_test/b/0"]
+
+    paged = dict(client.scan(prefix="list_test/", page_size=10))
+    assert list(paged) == sorted(items)
+    client.delVals(list(items))
+
+
+def test_change_feed(client):
+    mirror = kvs_client.KVSMirror(client)
+    mirror.sync()
+    assert mirror.table == client.listAll()
+
+    client.setVals({"feed_test/a": "1", "feed_test/b": "2"})
+    client.setVal("feed_test/a", "3")
+    client.delVal("feed_test/b")
+    assert mirror.sync() == 4
+    assert mirror.table["feed_test/a"] == {"value": "3", "version": 1}
+    assert "feed_test/b" not in mirror.table
+    assert mirror.sync() == 0
+
+    resp = client.changes(mirror.seq, "not-the-epoch")
+    assert resp["reset"]
+    client.delVal("feed_test/a")
+
+
+def test_atomic_ops(client):
+    client.delVals(["atomic/counter", "atomic/cas", "atomic/float", "atomic/text"])
+
+    # incr/add create missing keys from 0
+    assert client.incrVal("atomic/counter") == {"value": "1", "version": 0}
+    assert client.incrVal("atomic/counter", 41) == {"value": "42", "version": 1}
+    assert client.incrVal("atomic/counter", -2)["value"] == "40"
+    assert client.addVal("atomic/float", 0.5)["value"] == "0.5"
+    assert client.addVal("atomic/float", 1e20)["value"] == "1e+20"
+    assert "error" in client.addVal("atomic/float", "x")
+
+    # Increments from concurrent clients aren't lost
+    threads = [
+        threading.Thread(
+            target=lambda: [client.incrVal("atomic/counter") for _ in range(100)]
+        )
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert client.getVal("atomic/counter")["value"] == "440"
+
+    # cas: -1 creates, then only the matching version wins
+    assert client.casVal("atomic/cas", "a", -1) == {"version": 0}
+    resp = client.casVal("atomic/cas", "b", -1)
+    assert resp == {"error": "version mismatch", "version": 0}
+    assert client.casVal("atomic/cas", "b", 0) == {"version": 1}
+    assert client.casVal("atomic/cas", "c", 0)["version"] == 1
+    assert client.getVal("atomic/cas")["value"] == "b"
+
+    # A failed cas on a missing key leaves nothing behind
+    client.casVal("atomic/cas-missing", "x", 3)
+    assert "atomic/cas-missing" not in client.listAll(prefix="atomic/")
+
+    client.setVal("atomic/text", "abc")
+    assert "error" in client.incrVal("atomic/text")
+    assert client.getVal("atomic/text") == {"value": "abc", "version": 0}
+
+
+def test_ttl(client):
+    client.delVals(["ttl/short", "ttl/long", "ttl/batch1", "ttl/batch2"])
+    before = client.stats()
+
+    assert client.setVal("ttl/short", "x", ttl=0.5) == {"version": 0}
+    assert client.setVal("ttl/long", "y", ttl=60) == {"version": 0}
+    client.setVals({"ttl/batch1": "1", "ttl/batch2": "2"}, ttl=0.5)
+    assert client.getVal("ttl/short")["value"] == "x"
+    assert len(client.listAll(prefix="ttl/")) == 4
+
+    # Gone on read as soon as it's due, reaped in the background after
+    time.sleep(0.6)
+    assert "error" in client.getVal("ttl/short")
+    assert list(client.listAll(prefix="ttl/")) == ["ttl/long"]
+    assert client.getVals(["ttl/short", "ttl/batch1"]) == {}
+    time.sleep(1)
+    stats = client.stats()
+    assert stats["expired"] >= before["expired"] + 3
+    assert stats["keys"] == before["keys"] + 1
+
+    # Setting an expired key starts it over at version 0
+    client.setVal("ttl/short", "again")
+    assert client.getVal("ttl/short") == {"value": "again", "version": 0}
+    assert "error" in client.setVal("ttl/short", "x", ttl=-1)
+    assert "error" in client.setVal("ttl/short", "x", ttl=float("nan"))
+    assert "error" in client.setVal("ttl/short", "x", ttl=float("inf"))
+    client.delVals(["ttl/short", "ttl/long"])
+
+    # Rewriting a key with a ttl keeps a single expiry entry for it
+    queued = client.stats()["pending_expiry"]
+    for i in range(500):
+        client.setVal("ttl/beat", str(i), ttl=3600)
+    assert client.stats()["pending_expiry"] <= queued + 1
+
+    # A later deadline than the queued one is honored when that comes due
+    client.setVal("ttl/beat", "soon", ttl=0.3)
+    client.setVal("ttl/beat", "later", ttl=60)
+    time.sleep(1.5)
+    assert client.getVal("ttl/beat")["value"] == "later"
+    client.setVal("ttl/beat", "last", ttl=0.3)
+    time.sleep(1.5)
+    assert client.stats()["keys"] == before["keys"]
+
+
+def test_conditional_reads(client):
+    client.setVal("etag/key", "a")
+    pool = kvs_client.ConnectionPool(client.uri_host)
+
+    status, headers, data = pool.request("GET", "/get?key=etag/key")
+    etag = headers["ETag"]
+    assert status == 200 and json.loads(data)["value"] == "a"
+    status, headers, data = pool.request(
+        "GET", "/get?key=etag/key", headers={"If-None-Match": etag}
+    )
+    assert (status, data, headers["ETag"]) == (304, b"", etag)
+
+    # Any change gets a new tag, for listings any change in the table
+    status, headers, _ = pool.request("GET", "/listall?prefix=etag/")
+    table_etag = headers["ETag"]
+    client.setVal("etag/key", "b")
+    status, headers, data = pool.request(
+        "GET", "/get?key=etag/key", headers={"If-None-Match": etag}
+    )
+    assert status == 200 and headers["ETag"] != etag
+    status, _, _ = pool.request(
+        "GET", "/listall?prefix=etag/", headers={"If-None-Match": table_etag}
+    )
+    assert status == 200
+    pool.close()
+
+    # Revalidating cache: unchanged reads come back as 304s
+    cached = kvs_client.HttpKVSClient(client.uri_host, cache_size=10)
+    assert cached.getVal("etag/key")["value"] == "b"
+    assert cached.getVal("etag/key")["value"] == "b"
+    assert cached.listAll(prefix="etag/") == cached.listAll(prefix="etag/")
+    assert (cached.cache.misses, cached.cache.revalidated) == (2, 2)
+    client.setVal("etag/key", "c")
+    assert cached.getVal("etag/key")["value"] == "c"
+
+    # With max_staleness, reads within it skip the server entirely
+    stale = kvs_client.HttpKVSClient(client.uri_host, 10, max_staleness=60)
+    stale.getVal("etag/key")
+    client.setVal("etag/key", "d")
+    assert stale.getVal("etag/key")["value"] == "c"
+    assert stale.cache.hits == 1
+    # but not after writing the key itself
+    stale.setVal("etag/key", "e")
+    assert stale.getVal("etag/key")["value"] == "e"
+    client.delVal("etag/key")
+
+
+def test_snapshot_reads(client):
+    client.setVals({"snap/relay": "on", "snap/interlock": "closed"})
+    snap = client.snapshot(["snap/relay", "snap/interlock", "snap/missing"])
+    assert set(snap["entries"]) == {"snap/relay", "snap/interlock"}
+
+    # Reading as of that seq again ignores what happened since
+    client.setVal("snap/relay", "off")
+    client.delVal("snap/interlock")
+    client.setVal("snap/missing", "new")
+    keys = ["snap/relay", "snap/interlock", "snap/missing"]
+    again = client.snapshot(keys, snap["seq"], snap["epoch"])
+    assert again == snap, again
+    assert client.snapshot(keys)["entries"]["snap/relay"]["value"] == "off"
+    resp = client.snapshot(keys, snap["seq"], "another-process")
+    assert resp["error"] == "snapshot expired", resp
+
+    # Later pages of a listing come from the first page's snapshot
+    items = {"snap/page/{:02d}".format(i): str(i) for i in range(30)}
+    client.setVals(items)
+    page = client.listAll(prefix="snap/page/", limit=10)
+    client.delVal("snap/page/15")
+    client.setVal("snap/page/25", "changed")
+    client.setVal("snap/page/255", "added")
+    rest = client.listAll(
+        "", "snap/page/", 100, page["cursor"], page["seq"], page["epoch"]
+    )
+    listed = dict(page["entries"], **rest["entries"])
+    assert {k: e["value"] for k, e in listed.items()} == items
+
+    # A writer keeps relay one step ahead of interlock, never behind
+    stop = threading.Event()
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            n += 1
+            client_w.setVal("snap/relay", str(n))
+            client_w.setVal("snap/interlock", str(n))
+
+    client_w = kvs_client.HttpKVSClient(client.uri_host)
+    client.setVals({"snap/relay": "0", "snap/interlock": "0"})
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        for _ in range(200):
+            seen = client.snapshot(["snap/relay", "snap/interlock"])["entries"]
+            gap = int(seen["snap/relay"]["value"]) - int(
+                seen["snap/interlock"]["value"]
+            )
+            assert gap in (0, 1), seen
+            seen = client.listAll("^snap/(relay|interlock)$")
+            gap = int(seen["snap/relay"]["value"]) - int(
+                seen["snap/interlock"]["value"]
+            )
+            assert gap in (0, 1), seen
+    finally:
+        stop.set()
+        t.join()
+    client_w.close()
+    client.delVals(list(items) + keys + ["snap/page/255"])
+
+
+def test_async_client(client):
+    async def run():
+        async with kvs_async_client.AsyncKVSClient(client.uri_host, 2) as aclient:
+            keys = ["async/k{}".format(i) for i in range(200)]
+            done = await aclient.setMany({k: k for k in keys})
+            assert all(r == {"version": 0} for r in done.values())
+
+            # 200 gets in flight over 2 connections, answers matched up
+            found = await aclient.getMany(keys)
+            assert all(found[k]["value"] == k for k in keys)
+            assert len(aclient.pool.conns) <= 2
+
+            listing = await aclient.listAll(prefix="async/")
+            assert sorted(listing) == sorted(keys)
+            assert "error" in await aclient.getVal("async/missing")
+            assert (await aclient.incrVal("async/count"))["value"] == "1"
+            resp = await aclient.delVals(keys + ["async/count"])
+            assert len(resp["lastversions"]) == 201
+
+    asyncio.run(run())
+
+
+def hang_up_on_writes() -> tuple:
+    """
+    Fake server that answers /get with {} on a kept-alive connection and
+    hangs up on anything else without answering, as if it died mid request.
+    Returns (authority, paths of the requests it got, serving thread)
+    """
+    srv = socket.create_server(("127.0.0.1", 0))
+    srv.settimeout(0.5)
+    seen = []
+
+    def handle(conn):
+        buf = b""
+        while True:
+            while b"\r\n\r\n" not in buf:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                buf += data
+            head, _, buf = buf.partition(b"\r\n\r\n")
+            path = head.split()[1].split(b"?")[0].decode()
+            seen.append(path)
+            if path != "/get":
+                return
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+
+    def serve():
+        with srv:
+            while True:
+                try:
+                    conn, _ = srv.accept()
+                except OSError:
+                    return
+                with conn:
+                    conn.settimeout(2)
+                    handle(conn)
+
+    t = threading.Thread(target=serve)
+    t.start()
+    return "127.0.0.1:{}".format(srv.getsockname()[1]), seen, t
+
+
+def test_no_resend():
+    """An incr lost to a reset may have been applied, it isn't sent again"""
+    authority, seen, t = hang_up_on_writes()
+    fake = kvs_client.HttpKVSClient(authority)
+    assert fake.getVal("k") == {}
+    assert "error" in fake.incrVal("k")
+    fake.close()
+    t.join()
+    assert seen == ["/get", "/incr"], seen
+
+    async def run():
+        async with kvs_async_client.AsyncKVSClient(authority) as aclient:
+            assert await aclient.getVal("k") == {}
+            assert "error" in await aclient.incrVal("k")
+
+    authority, seen, t = hang_up_on_writes()
+    asyncio.run(run())
+    t.join()
+    assert seen == ["/get", "/incr"], seen
+
+
+def test_idle_timeout(port: int):
+    """incr right after the server dropped an idle connection still works"""
+    for mode in ("threaded", "asyncio"):
+        env = {"KVS_SERVER": mode, "KVS_IDLE_TIMEOUT_S": "1"}
+        proc = kvs_bench.start_service(port, env)
+        try:
+            idler = kvs_client.HttpKVSClient("127.0.0.1:{}".format(port))
+            assert idler.incrVal("idle/n")["value"] == "1"
+            time.sleep(1.5)
+            assert idler.incrVal("idle/n")["value"] == "2", mode
+            time.sleep(1.5)
+            assert idler.getVal("idle/n")["value"] == "2", mode
+            idler.close()
+        finally:
+            kvs_bench.stop_service(proc)
+
+
+def test_recovery(port: int):
+    """Killed with -9, a server comes back from its data dir as it was"""
+    authority = "127.0.0.1:{}".format(port)
+    for mode in ("threaded", "asyncio"):
+        with tempfile.TemporaryDirectory() as datadir:
+            env = {"KVS_SERVER": mode, "KVS_DATA_DIR": datadir}
+
+            def restart(proc, extra=None):
+                proc.send_signal(signal.SIGKILL)
+                proc.wait()
+                return kvs_bench.start_service(port, dict(env, **(extra or {})))
+
+            proc = kvs_bench.start_service(port, env)
+            try:
+                c = kvs_client.HttpKVSClient(authority)
+                for i in range(3):
+                    c.setVal("wal/over", str(i))
+                c.setVal("wal/gone", "x")
+                c.delVal("wal/gone")
+                c.setVals({"wal/b{}".format(i): str(i) for i in range(10)})
+                c.delVals(["wal/b3", "wal/b4"])
+                for _ in range(5):
+                    c.incrVal("wal/n")
+                c.setVal("wal/ttl", "t", ttl=600)
+                expected = c.listAll(prefix="wal/")
+                c.close()
+
+                # Replayed from the log
+                proc = restart(proc)
+                c = kvs_client.HttpKVSClient(authority)
+                assert c.listAll(prefix="wal/") == expected, mode
+                assert 500 < c.expiries(["wal/ttl"])["wal/ttl"] <= 600
+                c.close()
+
+                # From a snapshot plus the log written after it
+                proc = restart(proc, {"KVS_SNAPSHOT_S": "0.5"})
+                c = kvs_client.HttpKVSClient(authority)
+                c.setVal("wal/over", "before snapshot")
+                deadline = time.time() + 10
+                while not [f for f in os.listdir(datadir) if f.endswith(".json")]:
+                    assert time.time() < deadline, "no snapshot written"
+                    time.sleep(0.1)
+                c.setVal("wal/over", "after snapshot")
+                c.delVal("wal/b0")
+                c.incrVal("wal/n")
+                expected = c.listAll(prefix="wal/")
+                c.close()
+
+                proc = restart(proc)
+                c = kvs_client.HttpKVSClient(authority)
+                assert c.listAll(prefix="wal/") == expected, mode
+                assert c.getVal("wal/over") == {"value": "after snapshot", "version": 4}
+                c.close()
+            finally:
+                kvs_bench.stop_service(proc)
+
+
 if __name__ == "__main__":
     HOST = os.getenv("KVS_HOST", "127.0.0.1")
     PORT = os.getenv("KVS_PORT", 9090)
@@ -67,5 +526,18 @@ if __name__ == "__main__":
     test_clear_all(client)
     test_value_version(client)
     test_query_val_escape(client)
+    test_bad_requests(client)
+    test_batch_ops(client)
+    test_watch(client)
+    test_filtered_listing(client)
+    test_change_feed(client)
+    test_atomic_ops(client)
+    test_ttl(client)
+    test_conditional_reads(client)
+    test_snapshot_reads(client)
+    test_async_client(client)
+    test_no_resend()
+    test_idle_timeout(PORT + 5)
+    test_recovery(PORT + 6)
 
     print("Got here without breaking an assert - PASS")
@@ -0,0 +1,267 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+import threading
+import time
+
+"""
+On disk layout, everything lives in one data directory:
+    wal-<segment>.log       one JSON array per line, ["s", key, value, version]
+                            or ["d", key]. Sets of keys with a ttl carry
+                            the time.time() they expire at as a 5th item
+    snapshot-<segment>.json one [key, value, version, expires] per line,
+                            covers every segment numbered below <segment>
+
+Records carry the resulting version rather than an operation to redo, so
+replaying a record the snapshot already reflects is harmless. That lets a
+snapshot be taken while writers keep going: rotate to a new segment, dump
+the table, and on restart replay from that segment onward.
+"""
+
+"ack once the record is fsynced, concurrent writers share one fsync"
+FSYNC_ALWAYS = "always"
+
+"ack once written to the OS, a background thread fsyncs every N ms"
+FSYNC_BATCH = "batch"
+
+"ack once written to the OS, leave flushing to the OS"
+FSYNC_NEVER = "never"
+
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_BATCH, FSYNC_NEVER)
+
+
+def segment_path(datadir: str, seg: int) -> str:
+    return os.path.join(datadir, "wal-{:08d}.log".format(seg))
+
+
+def snapshot_path(datadir: str, seg: int) -> str:
+    return os.path.join(datadir, "snapshot-{:08d}.json".format(seg))
+
+
+def list_numbered(datadir: str, prefix: str, suffix: str) -> list:
+    """Sorted segment numbers of files named <prefix><number><suffix>"""
+    nums = []
+    for name in os.listdir(datadir):
+        if name.startswith(prefix) and name.endswith(suffix):
+            digits = name[len(prefix) : len(name) - len(suffix)]
+            if digits.isdigit():
+                nums.append(int(digits))
+    return sorted(nums)
+
+
+def read_records(path: str):
+    """
+    Yield decoded lines from path. A crash can leave a torn last line,
+    everything from the first undecodable line on is ignored.
+    """
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                print("warn: torn record in {}, ignoring the rest".format(path))
+                return
+
+
+def fsync_dir(datadir: str):
+    """Make renames/creates in datadir durable"""
+    fd = os.open(datadir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog(object):
+    """
+    Append-only log of set/delete operations for VersionedHash.
+
+    append() writes the record to the current segment and returns its log
+    sequence number (lsn). sync(lsn) blocks until that record is durable
+    as far as the fsync policy promises. With FSYNC_ALWAYS the first caller
+    to find no fsync in flight does one for everything appended so far,
+    callers arriving meanwhile wait for it and usually find their record
+    already covered.
+    """
+
+    __slots__ = (
+        "datadir",
+        "policy",
+        "interval_s",
+        "cond",
+        "fd",
+        "segment",
+        "lsn",
+        "synced_lsn",
+        "syncing",
+        "snapshot_lsn",
+        "running",
+    )
+
+    def __init__(self, datadir: str, policy: str = FSYNC_ALWAYS, interval_ms: int = 5):
+        if policy not in FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy: {}".format(policy))
+        os.makedirs(datadir, exist_ok=True)
+        self.datadir = datadir
+        self.policy = policy
+        self.interval_s = interval_ms / 1000
+        self.cond = threading.Condition()
+        self.fd = None
+        self.segment = 0
+        self.lsn = 0
+        self.synced_lsn = 0
+        self.syncing = False
+        self.snapshot_lsn = 0
+        self.running = False
+
+    def recover(self, state) -> int:
+        """
+        Load the newest snapshot into state, replay the segments it doesn't
+        cover, then open a fresh segment for appends.
+        Returns the number of log records replayed.
+        """
+        snaps = list_numbered(self.datadir, "snapshot-", ".json")
+        segs = list_numbered(self.datadir, "wal-", ".log")
+
+        first = 0
+        if snaps:
+            first = snaps[-1]
+            for rec in read_records(snapshot_path(self.datadir, first)):
+                state.load_entry(*rec)
+
+        replayed = 0
+        for seg in segs:
+            if seg < first:
+                continue
+            for rec in read_records(segment_path(self.datadir, seg)):
+                if rec[0] == "s":
+                    state.load_entry(*rec[1:])
+                else:
+                    state.drop_entry(rec[1])
+                replayed += 1
+
+        # A replayed log isn't covered by a snapshot yet, make one due
+        if replayed:
+            self.snapshot_lsn = -1
+
+        self.segment = max(segs + snaps + [0]) + 1
+        self.fd = self.open_segment(self.segment)
+        return replayed
+
+    def append(self, rec: list) -> int:
+        """Write one record, returns its lsn for sync()"""
+        line = bytes(json.dumps(rec, separators=(",", ":")) + "\n", "utf-8")
+        with self.cond:
+            os.write(self.fd, line)
+            self.lsn += 1
+            return self.lsn
+
+    def sync(self, lsn: int):
+        """Block until lsn is as durable as the policy promises"""
+        if self.policy == FSYNC_ALWAYS:
+            self.wait_durable(lsn)
+
+    def snapshot(self, state):
+        """
+        Write a compact copy of state and drop the log it makes redundant.
+        Writers keep going, anything they change lands in the new segment.
+        """
+        with self.cond:
+            if self.lsn == self.snapshot_lsn:
+                return
+            seg = self.rotate()
+            self.snapshot_lsn = self.lsn
+
+        path = snapshot_path(self.datadir, seg)
+        with open(path + ".tmp", "wb") as f:
+            for entry in state.entries():
+                f.write(bytes(json.dumps(list(entry)) + "\n", "utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        fsync_dir(self.datadir)
+
+        # Older segments and snapshots are covered by the new snapshot now
+        for old in list_numbered(self.datadir, "wal-", ".log"):
+            if old < seg:
+                os.unlink(segment_path(self.datadir, old))
+        for old in list_numbered(self.datadir, "snapshot-", ".json"):
+            if old < seg:
+                os.unlink(snapshot_path(self.datadir, old))
+
+    def start(self, state, snapshot_s: float):
+        """Background thread for batched fsyncs and periodic snapshots"""
+
+        def loop():
+            next_snapshot = time.time() + snapshot_s
+            while self.running:
+                time.sleep(self.interval_s if self.policy == FSYNC_BATCH else 0.5)
+                if self.policy == FSYNC_BATCH:
+                    self.wait_durable(self.lsn)
+                if snapshot_s > 0 and time.time() >= next_snapshot:
+                    self.snapshot(state)
+                    next_snapshot = time.time() + snapshot_s
+
+        self.running = True
+        threading.Thread(target=loop, daemon=True).start()
+
+    def close(self):
+        self.running = False
+        self.wait_durable(self.lsn)
+        with self.cond:
+            os.close(self.fd)
+            self.fd = None
+
+    # not public interface
+    def open_segment(self, seg: int) -> int:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        fd = os.open(segment_path(self.datadir, seg), flags, 0o644)
+        fsync_dir(self.datadir)
+        return fd
+
+    def wait_durable(self, lsn: int):
+        """Group commit, see class docstring"""
+        with self.cond:
+            while self.synced_lsn < lsn and self.syncing:
+                self.cond.wait()
+            if self.synced_lsn >= lsn:
+                return
+            self.syncing = True
+            target, fd = self.lsn, self.fd
+
+        try:
+            os.fsync(fd)
+        finally:
+            with self.cond:
+                self.syncing = False
+                self.synced_lsn = max(self.synced_lsn, target)
+                self.cond.notify_all()
+
+    def rotate(self) -> int:
+        """
+        Switch appends to a new segment, returns its number.
+        Caller holds cond, which keeps appends out until the switch is done.
+        """
+        while self.syncing:
+            self.cond.wait()
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.synced_lsn = self.lsn
+        self.segment += 1
+        self.fd = self.open_segment(self.segment)
+        return self.segment
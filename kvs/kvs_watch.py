@@ -0,0 +1,121 @@
+"""
+Copyright 2024 Jim Clampffer
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at^M
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import threading
+
+"Longest a watch may park before answering with no changes"
+MAX_WATCH_TIMEOUT_S = 300
+
+
+class Watch(object):
+    """
+    A parked long-poll on one key or on every key under a prefix.
+    Nothing runs on its behalf while parked. Writers call wake() with the
+    key they changed, which records it and releases whoever is waiting:
+    a thread blocked in wait(), or a coroutine in wait_async().
+    """
+
+    __slots__ = "key", "prefix", "timeout", "changed", "event", "loop", "future"
+
+    def __init__(self, key: str, prefix: str, timeout: float):
+        self.key = key
+        self.prefix = prefix
+        self.timeout = min(timeout, MAX_WATCH_TIMEOUT_S)
+        self.changed = []
+        self.event = threading.Event()
+        self.loop = None
+        self.future = None
+
+    def wake(self, key: str):
+        """Called by writers, possibly from any thread"""
+        self.changed.append(key)
+        self.event.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.resolve)
+
+    def resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+    def wait(self):
+        """Block the calling thread until woken or timed out"""
+        self.event.wait(self.timeout)
+
+    async def wait_async(self):
+        """Park a coroutine until woken or timed out, no thread is held"""
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        if self.event.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.future, self.timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class WatchRegistry(object):
+    """
+    Index of parked watches. Key watches are found with one dict lookup.
+    Prefix watches are grouped by prefix length so a change only probes one
+    slice of the key per distinct length, rather than every watch.
+    """
+
+    __slots__ = "lock", "by_key", "by_prefix", "prefix_lens"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_key = {}
+        self.by_prefix = {}
+        self.prefix_lens = {}
+
+    def add(self, w: Watch):
+        with self.lock:
+            if w.key is not None:
+                self.by_key.setdefault(w.key, []).append(w)
+            else:
+                self.by_prefix.setdefault(w.prefix, []).append(w)
+                n = len(w.prefix)
+                self.prefix_lens[n] = self.prefix_lens.get(n, 0) + 1
+
+    def remove(self, w: Watch):
+        with self.lock:
+            if w.key is not None:
+                table, name = self.by_key, w.key
+            else:
+                table, name = self.by_prefix, w.prefix
+                n = len(w.prefix)
+                self.prefix_lens[n] -= 1
+                if self.prefix_lens[n] == 0:
+                    del self.prefix_lens[n]
+
+            waiting = table[name]
+            waiting.remove(w)
+            if not waiting:
+                del table[name]
+
+    def fire(self, key: str):
+        """Wake every watch covering key"""
+        if not self.by_key and not self.by_prefix:
+            return
+
+        with self.lock:
+            woken = list(self.by_key.get(key, ()))
+            for n in self.prefix_lens:
+                woken.extend(self.by_prefix.get(key[:n], ()))
+
+        for w in woken:
+            w.wake(key)